@@ -0,0 +1,131 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Client password verification off the reactor thread.
+
+Checking a sha512_crypt hash takes tens of milliseconds, and the crypt() it comes down to holds the GIL, so a burst
+of reconnecting clients would stall every user if it were done on the reactor, and not much less in a thread. The
+Authenticator does it in a small pool of processes instead (auth_processes, 0 verifies on the reactor as before) and
+hands back a Deferred.
+
+Successful verifications are remembered for auth_cache_ttl seconds, keyed on a keyed digest of the user, its stored
+hash and the password, so reconnects skip the pool and a changed password invalidates the entry. Sources with
+auth_max_failures failed attempts in the last auth_failure_window seconds are refused without verifying anything.
+"""
+import time
+import hmac
+import hashlib
+import os
+import signal
+import multiprocessing
+from collections import deque
+
+from twisted.internet import reactor, defer
+from passlib.apps import custom_app_context as pwd_context
+
+import metrics
+import thudlog
+
+log = thudlog.getLogger("auth")
+
+DEFAULT_PROCESSES = 2
+DEFAULT_CACHE_TTL = 300
+DEFAULT_MAX_FAILURES = 5
+DEFAULT_FAILURE_WINDOW = 60
+MAX_PENDING = 1000  # verifications queued for the pool before new ones are refused outright
+MAX_SOURCES = 10000  # sources with failed attempts tracked before the ones that aged out are swept
+
+attempts = metrics.counter("thud_auth_attempts_total", "Client password checks, by result (ok, cached, failed, blocked, busy)", ("result",))
+
+
+def verify_password(password, stored_hash):
+    """ Runs in a pool process. """
+    try:
+        return pwd_context.verify(password, stored_hash)
+    except Exception:
+        return False  # a malformed hash; apply_async has no way to report errors back
+
+
+def init_pool_process():
+    # signals meant for the bouncer (Ctrl-C in a terminal, SIGHUP reloads) are not for the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+
+class Authenticator(object):
+    def __init__(self, processes=DEFAULT_PROCESSES, cache_ttl=DEFAULT_CACHE_TTL, max_failures=DEFAULT_MAX_FAILURES, failure_window=DEFAULT_FAILURE_WINDOW):
+        self.pool = None
+        if processes:
+            self.pool = multiprocessing.Pool(processes, init_pool_process)
+            reactor.addSystemEventTrigger("before", "shutdown", self.pool.terminate)
+        self.cache_ttl = cache_ttl
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        self.secret = os.urandom(16)
+        self.verified = {}  # key is a digest of (user, stored hash, password), value is when it expires
+        self.failures = {}  # key is source address, value is a deque of failure times
+        self.pending = 0
+
+    def verify(self, username, password, stored_hash, source):
+        """ Return a Deferred firing with whether password matches stored_hash. """
+        now = time.time()
+        if self.blocked(source, now):
+            attempts.inc(("blocked",))
+            log.warning("refusing authentication for %s from %s, too many failed attempts", username, source)
+            return defer.succeed(False)
+        key = hmac.new(self.secret, "\0".join((username, stored_hash or "", password)), hashlib.sha256).digest()
+        if self.verified.get(key, 0) > now:
+            attempts.inc(("cached",))
+            return defer.succeed(True)
+        if self.pending >= MAX_PENDING:
+            attempts.inc(("busy",))
+            log.warning("refusing authentication for %s from %s, %d verifications already pending", username, source, self.pending)
+            return defer.succeed(False)
+        d = self.check(password, stored_hash)
+
+        def __checked(ok):
+            if ok:
+                attempts.inc(("ok",))
+                self.expire(time.time())
+                self.verified[key] = time.time() + self.cache_ttl
+            else:
+                attempts.inc(("failed",))
+                self.failed(source, time.time())
+            return ok
+        return d.addCallback(__checked)
+
+    def check(self, password, stored_hash):
+        if not stored_hash:
+            return defer.succeed(False)
+        if not self.pool:
+            return defer.succeed(verify_password(password, stored_hash))
+        d = defer.Deferred()
+        self.pending += 1
+
+        def __done(ok):
+            self.pending -= 1
+            d.callback(ok)
+        # the callback runs in the pool's result thread
+        self.pool.apply_async(verify_password, (password, stored_hash), callback=lambda ok: reactor.callFromThread(__done, ok))
+        return d
+
+    def expire(self, now):
+        for key, expires in self.verified.items():
+            if expires <= now:
+                del self.verified[key]
+
+    def blocked(self, source, now):
+        failures = self.failures.get(source)
+        if not failures:
+            return False
+        while failures and failures[0] <= now - self.failure_window:
+            failures.popleft()
+        if not failures:
+            del self.failures[source]
+            return False
+        return len(failures) >= self.max_failures
+
+    def failed(self, source, now):
+        self.failures.setdefault(source, deque()).append(now)
+        if len(self.failures) > MAX_SOURCES:
+            # forget the sources whose failures have all aged out
+            for other in self.failures.keys():
+                self.blocked(other, now)
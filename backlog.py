@@ -0,0 +1,281 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Append-only, segmented on-disk backlog storage.
+
+Every (user, network, buffer) gets its own directory holding a series of segments. A segment is a pair of files:
+    <first sequence number>.log - the raw IRC lines, one per line, append-only
+    <first sequence number>.idx - fixed size (timestamp, sequence, offset) records, one per line in the .log
+
+The index files are memory-mapped for lookups, so finding the start of a replay is a bisection over the index
+instead of a scan through the log. The maps are released again once a replay has read what it needs.
+
+The stores of all buffers share one BacklogFiles: segment files are kept open for appending in its LRU cache (see
+chatlog.OpenFileCache), so the number of buffers doesn't decide the number of open files, and it flushes them every
+backlog_flush_interval seconds, as well as before every snapshot, so a crash loses at most that much. It also expires
+old segments of every store every backlog_expire_interval seconds; a quiet buffer may never fill up a segment to
+roll over to the next one, which is where expiry happens otherwise.
+"""
+import os
+import time
+import bisect
+import mmap
+import errno
+import struct
+import weakref
+
+from twisted.internet import reactor, task
+
+import chatlog
+
+INDEX_ENTRY = struct.Struct("<dQQ")  # timestamp, sequence number, offset into the .log file
+
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_OPEN_FILES = 256
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_EXPIRE_INTERVAL = 600
+
+
+def to_timestamp(dt):
+    """ Convert a (local time) datetime into a unix timestamp. """
+    if dt.year < 1970:
+        return 0.0
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1000000.0
+
+
+class Segment(object):
+    def __init__(self, directory, first_seq, files):
+        self.first_seq = first_seq
+        self.files = files  # the OpenFileCache of BacklogFiles
+        base = os.path.join(directory, "%020d" % first_seq)
+        self.log_path = base + ".log"
+        self.idx_path = base + ".idx"
+        self.log_size = None  # size of the .log file, once looked up
+        self._map = None
+        self._mapped_size = 0
+
+    def close(self):
+        self.files.close(self.log_path)
+        self.files.close(self.idx_path)
+        self.unmap()
+
+    def unmap(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+            self._mapped_size = 0
+
+    def flush(self):
+        self.files.flush(self.log_path)
+        self.files.flush(self.idx_path)
+
+    def append(self, timestamp, seq, line):
+        offset = self.size()
+        self.files.get(self.log_path).write(line + "\n")
+        self.files.get(self.idx_path).write(INDEX_ENTRY.pack(timestamp, seq, offset))
+        self.log_size = offset + len(line) + 1
+
+    def size(self):
+        if self.log_size is None:
+            try:
+                self.log_size = os.path.getsize(self.log_path)
+            except OSError:
+                self.log_size = 0
+        return self.log_size
+
+    def _index(self):
+        """ Return an up-to-date memory map of the index file (or None if it is still empty). """
+        size = os.path.getsize(self.idx_path)
+        size -= size % INDEX_ENTRY.size  # ignore a torn trailing record
+        if size != self._mapped_size:
+            if self._map:
+                self._map.close()
+                self._map = None
+            if size:
+                with open(self.idx_path, "rb") as f:
+                    self._map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+        return self._map
+
+    def __len__(self):
+        return self._mapped_size // INDEX_ENTRY.size
+
+    def entry(self, n):
+        return INDEX_ENTRY.unpack_from(self._map, n * INDEX_ENTRY.size)
+
+    def last_entry(self):
+        if not self._index():
+            return None
+        return self.entry(len(self) - 1)
+
+    def bisect(self, seq):
+        """ Return the position of the first entry with a sequence number greater than seq. """
+        if not self._index():
+            return 0
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[1] > seq:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def read_from(self, n):
+        """ Yield (timestamp, seq, line) for every entry from position n onwards. """
+        if not self._index() or n >= len(self):
+            return
+        count = len(self)
+        with open(self.log_path, "rb") as f:
+            while n < count:
+                timestamp, seq, offset = self.entry(n)
+                # the index is the authority on where a line starts; a torn write can leave the log out of step
+                if f.tell() != offset:
+                    f.seek(offset)
+                line = f.readline()
+                if not line.endswith("\n"):
+                    return  # still being written, or cut short by a crash
+                yield timestamp, seq, line[:-1]
+                n += 1
+
+
+class BacklogStore(object):
+    """ The on-disk backlog of a single buffer. """
+    def __init__(self, directory, files, segment_size=DEFAULT_SEGMENT_SIZE, max_age=DEFAULT_MAX_AGE, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.files = files
+        self.segment_size = segment_size
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.segments = []
+        for filename in sorted(os.listdir(directory)):
+            name, ext = os.path.splitext(filename)
+            if ext == ".log" and name.isdigit():
+                self.segments.append(Segment(directory, int(name), files))
+        self.last_seq = 0
+        if self.segments:
+            last = self.segments[-1].last_entry()
+            self.last_seq = last and last[1] or self.segments[-1].first_seq - 1
+            self.segments[-1].unmap()
+        self.expire()
+
+    def append(self, timestamp, line):
+        """ Store a line, returning the sequence number it was stored under. """
+        if not self.segments or self.segments[-1].size() >= self.segment_size:
+            self.roll()
+        self.last_seq += 1
+        self.segments[-1].append(timestamp, self.last_seq, line)
+        return self.last_seq
+
+    def roll(self):
+        if self.segments:
+            self.segments[-1].close()
+        self.segments.append(Segment(self.directory, self.last_seq + 1, self.files))
+        self.expire()
+
+    def expire(self, now=None):
+        """ Drop the oldest segments once they are older than max_age, or while the store is larger than max_bytes. The segment being written to is never dropped. """
+        now = now or time.time()
+        total = sum(segment.size() for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            last = oldest.last_entry()
+            too_old = self.max_age and last and now - last[0] > self.max_age
+            too_big = self.max_bytes and total > self.max_bytes
+            if not (too_old or too_big):
+                oldest.unmap()
+                break
+            total -= oldest.size()
+            oldest.close()
+            for path in (oldest.log_path, oldest.idx_path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            del self.segments[0]
+
+    def first_seq(self):
+        """ Return the sequence number of the oldest line still stored (or of the next one, if there are none). """
+        return self.segments and self.segments[0].first_seq or self.last_seq + 1
+
+    def since_seq(self, seq, before_seq=None):
+        """ Yield (timestamp, seq, line) for every stored line after sequence number seq and, if given, before before_seq. """
+        if not self.segments:
+            return
+        self.segments[-1].flush()
+        # segments are named after their first sequence number, so the starting segment is a bisection too
+        start = max(bisect.bisect_right([segment.first_seq for segment in self.segments], seq + 1) - 1, 0)
+        segments = self.segments[start:]
+        try:
+            for i, segment in enumerate(segments):
+                for entry in segment.read_from(i == 0 and segment.bisect(seq) or 0):
+                    if before_seq is not None and entry[1] >= before_seq:
+                        return
+                    yield entry
+        finally:
+            for segment in segments:
+                segment.unmap()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class BacklogFiles(object):
+    """ What the stores of all buffers share: the cache of open segment files, and the timers flushing them and
+    expiring old segments. """
+    def __init__(self, max_open_files=DEFAULT_MAX_OPEN_FILES, flush_interval=DEFAULT_FLUSH_INTERVAL, expire_interval=DEFAULT_EXPIRE_INTERVAL):
+        self.files = chatlog.OpenFileCache(max_open_files)
+        self.stores = weakref.WeakValueDictionary()  # key is the store's directory
+        self.flush_interval = flush_interval
+        self.expire_interval = expire_interval
+        self.flush_loop = task.LoopingCall(self.flush)
+        self.expire_loop = task.LoopingCall(self.expire)
+
+    def start(self):
+        self.flush_loop.start(self.flush_interval, now=False)
+        self.expire_loop.start(self.expire_interval, now=False)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def flush(self):
+        self.files.flush_all()
+
+    def expire(self):
+        now = time.time()
+        for store in self.stores.values():
+            store.expire(now)
+
+    def stop(self):
+        for loop in (self.flush_loop, self.expire_loop):
+            if loop.running:
+                loop.stop()
+        self.files.close_all()
+
+
+def quote_name(name):
+    """ Turn a user, network or buffer name into a directory name. Everything but lower case letters and digits is
+    %-escaped, upper case letters included, so names that differ only in case get different directories even on a
+    case-insensitive filesystem. """
+    return "".join(c.isalnum() and not c.isupper() and c or "%%%02X" % ord(c) for c in name)
+
+
+def open_store(config, backlog_files, *names):
+    """ Open the on-disk backlog for the buffer identified by names (user, network, buffer), sharing backlog_files
+    with the other stores, or return None if on-disk backlogs are disabled. A buffer that is opened again while its
+    store is still alive gets the same store, so there is never more than one writer per directory. """
+    directory = config.backlog_dir
+    if not directory:
+        return None
+    path = os.path.join(directory, *[quote_name(name) for name in names])
+    store = backlog_files.stores.get(path)
+    if store is None:
+        store = backlog_files.stores[path] = BacklogStore(path, backlog_files.files,
+                                                          segment_size=config.backlog_segment_size or DEFAULT_SEGMENT_SIZE,
+                                                          max_age=config.backlog_max_age or DEFAULT_MAX_AGE,
+                                                          max_bytes=config.backlog_max_bytes or DEFAULT_MAX_BYTES)
+    return store
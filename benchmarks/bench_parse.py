@@ -0,0 +1,102 @@
+#!/usr/bin/env python2.7
+""" Micro-benchmark for irc.parse_line against the old tuple-returning parse_message.
+
+Untagged lines, the usual case, and tagged ones are also compared on their own:
+the old parser didn't parse IRCv3 tags at all. Besides the raw parser throughput
+it also reports the cost for a buffered channel line, which the old code parsed
+once on dispatch and once more on replay.
+
+A single parse_line call is slower than the old parser, because it builds a
+Message where the old one returned a tuple. On Python 2.7.18, over six runs of
+200000 lines with 7 repeats, parse_line ran at 0.86-1.09x the old parser on
+untagged lines (typically about 0.95x), 0.45-0.5x on tagged ones and 0.8-0.87x
+on the mix. A buffered line still comes out at 1.65-1.9x, because it is parsed once
+instead of twice. Runs on a busy machine vary by 10% or more, so compare the
+parsers within one run only.
+
+Usage: python2.7 benchmarks/bench_parse.py [lines] [repeat]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import irc
+
+
+def legacy_parse_message(message):
+    """ The parser irc.py used before Message existed, kept here verbatim for comparison. """
+    prefix = ""
+    if message.startswith(":"):
+        prefix, code, args = message.split(" ", 2)
+    else:
+        if " " in message:
+            code, args = message.split(" ", 1)
+        else:
+            code, args = (message, "")
+
+    if ":" in args:
+        if args[0] == ":":
+            args = " " + args
+        args, d, last_arg = args.partition(" :")
+        args = args.split() + [last_arg]
+    else:
+        args = args.split(" ")
+    if code.isdigit():
+        code = int(code)
+        if code in irc.numeric_codes_reverse:
+            code = irc.numeric_codes_reverse[int(code)]
+    return (prefix, code, args)
+
+
+SAMPLE = [
+    ":nick!user@some.host.example PRIVMSG #channel :hello there, how is everybody doing today?",
+    ":nick!user@some.host.example NOTICE #channel :this is a notice with a few more words in it",
+    ":irc.example.net 352 thud #channel ~user host.example irc.example.net nick H@ :0 Real Name",
+    ":irc.example.net 353 thud = #channel :@op +voice nick1 nick2 nick3 nick4 nick5 nick6",
+    ":other!user@other.host JOIN #channel",
+    ":other!user@other.host MODE #channel +o nick",
+    "PING :irc.example.net",
+    "@time=2012-06-30T23:59:60.419Z;msgid=abc :nick!user@host PRIVMSG #channel :tagged line",
+]
+
+
+def run(parsers, lines, repeat):
+    """ Return the best lines/sec of each parser. The parsers take turns, so a noisy machine slows them down alike. """
+    best = [None] * len(parsers)
+    for i in range(repeat):
+        for n, parser in enumerate(parsers):
+            def loop():
+                for line in lines:
+                    parser(line)
+            elapsed = timeit.timeit(loop, number=1)
+            best[n] = min(best[n] or elapsed, elapsed)
+    return [len(lines) / elapsed for elapsed in best]
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 200000
+    repeat = len(sys.argv) > 2 and int(sys.argv[2]) or 5
+    lines = (SAMPLE * (count // len(SAMPLE) + 1))[:count]
+    # a buffered channel line used to be parsed on dispatch and again on replay
+    legacy, current, buffered = run([legacy_parse_message, irc.parse_line,
+                                     lambda line: (legacy_parse_message(line), legacy_parse_message(line))], lines, repeat)
+    print "%-32s %12.0f lines/sec" % ("legacy parse_message", legacy)
+    print "%-32s %12.0f lines/sec" % ("irc.parse_line", current)
+    print "%-32s %12.2fx" % ("speedup (single parse)", current / legacy)
+    untagged = [line for line in lines if not line.startswith("@")]
+    legacy_untagged, current_untagged = run([legacy_parse_message, irc.parse_line], untagged, repeat)
+    print "%-32s %12.0f lines/sec" % ("legacy, untagged lines", legacy_untagged)
+    print "%-32s %12.0f lines/sec" % ("irc.parse_line, untagged lines", current_untagged)
+    print "%-32s %12.2fx" % ("speedup (untagged)", current_untagged / legacy_untagged)
+    tagged = [line for line in lines if line.startswith("@")]
+    legacy_tagged, current_tagged = run([legacy_parse_message, irc.parse_line], tagged, repeat)
+    print "%-32s %12.0f lines/sec" % ("legacy, tagged lines", legacy_tagged)
+    print "%-32s %12.0f lines/sec" % ("irc.parse_line, tagged lines", current_tagged)
+    print "%-32s %12.2fx" % ("speedup (tagged)", current_tagged / legacy_tagged)
+    print "%-32s %12.0f lines/sec" % ("legacy dispatch + replay", buffered)
+    print "%-32s %12.2fx" % ("speedup (buffered line)", current / buffered)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+""" A stand-in IRC network for load tests.
+
+It speaks just enough of the server side of the protocol for thud to register, join channels and fill its cache
+(welcome numerics, JOIN/NAMES/TOPIC, WHO, MODE, PING), and generates channel traffic at a configurable rate.
+
+Every bouncer connection is joined to all channels, each of which has a set of simulated members that talk (PRIVMSG),
+come and go (JOIN/PART) and change nicks (NICK). PRIVMSG text carries the time it was sent and the load step it
+belongs to ("t=<time> s=<step>"), so the receiving end can measure latency.
+"""
+import time
+import random
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineReceiver
+
+SERVER = "irc.load.test"
+TICKS_PER_SECOND = 100
+
+
+class FakeServerConnection(LineReceiver):
+    delimiter = "\r\n"
+    MAX_LENGTH = 1 << 20
+
+    def connectionMade(self):
+        self.nick = None
+        self.channels = set()
+
+    def connectionLost(self, reason):
+        self.factory.disconnected(self)
+
+    def reply(self, numeric, text):
+        self.sendLine(":%s %s %s %s" % (SERVER, numeric, self.nick, text))
+
+    def lineReceived(self, line):
+        if line.startswith(":"):
+            line = line.split(" ", 1)[1]
+        command, sep, rest = line.partition(" ")
+        handler = getattr(self, "irc_%s" % command.upper(), None)
+        if handler:
+            handler(rest.split(" "))
+
+    def irc_NICK(self, args):
+        self.nick = args[0]
+
+    def irc_USER(self, args):
+        self.reply("001", ":Welcome to the load test network %s" % self.nick)
+        self.reply("002", ":Your host is %s" % SERVER)
+        self.reply("003", ":This server was created just now")
+        self.reply("004", "%s fakenet-1 io ovntk" % SERVER)
+        self.reply("005", "CASEMAPPING=rfc1459 PREFIX=(ov)@+ CHANTYPES=# :are supported by this server")
+        self.reply("375", ":- %s Message of the day -" % SERVER)
+        self.reply("372", ":- load testing only")
+        self.reply("376", ":End of /MOTD command.")
+        self.factory.registered(self)
+
+    def irc_JOIN(self, args):
+        for name in args[0].split(","):
+            channel = self.factory.channels.get(name)
+            if channel is None:
+                continue
+            self.channels.add(name)
+            channel.connections.add(self)
+            self.sendLine(":%s!%s@load.test JOIN %s" % (self.nick, self.nick, name))
+            self.reply("332", "%s :load test channel %s" % (name, name))
+            members = sorted(channel.members)
+            for i in range(0, len(members), 50):
+                self.reply("353", "= %s :%s" % (name, " ".join(members[i:i + 50])))
+            self.reply("366", "%s :End of /NAMES list." % name)
+
+    def irc_PART(self, args):
+        for name in args[0].split(","):
+            channel = self.factory.channels.get(name)
+            if channel:
+                channel.connections.discard(self)
+                self.channels.discard(name)
+
+    def irc_MODE(self, args):
+        if args[0] in self.factory.channels:
+            self.reply("324", "%s +nt" % args[0])
+
+    def irc_WHO(self, args):
+        channel = self.factory.channels.get(args[0])
+        if channel:
+            for nick in sorted(channel.members):
+                self.reply("352", "%s %s load.test %s %s H :0 %s" % (args[0], nick, SERVER, nick, nick))
+        self.reply("315", "%s :End of /WHO list." % args[0])
+
+    def irc_PING(self, args):
+        self.sendLine(":%s PONG %s %s" % (SERVER, SERVER, args[0]))
+
+
+class FakeChannel(object):
+    def __init__(self, name, members):
+        self.name = name
+        self.members = set(members)
+        self.away = set()  # members that have parted and may join again
+        self.connections = set()
+
+
+class FakeNetwork(ServerFactory):
+    """ channels channels with members members each. mix is the relative weight of PRIVMSG, JOIN/PART and NICK traffic. """
+    protocol = FakeServerConnection
+
+    def __init__(self, channels=10, members=50, mix=(90, 8, 2), seed=0):
+        self.random = random.Random(seed)
+        self.channels = {}
+        for c in range(channels):
+            name = "#load%d" % c
+            self.channels[name] = FakeChannel(name, ["m%d_%d" % (c, m) for m in range(members)])
+        self.names = sorted(self.channels)
+        self.mix = mix
+        self.connections = set()
+        self.rate = 0
+        self.step = 0
+        self.carry = 0.0
+        self.sent = {}  # key is step, value is the number of PRIVMSG lines delivered to bouncer connections
+        self.nick_counter = 0
+        self.loop = task.LoopingCall(self.tick)
+
+    def registered(self, connection):
+        self.connections.add(connection)
+
+    def disconnected(self, connection):
+        self.connections.discard(connection)
+        for channel in self.channels.values():
+            channel.connections.discard(connection)
+
+    def set_rate(self, rate, step=0):
+        """ Generate rate events per second from now on, tagging PRIVMSGs with step. A rate of 0 stops the traffic. """
+        self.rate = rate
+        self.step = step
+        self.carry = 0.0
+        if rate and not self.loop.running:
+            self.loop.start(1.0 / TICKS_PER_SECOND, now=False)
+        elif not rate and self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        self.carry += float(self.rate) / TICKS_PER_SECOND
+        count = int(self.carry)
+        self.carry -= count
+        for i in range(count):
+            self.event()
+
+    def event(self):
+        channel = self.channels[self.random.choice(self.names)]
+        if not channel.connections:
+            return
+        roll = self.random.uniform(0, sum(self.mix))
+        if roll < self.mix[0] or not channel.members:
+            nick = channel.members and self.random.choice(tuple(channel.members)) or "ghost"
+            line = ":%s!%s@load.test PRIVMSG %s :t=%.6f s=%d lorem ipsum dolor sit amet" % (nick, nick, channel.name, time.time(), self.step)
+            self.sent[self.step] = self.sent.get(self.step, 0) + len(channel.connections)
+        elif roll < self.mix[0] + self.mix[1]:
+            if channel.away and (self.random.random() < 0.5 or len(channel.members) < 2):
+                nick = self.random.choice(tuple(channel.away))
+                channel.away.discard(nick)
+                channel.members.add(nick)
+                line = ":%s!%s@load.test JOIN %s" % (nick, nick, channel.name)
+            else:
+                nick = self.random.choice(tuple(channel.members))
+                channel.members.discard(nick)
+                channel.away.add(nick)
+                line = ":%s!%s@load.test PART %s :bye" % (nick, nick, channel.name)
+        else:
+            old = self.random.choice(tuple(channel.members))
+            self.nick_counter += 1
+            new = "n%d" % self.nick_counter
+            channel.members.discard(old)
+            channel.members.add(new)
+            line = ":%s!%s@load.test NICK :%s" % (old, old, new)
+        for connection in channel.connections:
+            connection.sendLine(line)
+
+
+def listen(port, **kwargs):
+    network = FakeNetwork(**kwargs)
+    reactor.listenTCP(port, network, interface="127.0.0.1")
+    return network
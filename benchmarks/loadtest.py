@@ -0,0 +1,227 @@
+#!/usr/bin/env python2.7
+""" End-to-end load test: a fake IRC network, a swarm of simulated clients and a real thud in between.
+
+The driver writes a throwaway config directory (thud.conf plus one .user file per simulated user), starts thud.py
+on it as a separate process and points it at the fake network. Once every user has joined its channels and every
+client is attached it runs:
+
+    ramp      traffic is stepped up through --rates; each step reports upstream-to-client latency percentiles,
+              the fraction of lines delivered and the bouncer's CPU use. The highest step that delivered
+              everything with a p99 under --max-latency is the max sustainable rate.
+    reattach  a fraction of the clients detach while traffic continues, then reattach; reports the time until
+              every channel was rejoined and until the replay was complete.
+
+The bouncer's RSS is sampled throughout and reported at the end. The fake network and the clients share this
+process, so if it is pegged at 100% CPU the numbers describe the harness rather than thud; run fewer clients or
+users in that case.
+
+To compare event loops, run it once per --engine and compare the max sustainable rate and CPU use.
+
+Usage: python2.7 benchmarks/loadtest.py [--users N] [--channels N] [--members N] [--clients N] [--rates 500,1000,...]
+                                        [--engine default|epoll|poll|select]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+from twisted.internet import reactor, task, defer
+from twisted.python.failure import Failure
+from passlib.apps import custom_app_context as pwd_context
+
+import fakenet
+import swarm
+
+THUD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "thud.py")
+PASSWORD = "loadtest"
+REF = "loadnet"
+
+THUD_CONF = """tcp_enable: true
+tcp_port: %(port)d
+ssl_enable: false
+backlog_depth: %(backlog_depth)d
+query_backlog_depth: 50
+backlog_dir: %(backlog_dir)s
+debug_level: WARNING
+engine: %(engine)s
+connect_spread: 0
+"""
+
+USER_CONF = """name: %(name)s
+password: %(password)s
+nick: %(name)s
+realname: load test
+networks:
+    - ref: %(ref)s
+      uri: irc://127.0.0.1:%(upstream_port)d
+      autoconnect: true
+      channels:
+%(channels)s
+"""
+
+
+def write_config(directory, args):
+    with open(os.path.join(directory, "thud.conf"), "w") as f:
+        f.write(THUD_CONF % {"port": args.port, "backlog_depth": args.backlog_depth, "backlog_dir": os.path.join(directory, "backlog"),
+                                 "engine": args.engine})
+    password = pwd_context.encrypt(PASSWORD)
+    channels = "".join("        - name: '#load%d'\n          key: ''\n" % c for c in range(args.channels))
+    users = ["load%d" % u for u in range(args.users)]
+    for name in users:
+        with open(os.path.join(directory, "%s.user" % name), "w") as f:
+            f.write(USER_CONF % {"name": name, "password": password, "ref": REF, "upstream_port": args.upstream_port, "channels": channels})
+    return users
+
+
+def rss(pid):
+    """ Resident set size of pid in kB, or None where /proc isn't available. """
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def cpu_seconds(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError):
+        return None
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+@defer.inlineCallbacks
+def wait_for(condition, timeout, what):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out waiting for %s" % what)
+        yield sleep(0.1)
+
+
+@defer.inlineCallbacks
+def run(args, network, clients, bouncer):
+    rss_samples = [rss(bouncer.pid)]
+    print "waiting for %d users to join %d channels" % (args.users, args.channels)
+    yield wait_for(lambda: all(len(channel.connections) >= args.users for channel in network.channels.values()), args.timeout, "users to join")
+
+    started = time.time()
+    clients.attach()
+    yield wait_for(lambda: clients.attached() == len(clients.clients), args.timeout, "clients to attach")
+    print "%d clients attached in %.2fs" % (len(clients.clients), time.time() - started)
+    rss_samples.append(rss(bouncer.pid))
+
+    print
+    print "%8s %9s %9s %9s %9s %9s %9s %7s %8s" % ("rate", "delivered", "p50 ms", "p90 ms", "p99 ms", "max ms", "lines/s", "cpu %", "rss kB")
+    sustainable = 0
+    for step, rate in enumerate(args.rates, 1):
+        cpu = cpu_seconds(bouncer.pid)
+        network.set_rate(rate, step)
+        yield sleep(args.step_seconds)
+        network.set_rate(0)
+        cpu = cpu is not None and (cpu_seconds(bouncer.pid) - cpu) / args.step_seconds * 100 or float("nan")
+        yield sleep(args.grace)
+        latencies = sorted(clients.latencies.get(step, []))
+        expected = network.sent.get(step, 0) * args.clients
+        delivered = expected and float(len(latencies)) / expected or 0
+        rss_samples.append(rss(bouncer.pid))
+        print "%8d %8.1f%% %9.1f %9.1f %9.1f %9.1f %9.0f %7.0f %8s" % (
+            rate, delivered * 100, percentile(latencies, .5) * 1000, percentile(latencies, .9) * 1000,
+            percentile(latencies, .99) * 1000, latencies and latencies[-1] * 1000 or float("nan"),
+            len(latencies) / float(args.step_seconds), cpu, rss_samples[-1])
+        if delivered < 0.99 or percentile(latencies, .99) > args.max_latency:
+            break
+        sustainable = rate
+    # every user is in every channel, so each event reaches every client
+    print "max sustainable rate: %d events/sec (%d lines/sec to clients)" % (sustainable, sustainable * args.users * args.clients)
+
+    detached = clients.clients[:max(int(len(clients.clients) * args.reattach_fraction), 1)]
+    print
+    print "detaching %d clients for %ds at %d events/sec" % (len(detached), args.detach_seconds, args.reattach_rate)
+    clients.detach(detached)
+    network.set_rate(args.reattach_rate, 0)
+    yield sleep(args.detach_seconds)
+    network.set_rate(0)
+    yield sleep(args.grace)
+    clients.attach(detached)
+    yield wait_for(lambda: all(client.replayed_fully for client in detached), args.timeout, "replays to complete")
+    welcome = sorted(client.welcome_time for client in detached)
+    replay = sorted(client.replay_time for client in detached)
+    replayed = sum(sum(client.replayed.values()) for client in detached)
+    print "rejoined all channels: p50 %.1f ms, max %.1f ms" % (percentile(welcome, .5) * 1000, welcome[-1] * 1000)
+    print "replay complete:       p50 %.1f ms, max %.1f ms (%d lines replayed in total)" % (percentile(replay, .5) * 1000, replay[-1] * 1000, replayed)
+    rss_samples.append(rss(bouncer.pid))
+
+    if rss_samples[0] is not None:
+        print
+        print "bouncer rss: %d kB at start, %d kB with clients attached, %d kB at the end (+%d kB)" % (
+            rss_samples[0], rss_samples[1], rss_samples[-1], rss_samples[-1] - rss_samples[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test for thud.")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--channels", type=int, default=10, help="channels per user")
+    parser.add_argument("--members", type=int, default=50, help="simulated members per channel")
+    parser.add_argument("--clients", type=int, default=2, help="clients per user")
+    parser.add_argument("--mix", default="90,8,2", help="relative weight of PRIVMSG, JOIN/PART and NICK events")
+    parser.add_argument("--rates", default="100,250,500,1000,2000,4000,8000", help="events/sec for each ramp step")
+    parser.add_argument("--step-seconds", type=int, default=5)
+    parser.add_argument("--grace", type=float, default=2, help="seconds to wait for stragglers after each step")
+    parser.add_argument("--max-latency", type=float, default=1.0, help="p99 latency, in seconds, a step may have to count as sustainable")
+    parser.add_argument("--reattach-fraction", type=float, default=0.5)
+    parser.add_argument("--reattach-rate", type=int, default=200)
+    parser.add_argument("--detach-seconds", type=int, default=5)
+    parser.add_argument("--ping-interval", type=float, default=5, help="seconds between client PINGs")
+    parser.add_argument("--backlog-depth", type=int, default=1000)
+    parser.add_argument("--engine", default="default", choices=("default", "epoll", "poll", "select"), help="event loop for thud to run on (see engine.py)")
+    parser.add_argument("--port", type=int, default=26667, help="port thud listens on")
+    parser.add_argument("--upstream-port", type=int, default=26668, help="port the fake network listens on")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--keep", action="store_true", help="keep the generated config directory")
+    args = parser.parse_args()
+    args.rates = [int(rate) for rate in args.rates.split(",")]
+
+    directory = tempfile.mkdtemp(prefix="thud-loadtest-")
+    users = write_config(directory, args)
+    network = fakenet.listen(args.upstream_port, channels=args.channels, members=args.members, mix=[int(w) for w in args.mix.split(",")])
+    clients = swarm.Swarm("127.0.0.1", args.port, users, PASSWORD, REF, args.clients, args.channels, args.ping_interval)
+    bouncer = subprocess.Popen([sys.executable, os.path.abspath(THUD), directory], cwd=directory)
+    failed = []
+
+    def finished(result):
+        if isinstance(result, Failure):
+            failed.append(result)
+            print "load test failed: %s" % result.getErrorMessage()
+        reactor.stop()
+    reactor.callLater(1, lambda: run(args, network, clients, bouncer).addBoth(finished))
+    try:
+        reactor.run()
+    finally:
+        bouncer.terminate()
+        bouncer.wait()
+        if args.keep:
+            print "config left in %s" % directory
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+""" A swarm of simulated downstream clients for load tests.
+
+Each client authenticates with a user:password:ref:resource token, PINGs periodically like a real client would (which
+also keeps its replay cursor current), records the latency of every timestamped PRIVMSG it receives (see fakenet),
+and can detach and reattach, timing how long the replay takes.
+"""
+import re
+import time
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.basic import LineReceiver
+
+STAMP = re.compile(r" PRIVMSG \S+ :t=([0-9.]+) s=([0-9]+) ")
+WELCOME_BACK = re.compile(r"^:thud!cache@th\.ud NOTICE (\S+) :Welcome back!.* there have been ([0-9]+) messages(?:; the last ([0-9]+))?")
+REPLAYED = re.compile(r"^\S+ PRIVMSG (\S+) :\[[0-9:]{8}\] ")
+
+
+class SimulatedClient(LineReceiver):
+    # thud joins multi-line blocks (names, replays) with bare newlines inside one \r\n-terminated write
+    delimiter = "\n"
+    MAX_LENGTH = 1 << 24
+
+    def connectionMade(self):
+        self.factory.connected(self)
+        self.transport.write("PASS %s\r\n" % self.factory.token)
+        self.transport.write("NICK %s\r\nUSER %s 0 * :load test\r\n" % (self.factory.user, self.factory.user))
+        self.pinger = task.LoopingCall(self.transport.write, "PING :load\r\n")
+        self.pinger.start(self.factory.swarm.ping_interval, now=False)
+
+    def connectionLost(self, reason):
+        self.pinger.stop()
+        self.factory.disconnected(self)
+
+    def lineReceived(self, line):
+        self.factory.line(line.rstrip("\r"))
+
+
+class SimulatedClientFactory(ClientFactory):
+    """ One downstream client (user, resource), surviving any number of detach/reattach cycles. """
+    protocol = SimulatedClient
+
+    def __init__(self, swarm, user, password, ref, resource):
+        self.swarm = swarm
+        self.user = user
+        self.resource = resource
+        self.token = "%s:%s:%s:%s" % (user, password, ref, resource)
+        self.connection = None
+        self.attach_started = None
+        self.reset_replay()
+
+    def reset_replay(self):
+        self.welcomed = set()  # channels whose "Welcome back" notice has arrived
+        self.expected = {}  # key is channel, value is the number of replayed lines announced
+        self.replayed = {}  # key is channel, value is the number of replayed lines received
+        self.welcome_time = None
+        self.replay_time = None
+
+    def attach(self, host, port):
+        self.reset_replay()
+        self.attach_started = time.time()
+        reactor.connectTCP(host, port, self)
+
+    def detach(self):
+        if self.connection:
+            self.connection.transport.loseConnection()
+
+    def connected(self, connection):
+        self.connection = connection
+
+    def disconnected(self, connection):
+        if self.connection is connection:
+            self.connection = None
+
+    def line(self, line):
+        m = STAMP.search(line)
+        if m:
+            self.swarm.sample(int(m.group(2)), time.time() - float(m.group(1)))
+            return
+        m = WELCOME_BACK.match(line)
+        if m:
+            self.welcomed.add(m.group(1))
+            self.expected[m.group(1)] = int(m.group(3) or m.group(2))
+            self.replayed.setdefault(m.group(1), 0)
+            if len(self.welcomed) == self.swarm.channels:
+                self.welcome_time = time.time() - self.attach_started
+            self.check_replay()
+            return
+        m = REPLAYED.match(line)
+        if m:
+            self.replayed[m.group(1)] = self.replayed.get(m.group(1), 0) + 1
+            self.check_replay()
+
+    def check_replay(self):
+        if self.replay_time is None and len(self.welcomed) == self.swarm.channels and \
+                all(self.replayed.get(name, 0) >= count for name, count in self.expected.items()):
+            self.replay_time = time.time() - self.attach_started
+
+    @property
+    def attached(self):
+        return self.welcome_time is not None
+
+    @property
+    def replayed_fully(self):
+        return self.replay_time is not None
+
+
+class Swarm(object):
+    def __init__(self, host, port, users, password, ref, clients_per_user, channels, ping_interval=30):
+        self.host = host
+        self.port = port
+        self.ping_interval = ping_interval
+        self.channels = channels
+        self.clients = []
+        for user in users:
+            for n in range(clients_per_user):
+                self.clients.append(SimulatedClientFactory(self, user, password, ref, "load%d" % n))
+        self.latencies = {}  # key is step, value is a list of latencies in seconds
+
+    def sample(self, step, latency):
+        self.latencies.setdefault(step, []).append(latency)
+
+    def attach(self, clients=None):
+        for client in clients or self.clients:
+            client.attach(self.host, self.port)
+
+    def detach(self, clients=None):
+        for client in clients or self.clients:
+            client.detach()
+
+    def attached(self, clients=None):
+        return sum(1 for client in clients or self.clients if client.attached)
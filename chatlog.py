@@ -0,0 +1,123 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Chat log writing.
+
+The reactor only ever formats a line and appends it to a pending batch. A background thread wakes up every
+flush_interval seconds, groups the batch by file and writes each file's lines with a single write() call. Open files
+are kept in a small LRU cache, so a user sitting in hundreds of channels neither runs out of file descriptors nor pays
+for an open()/close() per line.
+"""
+import os
+import errno
+import threading
+from collections import OrderedDict
+
+import thudlog
+
+log = thudlog.getLogger("chatlog")
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_OPEN_FILES = 64
+DEFAULT_MAX_PENDING = 100000
+
+
+class OpenFileCache(object):
+    """ LRU cache of files opened for appending, keyed on path. Recency is a counter rather than the order of an
+    OrderedDict, which is slow to reorder on every lookup; once full, the least recently used quarter is closed. """
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.files = {}
+        self.used = {}  # key is path, value is the lookup count when it was last asked for
+        self.lookups = 0
+
+    def get(self, path):
+        self.lookups += 1
+        f = self.files.get(path)
+        if f is None:
+            if len(self.files) >= self.max_open:
+                self.evict()
+            directory = os.path.dirname(path)
+            if directory:
+                try:
+                    os.makedirs(directory)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            f = self.files[path] = open(path, "ab")
+        self.used[path] = self.lookups
+        return f
+
+    def evict(self):
+        # a quarter at a time, so a full cache doesn't sort on every open
+        for path in sorted(self.used, key=self.used.get)[:max(self.max_open // 4, 1)]:
+            self.close(path)
+
+    def flush(self, path):
+        f = self.files.get(path)
+        if f:
+            f.flush()
+
+    def flush_all(self):
+        for f in self.files.values():
+            f.flush()
+
+    def close(self, path):
+        self.used.pop(path, None)
+        f = self.files.pop(path, None)
+        if f:
+            f.close()
+
+    def close_all(self):
+        for path in self.files.keys():
+            self.close(path)
+
+
+class ChatLogWriter(object):
+    def __init__(self, flush_interval=DEFAULT_FLUSH_INTERVAL, max_open_files=DEFAULT_MAX_OPEN_FILES, max_pending=DEFAULT_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.files = OpenFileCache(max_open_files)
+        self.pending = []  # (path, line) tuples
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="thud-chatlog-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, path, line):
+        """ Queue line to be appended to the file at path. Called from the reactor thread. """
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self.pending.append((path, line))
+
+    def _run(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+        self.files.close_all()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            log.warning("chat log writer fell behind, %d lines dropped", dropped)
+        if not batch:
+            return
+        by_path = OrderedDict()
+        for path, line in batch:
+            by_path.setdefault(path, []).append(line)
+        for path, lines in by_path.items():
+            try:
+                f = self.files.get(path)
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+            except (IOError, OSError), e:
+                log.error("failed to write %d lines to chat log %s: %s", len(lines), path, e)
+
+    def stop(self):
+        """ Write out everything still pending and close all files. """
+        self.stopping.set()
+        self.thread.join()
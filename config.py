@@ -9,6 +9,7 @@ class Config(object):
         if self._filename:
             self.readfile()
         self._children = []
+        self._indexes = {} # key is a child key, value is a dict of that key's values to children
         self._parse()
 
     def readfile(self):
@@ -57,13 +58,22 @@ class Config(object):
             if "=" not in selector:
                 raise ConfigError("We need a selector to be able to pick the right child!")
             key,sep,value = selector.partition("=")
-            for child in self._children:
-                if child._data[key] == value:
-                    if path:
-                        return child.by_path(path)
-                    return child
+            child = self.get_child(key,value)
+            if child and path:
+                return child.by_path(path)
+            return child
         return None
 
+    def get_child(self, key, value):
+        """ Return the first child whose key is value, or None. Lookups go through an index per key, built on first use. """
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = {}
+            for child in self._children:
+                if key in child._data:
+                    index.setdefault(child._data[key],child)
+        return index.get(value)
+
     def __getattr__(self, name):
         return self.get_with_fallback(name)
     def __setattr__(self, name, value):
@@ -0,0 +1,269 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Scheduling of connections to the networks.
+
+Every connect thud makes upstream - autoconnect on startup, connect on demand, reconnect after losing a connection -
+goes through the bouncer's ConnectionScheduler, which keeps at most one attempt per user and network and:
+
+    spreads startup connects over connect_spread seconds, instead of hitting every server at once
+    allows at most connect_max_per_host attempts per upstream host at a time, across all users; an attempt holds
+        its slot until the server welcomes us (RPL_WELCOME), it fails, or connect_timeout runs out
+    retries failed attempts with decorrelated jitter backoff between connect_backoff_base and connect_backoff_cap
+        seconds, for as long as the network stays configured
+
+An attempt only counts as successful once the server has welcomed us, so servers that accept the connection and
+then throttle us keep backing off as well. Nor is the backoff forgotten on the welcome itself: a connection lost
+within connect_stable seconds of it counts as one more failure, so a server that welcomes and then kills us doesn't
+get reconnected to right away over and over.
+"""
+import re
+import time
+import heapq
+import random
+from collections import deque
+
+from twisted.internet import reactor
+
+import metrics
+import thudlog
+
+log = thudlog.getLogger("connector")
+
+DEFAULT_MAX_PER_HOST = 2
+DEFAULT_SPREAD = 30
+DEFAULT_BACKOFF_BASE = 5
+DEFAULT_BACKOFF_CAP = 600
+DEFAULT_TIMEOUT = 30
+DEFAULT_STABLE = 60
+
+WAITING = "waiting"
+CONNECTING = "connecting"
+REGISTERING = "registering"
+
+REASON_STARTUP = "startup"
+REASON_DEMAND = "on demand"
+REASON_ADDED = "added"
+REASON_RECONNECT = "reconnect"
+
+reconnect_attempts = metrics.counter("thud_reconnect_attempts_total", "Attempts to reconnect to a network after losing the connection", ("user", "network"))
+connect_failures = metrics.counter("thud_connect_failures_total", "Connection attempts that failed before the server welcomed us", ("user", "network"))
+
+
+def parse_uri(uri):
+    """ Return (protocol, host, port) of a network uri like ircs://irc.example.net:6697 """
+    m = re.match("(?:(?P<proto>[a-zA-i0-9]+)://)?(?P<host>[a-zA-Z0-9.-]+)(?:[:](?P<port>[0-9]+))?/?", uri)
+    parts = m.groupdict()
+    return (parts.get("proto") or "irc").lower(), parts.get("host"), parts.get("port") or "6667"
+
+
+class Attempt(object):
+    """ The connection of one user to one network, from the first request until the server welcomes us. """
+    def __init__(self, user, ref, host, reason):
+        self.user = user
+        self.ref = ref
+        self.host = host
+        self.reason = reason
+        self.state = WAITING
+        self.due = 0
+        self.delay = 0  # the last backoff delay, 0 until an attempt failed
+        self.failures = 0
+        self.error = None
+        self.welcomed = None  # when the server welcomed us
+        self.slot = False  # whether the attempt holds one of its host's slots
+        self.timer = None  # gives the slot back if registering takes too long
+
+    @property
+    def key(self):
+        return (self.user.config.name, self.ref)
+
+
+class ConnectionScheduler(object):
+    def __init__(self, bouncer, max_per_host=DEFAULT_MAX_PER_HOST, spread=DEFAULT_SPREAD, backoff_base=DEFAULT_BACKOFF_BASE,
+                 backoff_cap=DEFAULT_BACKOFF_CAP, timeout=DEFAULT_TIMEOUT, stable=DEFAULT_STABLE):
+        self.bouncer = bouncer
+        self.max_per_host = max_per_host
+        self.spread = spread
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.stable = stable
+        self.attempts = {}  # key is (user name, ref)
+        self.welcomed = {}  # key is (user name, ref), value is the attempt that last succeeded, for its backoff state
+        self.queue = []  # heap of (due, sequence, attempt); entries of attempts that moved on are skipped when popped
+        self.sequence = 0
+        self.active = {}  # key is host, value is the number of slots taken
+        self.ready = {}  # key is host, value is a deque of attempts that are due but waiting for a slot
+        self.timer = None
+
+    def request(self, user, ref, reason):
+        """ Have user connected to network ref. A request for a network that already has an attempt waiting is a
+        no-op; one for an attempt that got connected but not welcomed means that connection was lost. """
+        key = (user.config.name, ref)
+        attempt = self.attempts.get(key)
+        if attempt:
+            if attempt.state == REGISTERING:
+                self.failed(attempt, "disconnected before registering")
+            return
+        networkconfig = user.config.get_child("ref", ref)
+        attempt = Attempt(user, ref, parse_uri(networkconfig.uri)[1].lower(), reason)
+        self.attempts[key] = attempt
+        previous = self.welcomed.pop(key, None)
+        if reason == REASON_RECONNECT and previous and time.time() - previous.welcomed < self.stable:
+            attempt.failures, attempt.delay = previous.failures, previous.delay
+            self.failed(attempt, "disconnected %.0fs after registering" % (time.time() - previous.welcomed))
+            return
+        if reason == REASON_STARTUP:
+            delay = random.uniform(0, self.spread)
+        elif reason == REASON_RECONNECT:
+            delay = random.uniform(0, self.backoff_base)  # everyone that lost the same server shouldn't be back at once
+        else:
+            delay = 0
+        self.enqueue(attempt, delay)
+
+    def pending(self, user, ref):
+        """ Whether a connection of user to ref is waiting or underway. """
+        attempt = self.attempts.get((user.config.name, ref))
+        return bool(attempt and attempt.state != REGISTERING)
+
+    def cancel(self, user, ref=None):
+        """ Forget the attempts for one network of user, or all of them. """
+        for key, attempt in self.attempts.items():
+            if attempt.user is user and (ref is None or attempt.ref == ref):
+                self.finish(attempt)
+        for key, attempt in self.welcomed.items():
+            if attempt.user is user and (ref is None or attempt.ref == ref):
+                del self.welcomed[key]
+
+    def registered(self, user, ref):
+        """ Called when the server welcomed user on network ref: the attempt succeeded. """
+        attempt = self.attempts.get((user.config.name, ref))
+        if attempt:
+            log.info("[%s] connected to %s after %d failed attempts", user.config.name, ref, attempt.failures)
+            attempt.welcomed = time.time()
+            self.welcomed[attempt.key] = attempt
+            self.finish(attempt)
+
+    def enqueue(self, attempt, delay):
+        attempt.state = WAITING
+        attempt.due = time.time() + delay
+        self.sequence += 1
+        heapq.heappush(self.queue, (attempt.due, self.sequence, attempt))
+        self.schedule()
+
+    def schedule(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        while self.queue and not self.current(self.queue[0][2], WAITING):
+            heapq.heappop(self.queue)
+        if self.queue:
+            self.timer = reactor.callLater(max(self.queue[0][0] - time.time(), 0), self.run)
+
+    def current(self, attempt, state):
+        return self.attempts.get(attempt.key) is attempt and attempt.state == state
+
+    def run(self):
+        self.timer = None
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            due, sequence, attempt = heapq.heappop(self.queue)
+            if not self.current(attempt, WAITING) or attempt.due != due:
+                continue
+            ready = self.ready.setdefault(attempt.host, deque())
+            ready.append(attempt)
+            self.start_ready(attempt.host)
+        self.schedule()
+
+    def start_ready(self, host):
+        ready = self.ready.get(host)
+        while ready and self.active.get(host, 0) < self.max_per_host:
+            attempt = ready.popleft()
+            if self.current(attempt, WAITING):
+                self.start(attempt)
+        if not ready:
+            self.ready.pop(host, None)
+
+    def start(self, attempt):
+        user, ref = attempt.user, attempt.ref
+        networkconfig = user.config.get_child("ref", ref)
+        if user.removed or not networkconfig or ref in user.server_connections:
+            self.finish(attempt)
+            return
+        if attempt.reason == REASON_RECONNECT or attempt.failures:
+            reconnect_attempts.inc((user.config.name, ref))
+        log.info("[%s] connecting to %s (%s, attempt %d)", user.config.name, networkconfig.uri, attempt.reason, attempt.failures + 1)
+        attempt.state = CONNECTING
+        attempt.slot = True
+        self.active[attempt.host] = self.active.get(attempt.host, 0) + 1
+        attempt.timer = reactor.callLater(self.timeout, self.release, attempt)
+        d = self.bouncer.connect_server(networkconfig, user, self.timeout)
+
+        def __connected(server):
+            if not self.current(attempt, CONNECTING) or user.removed:
+                # cancelled (the network or user went away) while connecting
+                server.transport.loseConnection()
+                return
+            attempt.state = REGISTERING
+            user.server_connected(server)
+
+        def __error(failure):
+            if self.current(attempt, CONNECTING):
+                self.failed(attempt, failure.getErrorMessage())
+            else:
+                self.release(attempt)
+        d.addCallbacks(__connected, __error)
+
+    def release(self, attempt):
+        """ Give the host slot of attempt back, if it still has one. """
+        if attempt.timer:
+            if attempt.timer.active():
+                attempt.timer.cancel()
+            attempt.timer = None
+        if not attempt.slot:
+            return
+        attempt.slot = False
+        self.active[attempt.host] -= 1
+        if not self.active[attempt.host]:
+            del self.active[attempt.host]
+        self.start_ready(attempt.host)
+
+    def failed(self, attempt, error):
+        attempt.failures += 1
+        attempt.error = error
+        # decorrelated jitter: each delay is random between the base and three times the previous one
+        attempt.delay = min(self.backoff_cap, random.uniform(self.backoff_base, max(attempt.delay, self.backoff_base) * 3))
+        connect_failures.inc(attempt.key)
+        log.warning("[%s] connecting to %s failed (%s), retrying in %.0fs", attempt.user.config.name, attempt.ref, error, attempt.delay)
+        self.release(attempt)
+        self.enqueue(attempt, attempt.delay)
+        attempt.user.server_connect_failed(attempt.ref, error, attempt.delay)
+
+    def finish(self, attempt):
+        if self.attempts.get(attempt.key) is attempt:
+            del self.attempts[attempt.key]
+        attempt.state = None
+        self.release(attempt)
+
+    def describe(self, user=None):
+        """ Return a line per attempt, of user or everyone, soonest first. """
+        now = time.time()
+        lines = []
+        for attempt in sorted(self.attempts.values(), key=lambda attempt: attempt.due):
+            if user and attempt.user is not user:
+                continue
+            if attempt.state == WAITING:
+                state = "waiting, due in %.0fs" % max(attempt.due - now, 0)
+                if attempt.due <= now:
+                    state = "waiting for a slot on %s" % attempt.host
+            else:
+                state = attempt.state
+            lines.append("%s/%s %s (%s): %s, %d failed%s" % (attempt.user.config.name, attempt.ref, attempt.host, attempt.reason, state,
+                                                          attempt.failures, attempt.error and ", last error: %s" % attempt.error or ""))
+        return lines
+
+    def collect(self, family):
+        """ Add the number of attempts per state to the thud_connect_attempts gauge family. """
+        counts = dict((state, 0) for state in (WAITING, CONNECTING, REGISTERING))
+        for attempt in self.attempts.values():
+            counts[attempt.state] += 1
+        for state, count in counts.items():
+            family.add((state,), count)
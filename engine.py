@@ -0,0 +1,68 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" The event loop thud runs on, and the network calls that depend on it.
+
+Above this module everything - the line protocols in thud.py, irc.Cache, the schedulers - only deals in Twisted
+protocols, Deferreds and reactor.callLater, which behave the same on every Twisted reactor. Which reactor drives
+them is picked with 'engine' in thud.conf:
+
+    default   whatever Twisted picks for the platform (epoll on Linux)
+    epoll     \
+    poll       > one of Twisted's own reactors, to compare them
+    select    /
+
+A reactor has to be installed before anything imports twisted.internet.reactor, so thud.py calls install() ahead of
+its other imports when it runs as a script. For the same reason the functions below import the reactor when called.
+Listening and connecting for clients and servers goes through them rather than to the reactor directly.
+"""
+import importlib
+
+import config
+
+ENGINES = {
+    "epoll": "twisted.internet.epollreactor",
+    "poll": "twisted.internet.pollreactor",
+    "select": "twisted.internet.selectreactor",
+}
+
+
+class EngineError(Exception):
+    pass
+
+
+def install(configpath):
+    """ Install the reactor thud.conf in configpath asks for. Returns the engine's name. """
+    name = (config.Config(filename="%s/thud.conf" % configpath).engine or "default").lower()
+    if name == "default":
+        return name
+    if name not in ENGINES:
+        raise EngineError("unknown engine %r, use one of default, %s" % (name, ", ".join(sorted(ENGINES))))
+    try:
+        module = importlib.import_module(ENGINES[name])
+    except ImportError, e:
+        raise EngineError("engine %s is not available here: %s" % (name, e))
+    module.install()
+    return name
+
+
+def describe():
+    """ The reactor in use, for the startup log. """
+    from twisted.internet import reactor
+    return "%s.%s" % (reactor.__class__.__module__, reactor.__class__.__name__)
+
+
+def listen_tcp(port, factory):
+    from twisted.internet import reactor
+    return reactor.listenTCP(port, factory)
+
+
+def listen_ssl(port, factory, key, cert):
+    from twisted.internet import reactor, ssl
+    return reactor.listenSSL(port, factory, ssl.DefaultOpenSSLContextFactory(key, cert))
+
+
+def connect(host, port, use_ssl, factory, timeout):
+    """ Connect to host:port, over TLS if use_ssl. Returns a Deferred firing with the protocol factory built for it. """
+    from twisted.internet import reactor
+    from twisted.internet.endpoints import clientFromString
+    endpoint = clientFromString(reactor, "%s:host=%s:port=%s:timeout=%d" % (use_ssl and "ssl" or "tcp", host, port, timeout))
+    return endpoint.connect(factory)
@@ -1,30 +1,155 @@
 from collections import deque, defaultdict
 from datetime import datetime
+from itertools import islice
+import time
+import string
+import weakref
 import thudshell
+import thudlog
+import backlog
+import metrics
+import replay
+import scheduler
+import search
+import sendqueue
 
+log = thudlog.getLogger("cache")
+TRACE = thudlog.TRACE
 
-def parse_message(message):
-    prefix = ""
-    if message.startswith(":"):
-        prefix, code, args = message.split(" ", 2)
+replay_lines = metrics.histogram("thud_replay_lines", "Number of lines replayed to a client per buffer", ("user", "network"), buckets=(0, 10, 50, 100, 500, 1000, 5000, 10000, 50000))
+replay_seconds = metrics.histogram("thud_replay_seconds", "Time spent formatting a replay per buffer, summed over its chunks", ("user", "network"))
+handler_calls = metrics.counter("thud_handler_calls_total", "Server messages handled, per command (only counted with handler_timing enabled)", ("command",))
+handler_seconds = metrics.counter("thud_handler_seconds_total", "Time spent handling server messages, per command (only counted with handler_timing enabled)", ("command",))
+
+# per-handler call counts and timing cost a clock read per line, so they're off unless handler_timing is set
+handler_timing = False
+
+
+def set_handler_timing(enabled):
+    global handler_timing
+    handler_timing = bool(enabled)
+
+# last_seen value for client resources that have never been seen before
+NEVER = datetime.fromordinal(1)
+
+# messages kept in memory per channel, unless backlog_depth says otherwise
+DEFAULT_BACKLOG_DEPTH = 2000
+
+
+class Message(object):
+    """ A single parsed IRC line. The raw line is kept so the message can be forwarded as-is without being re-serialised.
+    Messages are never modified once parsed, which is what lets buffers of different users share them. Only
+    parse_line() creates them, filling in the slots itself; there is no __init__ to call per line. """
+    __slots__ = ("raw", "tags", "prefix", "command", "params", "__weakref__")
+
+    @property
+    def nick(self):
+        return nick_from_prefix(self.prefix)
+
+    def __str__(self):
+        return self.raw
+
+    def __repr__(self):
+        return "Message(%r)" % self.raw
+
+
+def unescape_tag_value(value):
+    """ Undo IRCv3 message-tag value escaping. """
+    res = []
+    i, n = 0, len(value)
+    while i < n:
+        c = value[i]
+        if c == "\\" and i + 1 < n:
+            i += 1
+            res.append(tag_escapes.get(value[i], value[i]))
+        elif c != "\\":
+            res.append(c)
+        i += 1
+    return "".join(res)
+
+
+def parse_tags(tagstring):
+    tags = {}
+    for tag in tagstring.split(";"):
+        key, sep, value = tag.partition("=")
+        if "\\" in value:
+            value = unescape_tag_value(value)
+        tags[key] = value
+    return tags
+
+
+def parse_line(line, Message=Message):
+    """ Parse a raw IRC line into a Message. This is the only place a line should ever get parsed; the resulting Message is handed around from there on.
+
+    Every line from a server comes through here, so the usual ":prefix COMMAND params" form is split in one go and
+    the slots are filled in as the parts turn up. """
+    message = Message()
+    message.raw = line
+    first = line[:1]
+    if first == "@":
+        tagstring, sep, line = line.partition(" ")
+        message.tags = parse_tags(tagstring[1:])
+        first = line[:1]
+    else:
+        message.tags = None
+    if first == ":":
+        try:
+            message.prefix, command, rest = line.split(" ", 2)
+        except ValueError:  # no parameters
+            message.prefix, sep, command = line.partition(" ")
+            rest = ""
     else:
-        if " " in message:
-            code, args = message.split(" ", 1)
+        message.prefix = ""
+        command, sep, rest = line.partition(" ")
+    if rest[:1] == ":":
+        message.params = [rest[1:]]
+    else:
+        middle, sep, trailing = rest.partition(" :")
+        if sep:
+            params = message.params = middle.split()
+            params.append(trailing)
         else:
-            code, args = (message, "")
+            message.params = rest.split()
+    if command < "A" and command.isdigit():  # digits sort before letters, so named commands skip isdigit()
+        command = numeric_names.get(command) or int(command)
+    message.command = command
+    return message
 
-    if ":" in args:
-        if args[0] == ":":
-            args = " " + args
-        args, d, last_arg = args.partition(" :")
-        args = args.split() + [last_arg]
-    else:
-        args = args.split(" ")
-    if code.isdigit():
-        code = int(code)
-        if code in numeric_codes_reverse:
-            code = numeric_codes_reverse[int(code)]
-    return (prefix, code, args)
+
+class SharedMessages(object):
+    """ Every buffered message, keyed by its raw line, for as long as some buffer holds it.
+
+    Users in the same channel get the same lines from the network. The first user's connection parses a line and
+    buffers it, and everyone else's gets that same Message (see parse_shared_line), so the process holds each distinct
+    line once however many users buffer it; per-user buffers only keep their own deques of (seq, timestamp, message)
+    references. This is a WeakValueDictionary without the exception a miss costs there, which is most lookups.
+    """
+    def __init__(self):
+        self.refs = {}  # key is a raw line, value is a weakref.KeyedRef to its Message
+
+    def __len__(self):
+        return len(self.refs)
+
+    def get(self, line):
+        ref = self.refs.get(line)
+        return ref and ref()
+
+    def add(self, message):
+        ref = self.refs.get(message.raw)
+        if ref is None or ref() is not message:
+            self.refs[message.raw] = weakref.KeyedRef(message, self.remove, message.raw)
+
+    def remove(self, ref):
+        # called once the last buffer dropped the message, possibly in the snapshot writer thread
+        if self.refs.get(ref.key) is ref:
+            self.refs.pop(ref.key, None)
+
+shared_messages = SharedMessages()
+
+
+def parse_shared_line(line):
+    """ parse_line for lines from a server: a line some buffer still holds isn't parsed again, its Message is shared. """
+    return shared_messages.get(line) or parse_line(line)
 
 
 def nick_from_prefix(prefix):
@@ -40,221 +165,532 @@ def make_prefix(nick, host):
 
 
 class MessageLogger(object):
-    def __init__(self, config, server, name):
-        self.config, self.server, self.name = config, server, name
-        self.file_template = config.log_file_template
-        self.timestamp_template = config.log_timestamp_template
-        self.open_file()
-
-    def open_file(self):
-        if self.file:
-            self.file.close()
-        self.file_opened = datetime.now()
-        filename = self.file_opened.strftime(self.file_template.replace("%SERVER", self.server).replace("%CHANNEL", self.name))
-        self.file = open(filename, 'at')
+    """ Turns the messages of a single buffer into chat log lines and hands them to the bouncer's ChatLogWriter.
+
+    The file name comes from the log_filename template: %y, %m and %d are replaced with the date (so logs rotate
+    daily), %n with the network ref and %c with the channel or query name.
+    """
+    def __init__(self, writer, template, cache, name):
+        self.writer = writer
+        self.template = template
+        self.cache = cache
+        self.name = name
+        self.day = None
+        self.path = None
+
+    def get_path(self, timestamp):
+        day = timestamp.date()
+        if day != self.day:
+            self.day = day
+            path = self.template.replace("%y", "%04d" % day.year).replace("%m", "%02d" % day.month).replace("%d", "%02d" % day.day)
+            self.path = path.replace("%n", self.cache.server.config.ref).replace("%c", self.name.replace("/", "_"))
+        return self.path
+
+    def format(self, message):
+        nick = message.nick or self.cache.nick
+        command, args = message.command, message.params
+        if command == "PRIVMSG":
+            if args[-1].startswith("\x01ACTION "):
+                return "* %s %s" % (nick, args[-1][8:].rstrip("\x01"))
+            return "<%s> %s" % (nick, args[-1])
+        elif command == "NOTICE":
+            return "-%s- %s" % (nick, args[-1])
+        elif command == "JOIN":
+            return "*** %s has joined" % nick
+        elif command == "PART":
+            return "*** %s has left (%s)" % (nick, len(args) > 1 and args[1] or "")
+        elif command == "TOPIC":
+            return "*** topic has been set by %s to: %s" % (nick, args[-1])
+        elif command == "MODE":
+            return "*** %s sets mode %s" % (nick, " ".join(args[1:]))
+        elif command == "NICK":
+            return "*** %s is now known as %s" % (nick, args[0])
+        elif command == "QUIT":
+            return "*** %s has quit (%s)" % (nick, args and args[0] or "")
+        elif command == "KICK":
+            return "*** %s was kicked by %s (%s)" % (args[1], nick, len(args) > 2 and args[2] or "")
+        return None
 
     def log(self, timestamp, message):
-        if timestamp.day > self.file_opened.day:
-            self.open_file()
-        prefix, code, args = message
-        if code == "PRIVMSG":
-            self.file.writeline("%s: <%s> %s" % (timestamp.strftime(self.timestamp_template), prefix[1:].partition("!")[0], args))
+        line = self.format(message)
+        if line is not None:
+            self.writer.write(self.get_path(timestamp), "[%s] %s" % (timestamp.strftime("%H:%M:%S"), line))
 
 
 class MessageBuffer(object):
-    def __init__(self, config, maxlen=0):
+    def __init__(self, cache, name, config, maxlen=0):
+        self.cache = cache
+        self.name = name
         self.config = config
         if not maxlen:
-            maxlen = self.config.backlog_depth
-        self.messages = deque(maxlen=maxlen)
-        if 0 and self.config.logging:
-            self.logger = MessageLogger(self.config)
-            self.log_message = self._log_message
+            maxlen = self.config.backlog_depth or DEFAULT_BACKLOG_DEPTH
+        self.messages = deque(maxlen=maxlen)  # (seq, timestamp, message) tuples
+        self.buffered_bytes = 0  # size of the raw lines in self.messages
+        # everything also goes to disk (if configured), so replays can reach back further than the deque
+        self.store = backlog.open_store(config, cache.user.bouncer.backlog_files, cache.user.config.name, cache.server.config.ref, name)
+        # sequence numbers are contiguous per buffer and carry on from whatever is already on disk
+        self.last_seq = self.store and self.store.last_seq or 0
+        self.index = self.config.search_index and search.BufferIndex() or None  # for THUD search
+        if self.store:
+            self.load_from_store()
+        if self.config.log_enable and self.config.log_filename:
+            self.logger = MessageLogger(cache.user.bouncer.chatlog, self.config.log_filename, cache, name)
+            self.log_message = self.logger.log
         else:
             self.log_message = lambda x, y: None
 
-    def _log_message(self, timestamp, message):
-        self.logger.log(timestamp, message)
-
     def add_message(self, message):
         timestamp = datetime.now()
         self.log_message(timestamp, message)
-        self.messages.append((timestamp, message))
-
-    def get_messages_since(self, last_time):
-        print "REPLAYING MESSAGES SINCE %s" % last_time
-        messages = []
-        for stamp, message in self.messages:
-            if stamp > last_time:
-                #TODO: make this configurable!
-                prefix, code, args = parse_message(message)
-                if not prefix:
-                    prefix = make_prefix(self.cache.nick, self.cache.host)
-                message = "%s %s %s :[%s] %s" % (prefix, code, args[0], stamp.strftime("%H:%M:%S"), args[1])
-                messages.append(message)
-        return messages
+        if self.store:
+            self.last_seq = self.store.append(backlog.to_timestamp(timestamp), message.raw)
+        else:
+            self.last_seq += 1
+        if len(self.messages) == self.messages.maxlen:
+            seq, stamp, oldest = self.messages[0]
+            self.buffered_bytes -= len(oldest.raw)
+            if self.index:
+                self.index.remove(seq, self.indexed_nick(oldest), oldest.params[-1])
+        self.messages.append((self.last_seq, timestamp, message))
+        self.buffered_bytes += len(message.raw)
+        shared_messages.add(message)
+        if self.index:
+            self.index.add(self.last_seq, self.indexed_nick(message), message.params[-1])
+
+    def load_from_store(self):
+        """ Fill the deque with the newest messages on disk, as add_message would have left it, so that after a
+        restart replays and THUD search start out from what was there before. Only as many as the deque holds are
+        read, however much more the store has. """
+        for timestamp, seq, line in self.store.since_seq(max(self.store.last_seq - self.messages.maxlen, 0)):
+            message = parse_shared_line(line)
+            self.messages.append((seq, datetime.fromtimestamp(timestamp), message))
+            self.buffered_bytes += len(line)
+            shared_messages.add(message)
+            if self.index:
+                self.index.add(seq, self.indexed_nick(message), message.params[-1])
+
+    def indexed_nick(self, message):
+        # messages our clients sent are buffered with our prefix; only ones from before that was done have none
+        return self.cache.fold(message.prefix and message.nick or self.cache.nick)
+
+    def snapshot(self):
+        """ Return the buffer's state for snapshot.py. Messages are left as (seq, datetime, Message) tuples for the
+        snapshot writer to convert, unless the backlog store already has them. """
+        return {"name": self.name, "last_seq": self.last_seq, "messages": not self.store and list(self.messages) or []}
+
+    def restore(self, state):
+        if self.store:
+            # the snapshot has no messages for this buffer, load_from_store read them back from disk already. Cursors
+            # past the store's end mean lines that never made it to disk; new lines get those sequence numbers again,
+            # so move the cursors back for them to be replayed
+            for cursors in self.cache.cursors.values():
+                if cursors.get(self.name, 0) > self.last_seq:
+                    cursors[self.name] = self.last_seq
+        else:
+            self.last_seq = state["last_seq"]
+            self.messages.extend((seq, datetime.fromtimestamp(timestamp), parse_shared_line(raw)) for seq, timestamp, raw in state["messages"])
+            self.buffered_bytes = sum(len(message.raw) for seq, stamp, message in self.messages)
+            for seq, stamp, message in self.messages:
+                shared_messages.add(message)
+            if self.index:
+                for seq, stamp, message in self.messages:
+                    self.index.add(seq, self.indexed_nick(message), message.params[-1])
+
+    def format_replay(self, stamp, message):
+        #TODO: make this configurable!
+        prefix = message.prefix or make_prefix(self.cache.nick, self.cache.host)
+        args = message.params
+        return "%s %s %s :[%s] %s" % (prefix, message.command, args[0], stamp.strftime("%H:%M:%S"), args[1])
+
+    def oldest_seq(self):
+        """ Return the sequence number of the oldest message a replay can still reach, on disk or in memory. """
+        first_seq = self.last_seq - len(self.messages) + 1
+        return self.store and min(self.store.first_seq(), first_seq) or first_seq
+
+    def replay_range(self, cursor):
+        """ Return (cursor, end, skipped): replay the messages after sequence number cursor up to and including end,
+        which are at most replay_max_lines, the skipped ones older than that being left for THUD backlog. A cursor of
+        None means the resource has never been seen, and only gets what is still in memory. """
+        end = self.last_seq
+        first_seq = end - len(self.messages) + 1
+        if cursor is None:
+            cursor = first_seq - 1
+        else:
+            # what has expired can't be replayed, nor counted as such
+            cursor = max(cursor, self.oldest_seq() - 1)
+        limit = self.config.replay_max_lines or replay.DEFAULT_MAX_LINES
+        skipped = max(end - cursor - limit, 0)
+        return cursor + skipped, end, skipped
+
+    def replay_chunks(self, cursor, end, progress=None):
+        """ Return an iterator over the formatted replay of the messages after sequence number cursor up to and
+        including end, as lists of at most replay_chunk_lines lines. The messages still in memory are picked out right
+        away, so the deque moving on while the replay is under way doesn't cost it lines the NOTICE before it counted;
+        older ones are read from disk a chunk at a time. If given, progress[name] is kept at the last sequence number
+        sent so far. """
+        log.debug("replaying %s from sequence %s to %s", self.name, cursor, end)
+        first_seq = self.last_seq - len(self.messages) + 1
+        # sequence numbers in the deque are contiguous, so the range's position is simple arithmetic
+        pinned = end >= first_seq and deque_slice(self.messages, max(cursor + 1 - first_seq, 0), end + 1 - first_seq) or []
+        return self._replay_chunks(cursor, min(end, first_seq - 1), pinned, progress)
+
+    def _replay_chunks(self, cursor, stored_end, pinned, progress):
+        chunk_lines = self.config.replay_chunk_lines or replay.DEFAULT_CHUNK_LINES
+        labels = (self.cache.user.config.name, self.cache.server.config.ref)
+        replay_lines.observe(labels, max(stored_end - cursor, 0) + len(pinned))
+        spent = 0
+        seq = cursor + 1
+        while self.store and seq <= stored_end:
+            started = time.time()
+            chunk = []
+            for timestamp, stored_seq, line in islice(self.store.since_seq(seq - 1, stored_end + 1), chunk_lines):
+                chunk.append(self.format_replay(datetime.fromtimestamp(timestamp), parse_line(line)))
+                seq = stored_seq + 1
+            if not chunk:
+                break  # expired from disk while the replay was under way
+            spent += time.time() - started
+            # the stream only asks for a chunk when the client's outbound queue is empty, and sends it right away
+            if progress is not None:
+                progress[self.name] = seq - 1
+            yield chunk
+        for start in xrange(0, len(pinned), chunk_lines):
+            started = time.time()
+            chunk = [self.format_replay(stamp, message) for seq, stamp, message in pinned[start:start + chunk_lines]]
+            spent += time.time() - started
+            if progress is not None:
+                progress[self.name] = pinned[start + len(chunk) - 1][0]
+            yield chunk
+        replay_seconds.observe(labels, spent)
+
+    def skipped_notice(self, skipped, replayed):
+        return ":thud!cache@th.ud NOTICE %s :%d older messages in %s were not replayed, THUD backlog %s %d %d fetches them" % (self.cache.nick, skipped, self.name, self.name, skipped, replayed)
 
     def rejoin(self, client, last_seen):
-        # replay messages since the last_seen time.
-        client.sendLine("\n".join(self.get_messages_since(last_seen)))
+        self.replay_to(client)
+
+    def replay_to(self, client):
+        """ Queue the replay of the messages the resource hasn't seen yet. """
+        cursor, end, skipped = self.replay_range(self.cache.get_cursor(client.resource, self.name))
+        if skipped:
+            client.replay.add_lines([self.skipped_notice(skipped, end - cursor)])
+        client.replay.add(self.replay_chunks(cursor, end, client.replay.replayed))
+
+    def replay_older(self, client, count, skip):
+        """ Replay count messages, ending skip messages before the newest one; used by THUD backlog. """
+        end = max(self.last_seq - skip, 0)
+        cursor = min(max(end - count, self.oldest_seq() - 1, 0), end)
+        client.replay.add_lines([":thud!cache@th.ud NOTICE %s :Replaying the %d messages in %s before the last %d:" % (self.cache.nick, end - cursor, self.name, skip)])
+        client.replay.add(self.replay_chunks(cursor, end))
+
+
+def deque_slice(d, start, stop):
+    """ Return d[start:stop] as a list, walking in from whichever end of the deque is closer. """
+    if start > len(d) - stop:
+        items = list(islice(reversed(d), len(d) - stop, len(d) - start))
+        items.reverse()
+        return items
+    return list(islice(d, start, stop))
+
+
+# channel membership prefixes, highest first, as in ISUPPORT PREFIX=(qaohv)~&@%+
+MEMBER_PREFIXES = "~&@%+"
+
+# ISUPPORT CASEMAPPING values, as translation tables folding a nick or channel name to its lower case key
+CASEMAPPINGS = {
+    "ascii": string.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    "rfc1459": string.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^"),
+    "strict-rfc1459": string.maketrans(string.ascii_uppercase + "[]\\", string.ascii_lowercase + "{}|"),
+}
+DEFAULT_CASEMAPPING = "rfc1459"
 
 
 class ChannelMember(object):
-    def __init__(self, nick=None, prefix=None, whoargs=None):
-        if not (prefix or nick or whoargs):
-            raise ValueError("A ChannelMember cannot be constructed without one of nick, prefix or whoargs")
-        if prefix:
-            self.nick = nick_from_prefix(prefix)
-            self.host = nick_from_prefix(prefix)
-        if nick:
-            self.nick = nick
-        if whoargs:
-            self.user, self.host, self.server, self.nick, modestring = whoargs[:5]
-            self.hops, dummy, self.realname = whoargs[5].partition(" ")
-            self.away = modestring[0] == "G"
-            self.ircoper = len(modestring) > 1 and modestring[1] == "*"
-            self.mode = self.ircoper and modestring[2:] or modestring[1:]
-        else:
-            self.user, self.server, self.hops, self.realname, self.away, self.ircoper, self.mode = ("", "", "", "", False, False, "")
-
-    def get_modestring(self):
-        modestring = self.away and "G" or "H"
-        modestring += self.ircoper and "*" or ""
-        modestring += self.mode
-        return modestring
-
-    def __repr__(self):
-        return "%s %s %s %s %s :%s %s" % (self.user, self.host, self.server, self.nick, self.get_modestring(), self.hops, self.realname)
+    """ Someone in at least one of our channels on a network. There is one per nick per network, shared by all of its channels; the per-channel mode prefix lives in ChannelBuffer.members. """
+    __slots__ = ("nick", "user", "host", "server", "hops", "realname", "away", "ircoper", "channels")
 
-    def update_modes(self, mode):
-        if mode == "+o":
-            self.mode = "@"
-        elif mode == "-o" and self.mode == "@":
-            self.mode = ""
-        elif mode == "+v" and not self.mode:
-            self.mode = "+"
-        elif mode == "-v" and self.mode == "+":
-            self.mode = ""
+    def __init__(self, nick):
+        self.nick = nick
+        self.user = self.host = self.server = self.hops = self.realname = ""
+        self.away = self.ircoper = False
+        self.channels = set()  # ChannelBuffers this member is in; doubles as the nick -> channels index
+
+    def set_prefix(self, prefix):
+        """ Fill in user and host from a nick!user@host prefix, if it has them. """
+        user, sep, host = prefix.partition("!")[2].partition("@")
+        if sep:
+            # the same few user and host strings show up over and over across members and channels
+            self.user = intern(user)
+            self.host = intern(host)
+
+    def set_who(self, whoargs):
+        """ Fill in everything from the arguments of an RPL_WHOREPLY (from the user field on), returning the channel mode prefix it carried. """
+        user, host, server, self.nick, modestring = whoargs[:5]
+        self.user, self.host, self.server = intern(user), intern(host), intern(server)
+        self.hops, dummy, self.realname = whoargs[5].partition(" ")
+        self.away = modestring[0] == "G"
+        self.ircoper = len(modestring) > 1 and modestring[1] == "*"
+        return self.ircoper and modestring[2:] or modestring[1:]
+
+    def get_modestring(self, mode):
+        return (self.away and "G" or "H") + (self.ircoper and "*" or "") + mode
+
+    def format_who(self, mode):
+        return "%s %s %s %s %s :%s %s" % (self.user, self.host, self.server, self.nick, self.get_modestring(mode), self.hops, self.realname)
+
+
+def update_mode_prefix(prefix, mode):
+    """ Return the channel mode prefix after applying a single +o/-o/+v/-v change. """
+    if mode == "+o":
+        return "@"
+    elif mode == "-o" and prefix == "@":
+        return ""
+    elif mode == "+v" and not prefix:
+        return "+"
+    elif mode == "-v" and prefix == "+":
+        return ""
+    return prefix
 
 
 class ChannelBuffer(MessageBuffer):
     def __init__(self, name, cache, config):
-        MessageBuffer.__init__(self, config)
-        self.cache = cache
-        self.name = name
+        MessageBuffer.__init__(self, cache, name, config)
+        self.members = {}  # key is casefolded nick, value is the member's mode prefix ("@", "+" or "") in this channel
+        # NAMES and WHO replies are rendered on first request and kept until the membership changes; WHO lines are
+        # kept per member, so a change only costs re-rendering that member's line
+        self.names_block = None
+        self.who_block = None
+        self.who_lines = {}  # key is casefolded nick, value is the member's rendered 352 line
+        self.rendered_for = None  # the (server prefix, our nick) every rendered line carries
         self.init_vars()
         self.has_who = False
 
     def init_vars(self):
-        self.members = {}
+        self.clear_members()
         self.topic = ""
         self.join = ""
         self.who = []
         self.mode = []
         self.is_joined = True
 
+    def clear_members(self):
+        for key in self.members.keys():
+            self.cache.remove_member(self, key)
+
+    def member_changed(self, key):
+        """ Forget what was rendered for member key; called whenever they join, leave or change in any way. """
+        self.who_lines.pop(key, None)
+        self.names_block = self.who_block = None
+
+    def invalidate(self):
+        self.who_lines = {}
+        self.names_block = self.who_block = None
+
+    def check_rendered(self):
+        if self.rendered_for != (self.cache.serverprefix, self.cache.nick):
+            self.invalidate()
+            self.rendered_for = (self.cache.serverprefix, self.cache.nick)
+
+    def snapshot(self):
+        state = MessageBuffer.snapshot(self)
+        state.update(topic=self.topic, mode=list(self.mode), members=dict(self.members), has_who=self.has_who, is_joined=self.is_joined)
+        return state
+
+    def restore(self, state):
+        MessageBuffer.restore(self, state)
+        self.topic = state["topic"]
+        self.mode = state["mode"]
+        self.has_who = state["has_who"]
+        self.is_joined = state["is_joined"]
+        for key, mode in state["members"].items():
+            member = self.cache.members.get(key)
+            if member:
+                member.channels.add(self)
+                self.members[key] = mode
+
     def rejoin(self, client, last_seen):
         client.sendLine("%s JOIN %s" % (make_prefix(self.cache.nick, self.cache.host), self.name))
         #TODO: FETCH the topic if we don't have one
         client.sendLine("%s 332 %s %s :%s" % (self.cache.serverprefix, self.cache.nick, self.name, self.topic))
         client.sendLine("\n".join(self.mode))
-        client.sendLine("\n".join(self.get_names()))
-        messages = self.get_messages_since(last_seen)
-        client.sendLine(":thud!cache@th.ud NOTICE %s :Welcome back! You were last here at %s. Since then, there have been %d messages, replayed below:" % (self.name, last_seen, len(messages)))
-        client.sendLine("\n".join(messages))
+        client.sendLine(self.get_names())
+        cursor, end, skipped = self.replay_range(self.cache.get_cursor(client.resource, self.name))
+        if skipped:
+            notice = "Since then, there have been %d messages; the last %d are replayed below, THUD backlog %s %d %d fetches the rest:" % (skipped + end - cursor, end - cursor, self.name, skipped, end - cursor)
+        else:
+            notice = "Since then, there have been %d messages, replayed below:" % (end - cursor)
+        client.replay.add_lines([":thud!cache@th.ud NOTICE %s :Welcome back! You were last here at %s. %s" % (self.name, last_seen, notice)])
+        client.replay.add(self.replay_chunks(cursor, end, client.replay.replayed))
 
     def part(self):
-        print "[-] PART %s" % self.name
+        log.debug("part %s", self.name)
         self.is_joined = False
+        self.clear_members()
 
-    def add_join(self, source, message, prefix, code, args):
-        print "[-] ADD_JOIN(%s)" % message
-        if nick_from_prefix(prefix) == self.cache.nick:
-            print "[-] ACTUALLY JOINING %s" % self.name
+    def add_join(self, source, message):
+        log.log(TRACE, "ADD_JOIN(%s)", message.raw)
+        nick = message.nick
+        if self.cache.fold(nick) == self.cache.fold(self.cache.nick):
+            log.debug("joined %s", self.name)
             self.init_vars()
+            self.log_message(datetime.now(), message)
         else:
-            self.members[nick_from_prefix(prefix)] = ChannelMember(prefix=prefix)  # just add the nick to the dictionary
-            print "SENDING WHO for %s" % nick_from_prefix(prefix)
-            source.sendLine(":thud!cache@th.ud WHO %s" % nick_from_prefix(prefix))
-
-    def add_part(self, source, message, prefix, code, args):
-        print "[-] ADD_PART(%s)" % message
-        if nick_from_prefix(prefix) == self.cache.nick:
-            self.is_joined = False
+            self.log_message(datetime.now(), message)
+            member = self.cache.add_member(self, nick)
+            member.set_prefix(message.prefix)
+            self.cache.member_updated(member)
+            if not member.server:
+                # nothing known about them from any other channel yet
+                source.scheduler.who(nick, self.name)
+
+    def add_part(self, source, message):
+        log.log(TRACE, "ADD_PART(%s)", message.raw)
+        self.log_message(datetime.now(), message)
+        self.remove(message.nick)
+
+    def remove(self, nick):
+        """ nick left the channel, by parting or being kicked. """
+        if self.cache.fold(nick) == self.cache.fold(self.cache.nick):
+            self.part()
         else:
-            del self.members[nick_from_prefix(prefix)]
+            self.cache.remove_member(self, self.cache.fold(nick))
 
-    def add_names(self, source, message, prefix, code, args):
-        #print "[-] ADD_NAMES(%s)" % message
-        if code == "RPL_NAMREPLY":
-            for name in args[3].split(" "):
-                if name.startswith("@") or name.startswith("+"):
-                    name = name[1:]
-                if not name in self.members:
-                    self.members[name] = ChannelMember(nick=name)
+    def add_names(self, source, message):
+        if message.command == "RPL_NAMREPLY":
+            for name in message.params[3].split(" "):
+                if not name:
+                    continue
+                mode = name[0] in MEMBER_PREFIXES and name[0] or ""
+                self.cache.add_member(self, name.lstrip(MEMBER_PREFIXES), mode)
 
     def get_names(self):
-        messages = []
-        names = self.members.keys()
-        while names:
-            messages.append("%s 353 %s = %s :%s" % (self.cache.serverprefix, self.cache.nick, self.name, " ".join(names[:3])))
-            names = names[3:]
-        messages.append("%s 366 %s %s :End of NAMES list" % (self.cache.serverprefix, self.cache.nick, self.name))
-        return messages
-
-    def update_nick(self, old, new):
-        if old in self.members:
-            tmp = self.members[old]
-            tmp.nick = new
-            self.members[new] = tmp
-            del self.members[old]
-
-    def set_topic(self, source, message, prefix, code, args):
-        print "[-] SET_TOPIC(%s)" % message
-        self.topic = args[2]
-
-    def add_channel_mode(self, source, message, prefix, code, args):
-        print "[-] ADD_CHANNEL_MODE(%s)" % message
-        self.mode.append(message)
-
-    def add_mode(self, source, message, prefix, code, args):
-        print "[-] ADD_MODE(%s)" % message
-        print args
+        """ Return the NAMES reply for the channel as one block of lines, with as many prefixed nicks per 353 as fit. """
+        self.check_rendered()
+        if self.names_block is None:
+            messages = []
+            members = self.cache.members
+            head = "%s 353 %s = %s :" % (self.cache.serverprefix, self.cache.nick, self.name)
+            names = []
+            length = len(head) - 1  # the first name has no separating space
+            for key, mode in self.members.iteritems():
+                name = mode + members[key].nick
+                if names and length + 1 + len(name) > scheduler.MAX_LINE_LENGTH:
+                    messages.append(head + " ".join(names))
+                    names = []
+                    length = len(head) - 1
+                names.append(name)
+                length += 1 + len(name)
+            if names:
+                messages.append(head + " ".join(names))
+            messages.append("%s 366 %s %s :End of NAMES list" % (self.cache.serverprefix, self.cache.nick, self.name))
+            self.names_block = "\n".join(messages)
+        return self.names_block
+
+    def set_topic(self, source, message):
+        log.log(TRACE, "SET_TOPIC(%s)", message.raw)
+        self.topic = message.params[-1]
+        self.log_message(datetime.now(), message)
+
+    def add_channel_mode(self, source, message):
+        log.log(TRACE, "ADD_CHANNEL_MODE(%s)", message.raw)
+        self.mode.append(message.raw)
+
+    def add_mode(self, source, message):
+        log.log(TRACE, "ADD_MODE(%s)", message.raw)
+        self.log_message(datetime.now(), message)
+        args = message.params
         if len(args) < 3:
-            self.add_channel_mode(source, message, prefix, code, args)
+            self.add_channel_mode(source, message)
             return
-        if not args[2] in self.members:
-            print "\n" * 5 + "channel member not found: " + args + "\n" * 5
+        key = self.cache.fold(args[2])
+        if not key in self.members:
+            log.warning("%s: channel member not found: %s", self.name, args)
             return
-        self.members[args[2]].update_modes(args[1])
-
-    def add_who(self, source, message, prefix, code, args):
-        # print "[-] ADD_WHO(%s)" % message
-        if code == "RPL_WHOREPLY":
-            self.members[args[5]] = ChannelMember(whoargs=args[2:])
+        self.members[key] = update_mode_prefix(self.members[key], args[1])
+        self.member_changed(key)
+
+    def add_who(self, source, message):
+        if message.command == "RPL_WHOREPLY":
+            args = message.params
+            member = self.cache.add_member(self, args[5])
+            self.members[self.cache.fold(args[5])] = intern(member.set_who(args[2:]))
+            self.cache.member_updated(member)
         self.has_who = True
 
     def get_who(self):
-        messages = []
-        for name, member in self.members.items():
-            messages.append("%s 352 %s %s %s" % (self.cache.serverprefix, self.cache.nick, self.name, repr(member)))
-        messages.append("%s 315 %s %s :End of WHO list" % (self.cache.serverprefix, self.cache.nick, self.name))
-        return messages
+        """ Return the WHO reply for the channel as one block of lines. """
+        self.check_rendered()
+        if self.who_block is None:
+            members = self.cache.members
+            lines = self.who_lines
+            for key, mode in self.members.iteritems():
+                if key not in lines:
+                    lines[key] = "%s 352 %s %s %s" % (self.cache.serverprefix, self.cache.nick, self.name, members[key].format_who(mode))
+            messages = [lines[key] for key in self.members]
+            messages.append("%s 315 %s %s :End of WHO list" % (self.cache.serverprefix, self.cache.nick, self.name))
+            self.who_block = "\n".join(messages)
+        return self.who_block
 
 
 class QueryBuffer(MessageBuffer):
-    def __init__(self, nick, config):
-        MessageBuffer.__init__(self, config, config.query_backlog_depth)
+    def __init__(self, nick, cache, config):
+        MessageBuffer.__init__(self, cache, nick, config, config.query_backlog_depth)
         self.nick = nick
 
 
-class DummyLogger(object):
-    def call(self, *args):
-        pass
+HANDLER_PREFIX = "handle_server_"
+
+
+def chain_handlers(chain):
+    """ Combine several handlers for one command into one; the first (built-in) handler's result is returned. """
+    def handler(cache, source, message):
+        result = chain[0](cache, source, message)
+        for extra in chain[1:]:
+            extra(cache, source, message)
+        return result
+    return handler
+
+
+class HandlerRegistry(object):
+    """ Maps server commands (names like "PRIVMSG" or "RPL_WHOREPLY", or ints for numerics without a name) to their handlers, for one Cache class.
+
+    It is built once per class from the class's handle_server_<COMMAND> methods. Handlers are plain functions called
+    as handler(cache, source, message); extensions add theirs with Cache.register_server_handler.
+    """
+    def __init__(self, cls):
+        self.chains = {}  # key is command, value is a list of handlers, built-in one first
+        for name in dir(cls):
+            command = name[len(HANDLER_PREFIX):]
+            if name.startswith(HANDLER_PREFIX) and command.isupper():
+                self.chains[command] = [getattr(cls, name).im_func]
+        self.compile()
+
+    def register(self, command, handler):
+        self.chains.setdefault(command, []).append(handler)
+        self.compile()
+
+    def compile(self):
+        self.handlers = {}
+        for command, chain in self.chains.items():
+            self.handlers[command] = len(chain) == 1 and chain[0] or chain_handlers(chain)
+        # PRIVMSG and NOTICE are the bulk of all traffic; as long as they share one handler it is called directly
+        privmsg = self.handlers.get("PRIVMSG")
+        self.message_handler = privmsg is self.handlers.get("NOTICE") and privmsg or None
 
 
 class Cache(object):
+    @classmethod
+    def get_registry(cls):
+        if "_registry" not in cls.__dict__:
+            cls._registry = HandlerRegistry(cls)
+        return cls._registry
+
+    @classmethod
+    def register_server_handler(cls, command, handler):
+        """ Have handler(cache, source, message) called for every server message with this command, after any handler already registered for it. """
+        cls.get_registry().register(command, handler)
+
     def __init__(self, user):
+        self.registry = self.get_registry()
         self.user = user
         self.server = None
         self.welcome = []
@@ -264,52 +700,134 @@ class Cache(object):
         self.queries = {}
         self.nick = None
         self.host = None
+        self.serverprefix = None
+        self.members = {}  # key is casefolded nick, for everyone in any of our channels
+        self.set_casemapping(DEFAULT_CASEMAPPING)
         # dictionary keyed on client resource, which lists when each resource was last known to be alive.
-        self.last_seen = defaultdict(lambda: datetime.fromordinal(1))
+        self.last_seen = defaultdict(lambda: NEVER)
+        # per resource, the sequence number of the last message it is known to have received in each buffer
+        self.cursors = {}
         self.shells = {}  # key is resource
-        self.logger = {}  # 'configured' loggers; key is channel name
-        self.temp_logger = {}  # 'temporary' loggers, created for unconfigured channels and privmsg; deleted after inactivity; key is channel/user name
-        self.default_logger = None  # logger base class for newly joined channels and privmsgs
+        self.restored_buffers = None  # (channels, queries) from a snapshot, waiting for the network config
 
     def set_server(self, server):
         self.server = server
         self.server.cache = self
         self.nick = self.server.config.nick
-
-    def add_logger(self, channel, logger):
-        if channel == None:
-            self.default_logger = logger
-        else:
-            self.logger[channel] = logger
-
-    def get_logger(self, name):
-        if name in self.logger.items():
-            if self.logger[name] == None:
-                return DummyLogger()
-            return self.logger[name]
-
-        # this is never None: all temp_loggers are based on default_logger and only created when default_logger != None
-        if name in self.temp_logger.items():
-            return self.temp_logger[name]
-
-        if self.default_logger == None:
-            return DummyLogger()
-
-        self.temp_logger[name] = self.default_logger.clone()
-        self.temp_logger[name].name = name
-        return self.temp_logger[name]
+        if self.restored_buffers:
+            channels, queries = self.restored_buffers
+            self.restored_buffers = None
+            for state in channels:
+                self.channels[state["name"]] = ChannelBuffer(state["name"], self, self.channel_config(state["name"]))
+                self.channels[state["name"]].restore(state)
+            for state in queries:
+                self.queries[state["name"]] = QueryBuffer(state["name"], self, self.server.config)
+                self.queries[state["name"]].restore(state)
+
+    def snapshot(self):
+        """ Return the cache's state as plain data (but for buffer messages, see MessageBuffer.snapshot) for snapshot.py. """
+        return {
+            "host": self.host,
+            "serverprefix": self.serverprefix,
+            "casemapping": self.casemapping,
+            "welcome": list(self.welcome),
+            "motd": list(self.motd),
+            "mode": self.mode,
+            "last_seen": dict((resource, backlog.to_timestamp(stamp)) for resource, stamp in self.last_seen.items()),
+            "cursors": dict((resource, dict(cursors)) for resource, cursors in self.cursors.items()),
+            "members": [(m.nick, m.user, m.host, m.server, m.hops, m.realname, m.away, m.ircoper) for m in self.members.values()],
+            "channels": [channel.snapshot() for channel in self.channels.values()],
+            "queries": [query.snapshot() for query in self.queries.values()],
+        }
+
+    def restore(self, state):
+        """ Take over the state of a snapshot. Buffers are only recreated once set_server provides the network config. """
+        self.set_casemapping(state["casemapping"])
+        self.host = state["host"]
+        self.serverprefix = state["serverprefix"]
+        self.welcome = state["welcome"]
+        self.motd = state["motd"]
+        self.mode = state["mode"]
+        for resource, timestamp in state["last_seen"].items():
+            self.last_seen[resource] = timestamp and datetime.fromtimestamp(timestamp) or NEVER
+        self.cursors = state["cursors"]
+        for nick, user, host, server, hops, realname, away, ircoper in state["members"]:
+            member = self.members[self.fold(nick)] = ChannelMember(nick)
+            member.user, member.host, member.server = intern(user), intern(host), intern(server)
+            member.hops, member.realname, member.away, member.ircoper = hops, realname, away, ircoper
+        self.restored_buffers = (state["channels"], state["queries"])
+
+    def channel_config(self, name):
+        return self.server.config.get_child("name", name) or self.server.config
+
+    def set_casemapping(self, name):
+        table = CASEMAPPINGS.get(name.lower())
+        if table is None:
+            log.warning("unknown CASEMAPPING %s, keeping %s", name, getattr(self, "casemapping", DEFAULT_CASEMAPPING))
+            return
+        self.casemapping = name.lower()
+        self.casemap_table = table
+        # anything keyed under the old casemapping has to be re-keyed
+        old = self.members
+        self.members = dict((self.fold(member.nick), member) for member in old.values())
+        for channel in self.channels.values():
+            channel.members = dict((self.fold(old[key].nick), mode) for key, mode in channel.members.items() if key in old)
+            channel.invalidate()
+
+    def fold(self, name):
+        """ Return the key nick or name is stored under, according to the network's CASEMAPPING. """
+        return name.translate(self.casemap_table)
+
+    def add_member(self, channel, nick, mode=None):
+        """ Record nick as being in channel, with mode as its mode prefix there (or keeping the one it has if None), and return its ChannelMember. """
+        key = self.fold(nick)
+        member = self.members.get(key)
+        if member is None:
+            member = self.members[key] = ChannelMember(nick)
+        member.channels.add(channel)
+        if mode is not None or key not in channel.members:
+            channel.members[key] = mode or ""
+            channel.member_changed(key)
+        return member
+
+    def member_updated(self, member):
+        """ Forget what was rendered for member in all of its channels, after its user, host or WHO details changed. """
+        key = self.fold(member.nick)
+        for channel in member.channels:
+            channel.member_changed(key)
+
+    def remove_member(self, channel, key):
+        channel.members.pop(key, None)
+        channel.member_changed(key)
+        member = self.members.get(key)
+        if member:
+            member.channels.discard(channel)
+            if not member.channels:
+                del self.members[key]
 
     def dispatch_server_message(self, source, message):
-        prefix, code, args = parse_message(message)
-        handler = getattr(self, 'handle_server_%s' % code, None)
-        if handler:
-            return handler(source, message, prefix, code, args)
-        print "CACHE UNABLE TO DISPATCH UNKNOWN MESSAGE CODE: %s" % message
+        command = message.command
+        registry = self.registry
+        if not handler_timing:
+            if registry.message_handler and (command == "PRIVMSG" or command == "NOTICE"):
+                return registry.message_handler(self, source, message)
+            handler = registry.handlers.get(command)
+            if handler:
+                return handler(self, source, message)
+        else:
+            handler = registry.handlers.get(command)
+            if handler:
+                started = time.time()
+                try:
+                    return handler(self, source, message)
+                finally:
+                    handler_calls.inc((command,))
+                    handler_seconds.inc((command,), time.time() - started)
+        log.debug("unable to dispatch unknown message code: %s", message.raw)
         return None
 
     def process_server_message(self, server, message):
         """ Called with each message from the server server. The message should be parsed, analyzed and possibly added to the cache's data-stores."""
-        #print "CACHE RECEIVED: %s" % message
         try:
             self.dispatch_server_message(server, message)
         except Exception:
@@ -317,34 +835,67 @@ class Cache(object):
             import traceback
             exc_type, exc_value, exc_traceback = sys.exc_info()
             notice = ""
-            lines = ["Exception occured while processing server message: %s" % (message)] + traceback.format_exception(exc_type, exc_value, exc_traceback)
+            lines = ["Exception occured while processing server message: %s" % (message.raw)] + traceback.format_exception(exc_type, exc_value, exc_traceback)
             for line in lines:
                 notice += ":thud!cache@th.ud NOTICE %s :%s\n" % (self.nick, line.strip())
-            # send out the message to any attached clients for this user.
-            # TODO: this probably needs to be limited to clients of this server
-            # only.
+            # send out the message to any attached clients of this server.
             # TODO: we should really push all exceptions onto some kind of
             # ExceptionBuffer so that they can be retrieved even if they happen
             # before any client connections
-            for client in self.user.clients.values():
+            for client in self.user.get_network_clients(self.server.config.ref):
                 client.sendLine(notice)
-            print "\n\n\n\nEXCEPTION!!!"
-            print notice
-            print "\n\n\n\n"
+            log.error("exception while processing server message: %s", message.raw, exc_info=(exc_type, exc_value, exc_traceback))
 
     def update_last_seen(self, client):
-        print "[*] UPDATE LAST_SEEN FOR %s" % client.resource
+        if client.outbound.gap or client.replay.active:
+            # the client is missing messages; keep its cursors where they are until they've been replayed
+            return
+        log.log(TRACE, "update last_seen for %s", client.resource)
         self.last_seen[client.resource] = datetime.now()
+        cursors = self.cursors.setdefault(client.resource, {})
+        for buf in self.channels.values():
+            cursors[buf.name] = buf.last_seq
+        for buf in self.queries.values():
+            cursors[buf.name] = buf.last_seq
+
+    def get_cursor(self, resource, name):
+        """ Return the replay cursor of resource in buffer name; None if the resource has never been seen at all. """
+        if resource not in self.cursors:
+            return None
+        # a buffer that didn't exist yet when the resource was last seen is entirely new to it
+        return self.cursors[resource].get(name, 0)
+
+    def mark_delivered(self, client):
+        """ Remember the last message of every buffer when the outbound queue of client starts to fill up. Live lines
+        go out before the cache stores them, so everything up to there has reached the client's transport, and a gap
+        replay after an overflow can start from there rather than from the cursors, which only move when the
+        client says something. """
+        if client.replay.active:
+            # live lines are held back during a replay, so what the replay got out is what the client has
+            client.delivered = dict(client.replay.replayed)
+        else:
+            client.delivered = dict((buf.name, buf.last_seq) for buf in self.channels.values() + self.queries.values())
+
+    def replay_gap(self, client):
+        """ Replay every buffer to a client that had messages dropped because it couldn't keep up. """
+        delivered, client.delivered = client.delivered, None
+        if delivered and client.resource in self.cursors:
+            cursors = self.cursors[client.resource]
+            for name, seq in delivered.items():
+                cursors[name] = max(cursors.get(name, 0), seq)
+        client.sendLine(":thud!cache@th.ud NOTICE %s :Your connection fell behind and %d lines were dropped. Replaying everything since the last line that reached you." % (self.nick, client.outbound.gap_lines))
+        for buf in self.channels.values() + self.queries.values():
+            buf.replay_to(client)
+        client.replay.add_call(self.update_last_seen, client)
 
     def handle_client_message(self, client, message):
         """ Called with each message from the client. The message should be parsed and if the cache can handle the message it should send any responses necessary and return true. If the cache can't handle the message, return false."""
         handled = False
-        prefix, code, args = parse_message(message)
+        code, args = message.command, message.params
         last_seen = self.last_seen[client.resource]
         update_last_seen = True
         if code == "USER":
-            print "REGISTERING CLIENT: %s" % (message)
-            print "RESOURCE (%s) LAST SEEN AT %s" % (client.resource, last_seen)
+            log.info("registering client %s, last seen at %s", client.resource, last_seen)
             if self.welcome:
                 client.sendLine("\n".join(self.welcome))
             if self.motd:
@@ -352,29 +903,38 @@ class Cache(object):
             if self.mode:
                 client.sendLine(self.mode)
             for channel in self.channels.values():
-                print "FORCING CLIENT JOIN TO CHANNEL %s" % channel.name
+                log.debug("forcing client join to channel %s", channel.name)
                 channel.rejoin(client, last_seen)
             for query in self.queries.values():
-                print "FORCING CLIENT JOIN TO QUERY %s" % query.nick
+                log.debug("forcing client join to query %s", query.nick)
                 query.rejoin(client, last_seen)
+            # cursors only move on once the whole replay has made it out
+            client.replay.add_call(self.update_last_seen, client)
             handled = True
         elif code in ["QUIT"]:
             # just update last_seen
             handled = True
         elif code in ["PRIVMSG", "NOTICE"]:
+            # buffered with the prefix we have now, so it stays ours (in replays, on disk and in the search index)
+            # after a nick change
+            prefix = make_prefix(self.nick, self.host)
+            if message.tags is None:
+                message_with_prefix = parse_line("%s %s" % (prefix, message.raw))
+            else:
+                tags, sep, rest = message.raw.partition(" ")
+                message_with_prefix = parse_line("%s %s %s" % (tags, prefix, rest))
             if args[0] in self.channels:
-                self.channels[args[0]].add_message(message)
+                self.channels[args[0]].add_message(message_with_prefix)
             else:
                 nick = args[0]
                 if not nick in self.queries:
-                    self.queries[nick] = QueryBuffer(nick, self.server.config)
-                print "QUERY SEND [%s] %s" % (nick, message)
-                self.queries[nick].add_message(message)
+                    self.queries[nick] = QueryBuffer(nick, self, self.server.config)
+                log.log(TRACE, "QUERY SEND [%s] %s", nick, message.raw)
+                self.queries[nick].add_message(message_with_prefix)
             # make sure all other connected clients see this message
-            message_with_prefix = "%s %s" % (make_prefix(self.nick, self.host), message)
-            for c in self.user.clients.values():
+            for c in self.user.get_network_clients(self.server.config.ref):
                 if c != client:
-                    c.sendLine(message_with_prefix)
+                    c.sendLine(message_with_prefix.raw)
         elif code == "PONG":
             pass
         elif code == "NICK":
@@ -383,15 +943,17 @@ class Cache(object):
         elif code == "THUD":
             if not client.resource in self.shells:
                 self.shells[client.resource] = thudshell.ThudShell(self, client)
+            # the resource may have reattached on a new connection since
+            self.shells[client.resource].client = client
             self.shells[client.resource].handle(args)
             handled = True
         elif code == "JOIN":
             chans = args[0].split(", ")
-            print "GOT JOIN MESSAGE FOR %s" % chans
+            log.debug("client JOIN for %s", chans)
             handled = True
             for chan in chans:
                 if not chan in self.channels:
-                    print "CACHE INGORING CLIENT JOIN TO UNJOINED CHANNEL: %s " % chan
+                    log.debug("ignoring client join to unjoined channel %s", chan)
                     handled = False
                     continue
                 channel = self.channels[chan]
@@ -403,116 +965,152 @@ class Cache(object):
         elif code == "WHO" and args[0] in self.channels:
             channel = self.channels[args[0]]
             if channel.has_who:
-                client.sendLine("\n".join(channel.get_who()))
+                client.sendLine(channel.get_who())
                 handled = True
         else:
-            print "CACHE IGNORING CLIENT MESSAGE %s:%s" % (code, args)
+            log.log(TRACE, "ignoring client message %s:%s", code, args)
         if update_last_seen:
             self.update_last_seen(client)
         return handled
 
     # WELCOME
-    def handle_server_RPL_WELCOME(self, source, message, prefix, code, args):
+    def handle_server_RPL_WELCOME(self, source, message):
         self.welcome = []
-        self.welcome.append(message)
-        self.serverprefix = prefix
+        self.welcome.append(message.raw)
+        self.serverprefix = message.prefix
+        self.user.server_registered(self.server)
 
-    def handle_server_welcome_messages(self, source, message, prefix, code, args):
-        self.welcome.append(message)
+    def handle_server_welcome_messages(self, source, message):
+        self.welcome.append(message.raw)
     handle_server_RPL_YOURHOST = handle_server_welcome_messages
     handle_server_RPL_CREATED = handle_server_welcome_messages
     handle_server_RPL_MYINFO = handle_server_welcome_messages
-    handle_server_RPL_ISUPPORT = handle_server_welcome_messages
+
+    def handle_server_RPL_ISUPPORT(self, source, message):
+        self.welcome.append(message.raw)
+        for token in message.params[1:-1]:
+            if token.upper().startswith("CASEMAPPING="):
+                self.set_casemapping(token.partition("=")[2])
 
     # MOTD
-    def handle_server_RPL_MOTDSTART(self, source, message, prefix, code, args):
+    def handle_server_RPL_MOTDSTART(self, source, message):
         self.motd = []
-        self.motd.append(message)
+        self.motd.append(message.raw)
+
+    def handle_server_RPL_MOTD(self, source, message):
+        self.motd.append(message.raw)
 
-    def handle_server_RPL_MOTD(self, source, message, prefix, code, args):
-        self.motd.append(message)
+    def handle_server_RPL_ENDOFMOTD(self, source, message):
+        self.motd.append(message.raw)
+        self.user.server_ready(self.server)
 
-    def handle_server_RPL_ENDOFMOTD(self, source, message, prefix, code, args):
-        self.motd.append(message)
+    def handle_server_ERR_NOMOTD(self, source, message):
+        self.user.server_ready(self.server)
 
-    def handle_server_MODE(self, source, message, prefix, code, args):
-        if args[0] == self.nick:
-            self.mode = message
+    def handle_server_MODE(self, source, message):
+        if message.params[0] == self.nick:
+            self.mode = message.raw
         else:
-            self.channels[args[0]].add_mode(source, message, prefix, code, args)
+            self.channels[message.params[0]].add_mode(source, message)
 
     # CHANNEL JOIN
-    def handle_server_JOIN(self, source, message, prefix, code, args):
-        print "SERVER JOIN: %s" % message
-        name = args[0]
+    def handle_server_JOIN(self, source, message):
+        log.log(TRACE, "SERVER JOIN: %s", message.raw)
+        name = message.params[0]
         if name not in self.channels:
-            config = self.server.config.by_path("channels/name=%s" % name)
-            if not config:
-                config = self.server.config
-            self.channels[name] = ChannelBuffer(name, self, config)
-        self.host = host_from_prefix(prefix)
-        self.channels[name].add_join(source, message, prefix, code, args)
-
-    def handle_server_PART(self, source, message, prefix, code, args):
-        name = args[0]
-        self.channels[name].add_part(source, message, prefix, code, args)
-
-    def handle_server_RPL_NAMREPLY(self, source, message, prefix, code, args):
+            self.channels[name] = ChannelBuffer(name, self, self.channel_config(name))
+        if self.fold(message.nick) == self.fold(self.nick):
+            self.host = host_from_prefix(message.prefix)
+        self.channels[name].add_join(source, message)
+
+    def handle_server_PART(self, source, message):
+        name = message.params[0]
+        self.channels[name].add_part(source, message)
+
+    def handle_server_RPL_NAMREPLY(self, source, message):
+        args = message.params
         name = args[1] in ["=", "*", "@"] and args[2] or args[1]
-        self.channels[name].add_names(source, message, prefix, code, args)
+        self.channels[name].add_names(source, message)
 
-    def handle_server_RPL_ENDOFNAMES(self, source, message, prefix, code, args):
-        self.channels[args[1]].add_names(source, message, prefix, code, args)
+    def handle_server_RPL_ENDOFNAMES(self, source, message):
+        self.channels[message.params[1]].add_names(source, message)
 
-    def handle_server_TOPIC(self, source, message, prefix, code, args):
-        self.channels[args[0]].set_topic(message, prefix, code, args)
+    def handle_server_TOPIC(self, source, message):
+        self.channels[message.params[0]].set_topic(source, message)
 
     # CHANNEL MODE
-    def handle_server_RPL_CHANNELMODEIS(self, source, message, prefix, code, args):
-        print "CACHEING CHANNEL MODE: %s" % message
-        self.channels[args[1]].add_channel_mode(source, message, prefix, code, args)
+    def handle_server_RPL_CHANNELMODEIS(self, source, message):
+        log.log(TRACE, "caching channel mode: %s", message.raw)
+        self.channels[message.params[1]].add_channel_mode(source, message)
 
-    def handle_server_RPL_CREATIONTIME(self, source, message, prefix, code, args):
-        self.channels[args[1]].add_channel_mode(source, message, prefix, code, args)
+    def handle_server_RPL_CREATIONTIME(self, source, message):
+        self.channels[message.params[1]].add_channel_mode(source, message)
 
     # CHANNEL WHO
-    def handle_server_RPL_WHOREPLY(self, source, message, prefix, code, args):
-        if code == 'RPL_ENDOFWHO' and args[1] not in self.channels:
+    def handle_server_RPL_WHOREPLY(self, source, message):
+        args = message.params
+        if message.command == 'RPL_ENDOFWHO' and args[1] not in self.channels:
             return  # this looks like an ENDOFWHO for a nick-targeted WHO request
         if args[1] == "*":
-            for channel in self.channels:
-                if args[5] in channel.members:
-                    channel.add_who(source, message, prefix, code, args)
+            member = self.members.get(self.fold(args[5]))
+            for channel in member and list(member.channels) or ():
+                channel.add_who(source, message)
         else:
-            self.channels[args[1]].add_who(source, message, prefix, code, args)
+            self.channels[args[1]].add_who(source, message)
 
     handle_server_RPL_ENDOFWHO = handle_server_RPL_WHOREPLY
 
     # PING
-    def handle_server_PING(self, source, message, prefix, code, args):
-        source.sendLine("PONG %s" % args[0])
+    def handle_server_PING(self, source, message):
+        source.sendLine("PONG %s" % (message.params and message.params[0] or ""), sendqueue.PRIORITY_URGENT)
 
     # NICK
-    def handle_server_NICK(self, source, message, prefix, code, args):
-        print "SERVER NICK: %s" % message
-        old = nick_from_prefix(prefix)
-        new = args[0]
-        if old == self.nick:
+    def handle_server_NICK(self, source, message):
+        log.log(TRACE, "SERVER NICK: %s", message.raw)
+        old = message.nick
+        new = message.params[0]
+        if self.fold(old) == self.fold(self.nick):
             self.nick = new
-        for channel in self.channels.values():
-            channel.update_nick(old, new)
+        member = self.members.pop(self.fold(old), None)
+        if not member:
+            return
+        # only the channels the nick is actually in are touched
+        key, member.nick = self.fold(new), new
+        self.members[key] = member
+        now = datetime.now()
+        for channel in member.channels:
+            channel.members[key] = channel.members.pop(self.fold(old))
+            channel.member_changed(self.fold(old))
+            channel.member_changed(key)
+            channel.log_message(now, message)
+
+    def handle_server_QUIT(self, source, message):
+        key = self.fold(message.nick)
+        member = self.members.get(key)
+        if not member:
+            return
+        now = datetime.now()
+        for channel in list(member.channels):
+            channel.log_message(now, message)
+            self.remove_member(channel, key)
+
+    def handle_server_KICK(self, source, message):
+        name = message.params[0]
+        if name in self.channels:
+            self.channels[name].log_message(datetime.now(), message)
+            self.channels[name].remove(message.params[1])
 
     # PRIVMSG
-    def handle_server_PRIVMSG(self, source, message, prefix, code, args):
-        if args[0] in self.channels:
-            self.channels[args[0]].add_message(message)
+    def handle_server_PRIVMSG(self, source, message):
+        target = message.params[0]
+        if target in self.channels:
+            self.channels[target].add_message(message)
         else:
-            nick = prefix[1:].partition("!")[0]
+            nick = message.nick
             if not nick in self.queries:
-                self.queries[nick] = QueryBuffer(nick, self.server.config)
-            print "QUERY RCV [%s] %s" % (nick, message)
+                self.queries[nick] = QueryBuffer(nick, self, self.server.config)
+            log.log(TRACE, "QUERY RCV [%s] %s", nick, message.raw)
             self.queries[nick].add_message(message)
-        #self.get_logger(args[0]).log_priovmsg(timestamp, prefix, args[1])
     handle_server_NOTICE = handle_server_PRIVMSG
 
 # Numeric response codes
@@ -662,6 +1260,9 @@ numeric_codes = {
     'ERR_USERSDONTMATCH'  : 502,
 }
 numeric_codes_reverse = {v: k for k, v in numeric_codes.items()}
+# keyed on the numeric as it appears on the wire, so parse_line can skip the int() conversion
+numeric_names = {"%03d" % v: k for k, v in numeric_codes.items()}
+tag_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
 # merge into module:
 globals().update(numeric_codes)
 
@@ -0,0 +1,144 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Metrics, exposed over HTTP in the Prometheus text format.
+
+Two kinds of metrics exist. Event metrics (Counter, Histogram) are updated as things happen and should only be used
+where an event has no natural home on a long-lived object. Everything else - line counts, queue depths, cache sizes -
+is already counted on the objects involved, and is read off them by collector functions only when the endpoint is
+scraped, so keeping metrics enabled costs the hot paths nothing beyond the integer increments they already do.
+"""
+import bisect
+
+from twisted.internet import reactor
+from twisted.web.server import Site
+from twisted.web.resource import Resource
+
+import thudlog
+
+log = thudlog.getLogger("metrics")
+
+DEFAULT_PORT = 9105
+DEFAULT_INTERFACE = "127.0.0.1"
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+class Family(object):
+    """ One metric (name, type, help) and its samples, ready to be rendered. """
+    def __init__(self, name, kind, help, labels=()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = labels
+        self.samples = []  # (suffix, label values, extra labels, value) tuples
+
+    def add(self, labelvalues, value, suffix="", extra=()):
+        self.samples.append((suffix, labelvalues, extra, value))
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for suffix, labelvalues, extra, value in self.samples:
+            pairs = zip(self.labels, labelvalues) + list(extra)
+            labels = ",".join("%s=\"%s\"" % (k, escape(v)) for k, v in pairs)
+            lines.append("%s%s%s %s" % (self.name, suffix, labels and "{%s}" % labels or "", value))
+        return "\n".join(lines)
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # key is a tuple of label values
+
+    def inc(self, labelvalues=(), amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def collect(self):
+        family = Family(self.name, "counter", self.help, self.labels)
+        for labelvalues, value in sorted(self.values.items()):
+            family.add(labelvalues, value)
+        return [family]
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = sorted(buckets)
+        self.values = {}  # key is a tuple of label values, value is [per-bucket counts (+Inf last), sum]
+
+    def observe(self, labelvalues, value):
+        entry = self.values.get(labelvalues)
+        if entry is None:
+            entry = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def collect(self):
+        family = Family(self.name, "histogram", self.help, self.labels)
+        for labelvalues, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                family.add(labelvalues, cumulative, "_bucket", (("le", bound),))
+            family.add(labelvalues, total, "_sum")
+            family.add(labelvalues, cumulative, "_count")
+        return [family]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """ collector is called on every scrape and returns a list of Family instances. """
+        self.collectors.append(collector)
+
+    def render(self):
+        families = []
+        for metric in self.metrics:
+            families.extend(metric.collect())
+        for collector in self.collectors:
+            try:
+                families.extend(collector())
+            except Exception:
+                log.error("metrics collector %r failed", collector, exc_info=True)
+        return "\n".join(family.render() for family in families) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, help, labels=()):
+    return registry.register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), **kwargs):
+    return registry.register(Histogram(name, help, labels, **kwargs))
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", CONTENT_TYPE)
+        return registry.render()
+
+
+def listen(config, offset=0):
+    """ Start the HTTP endpoint if metrics_enable is set. offset is added to the port, so worker processes each get their own. """
+    if not config.metrics_enable:
+        return None
+    port = (config.metrics_port or DEFAULT_PORT) + offset
+    interface = config.metrics_interface or DEFAULT_INTERFACE
+    log.info("serving metrics on http://%s:%d/metrics", interface, port)
+    return reactor.listenTCP(port, Site(MetricsResource()), interface=interface)
@@ -0,0 +1,114 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Streaming backlog replay to a client.
+
+Replaying a busy channel can mean tens of thousands of lines. Rather than formatting them all at once and handing
+the client one huge write, each client has a ReplayStream: buffers queue generators that yield the replay a chunk of
+lines at a time, and the stream sends one chunk per reactor iteration, so other users are served in between. It
+only sends while the client's OutboundQueue has nothing waiting, so a slow client slows down its replay instead of
+filling up memory or overflowing into a gap.
+
+Parts are played in the order they were added. A part is either an iterable of chunks (lists of lines) or a
+callable, which is called once everything before it has been sent.
+
+Live lines that arrive for the client while a replay is under way are held back (see hold) and sent once the last
+part is done, so the client never sees them ahead of the history that led up to them. Holding more than the
+client's outbound queue may hold counts as an overflow of that queue; the replay after it starts from as far as this
+one got (see replayed).
+"""
+from collections import deque
+
+from twisted.internet import reactor
+
+import thudlog
+
+log = thudlog.getLogger("replay")
+
+DEFAULT_CHUNK_LINES = 200
+DEFAULT_MAX_LINES = 2000
+
+
+class ReplayStream(object):
+    def __init__(self, client):
+        self.client = client
+        self.parts = deque()
+        self.timer = None
+        self.waiting = False  # for the client's outbound queue to drain
+        self.sent_lines = 0
+        self.held = deque()  # live lines waiting for the replay to finish
+        self.held_bytes = 0
+        self.replayed = {}  # key is buffer name, value is the last sequence number the replay has sent
+
+    @property
+    def active(self):
+        return bool(self.parts)
+
+    def add(self, chunks):
+        """ Queue an iterable of chunks (lists of lines) for sending. """
+        self.parts.append(iter(chunks))
+        self.schedule()
+
+    def add_lines(self, lines):
+        self.add([lines])
+
+    def add_call(self, func, *args):
+        """ Queue func(*args) to be called once everything queued so far has been sent. """
+        self.parts.append(lambda: func(*args))
+        self.schedule()
+
+    def hold(self, line):
+        """ Keep a live line back until everything queued so far has been sent. """
+        self.held.append(line)
+        self.held_bytes += len(line)
+        if self.held_bytes > self.client.outbound.max_bytes:
+            self.client.delivered = dict(self.replayed)
+            self.client.outbound.overflow()
+
+    def schedule(self):
+        if self.timer or self.waiting or not self.parts:
+            return
+        self.timer = reactor.callLater(0, self.run)
+
+    def drained(self):
+        self.waiting = False
+        self.schedule()
+
+    def run(self):
+        self.timer = None
+        outbound = self.client.outbound
+        if outbound.paused or outbound.lines:
+            self.waiting = True
+            outbound.when_drained(self.drained)
+            return
+        while self.parts:
+            part = self.parts[0]
+            if callable(part):
+                self.parts.popleft()
+                part()
+                continue
+            chunk = next(part, None)
+            if chunk is None:
+                self.parts.popleft()
+                continue
+            if chunk:
+                self.sent_lines += len(chunk)
+                self.client.sendLine("\n".join(chunk))
+                break
+        if not self.parts:
+            self.replayed.clear()
+            if self.held:
+                held, self.held = self.held, deque()
+                self.held_bytes = 0
+                self.client.sendLine("\n".join(held))
+        self.schedule()
+
+    def stop(self):
+        """ Drop everything still queued and held, e.g. because the client overflowed and gets a fresh replay anyway. """
+        if self.parts:
+            log.debug("dropping %d queued replay parts and %d held lines for %s", len(self.parts), len(self.held), self.client.resource)
+        self.parts.clear()
+        self.held.clear()
+        self.held_bytes = 0
+        self.replayed.clear()
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
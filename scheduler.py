@@ -0,0 +1,152 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Pacing of the queries thud sends upstream on its own behalf.
+
+On connect thud has to JOIN every configured channel and fetch its MODE and WHO, and every time someone joins a
+channel it wants a WHO for them. Sent as fast as they are generated, that gets a user with a hundred channels - or
+anyone in a busy channel during a netsplit rejoin - killed for excess flood. A QueryScheduler sits between the cache
+and a server connection instead:
+
+    JOINs are batched into comma-separated JOIN lines, as long as the line length limit allows
+    MODE and WHO queries are queued and deduplicated
+    WHOs for single nicks are dropped once a WHO for their whole channel is pending, and once enough of them are
+        waiting for the same channel they are replaced by one WHO for the channel; servers that accept several
+        targets per WHO can have them combined (who_targets)
+
+Queries stay here until the connection's SendQueue has room for background traffic (see sendqueue), and are then
+handed out one line at a time, JOINs first, then MODEs, then WHOs.
+"""
+from collections import OrderedDict
+
+import thudlog
+
+log = thudlog.getLogger("scheduler")
+
+MAX_LINE_LENGTH = 510  # 512 bytes, less the CR LF
+
+DEFAULT_WHO_TARGETS = 1
+DEFAULT_WHO_CHANNEL_THRESHOLD = 5
+
+
+def batch_joins(channels, max_length=MAX_LINE_LENGTH):
+    """ Turn a list of (name, key) pairs into as few JOIN lines as fit in max_length. """
+    # keys are matched to channels by position, so channels with a key have to come first
+    channels = [c for c in channels if c[1]] + [c for c in channels if not c[1]]
+    lines = []
+    names, keys = [], []
+    for name, key in channels:
+        if names and len(join_line(names + [name], key and keys + [key] or keys)) > max_length:
+            lines.append(join_line(names, keys))
+            names, keys = [], []
+        names.append(name)
+        if key:
+            keys.append(key)
+    if names:
+        lines.append(join_line(names, keys))
+    return lines
+
+
+def join_line(names, keys):
+    if keys:
+        return "JOIN %s %s" % (",".join(names), ",".join(keys))
+    return "JOIN %s" % ",".join(names)
+
+
+class QueryScheduler(object):
+    def __init__(self, who_targets=DEFAULT_WHO_TARGETS, who_channel_threshold=DEFAULT_WHO_CHANNEL_THRESHOLD):
+        self.wakeup = None  # called when there is something new to send, set by SendQueue.attach_scheduler
+        self.who_targets = who_targets
+        self.who_channel_threshold = who_channel_threshold
+        self.joins = []  # ready to send JOIN lines
+        self.modes = OrderedDict()  # key is target, used as an ordered set
+        self.channel_whos = OrderedDict()  # key is channel, used as an ordered set
+        self.nick_whos = OrderedDict()  # key is nick, value is the channel it was wanted for (or None)
+        self.channel_nicks = {}  # key is channel, value is the set of nicks in nick_whos wanted for it
+        self.crowded = OrderedDict()  # channels with who_channel_threshold nick WHOs waiting, used as an ordered set
+        self.sent = 0
+        self.skipped = 0  # queries dropped as duplicates or made redundant
+
+    def join(self, channels):
+        """ Queue JOINs for a list of (name, key) pairs. """
+        self.joins.extend(batch_joins(channels))
+        self.schedule()
+
+    def mode(self, target):
+        if target in self.modes:
+            self.skipped += 1
+            return
+        self.modes[target] = True
+        self.schedule()
+
+    def who(self, target, channel=None):
+        """ Queue a WHO for a channel, or for a nick seen in channel. """
+        if target[:1] in "#&+!":
+            if target in self.channel_whos:
+                self.skipped += 1
+                return
+            self.channel_whos[target] = True
+            # the channel WHO answers for everyone in it
+            self.skipped += len(self.drop_channel_nicks(target))
+        elif target in self.nick_whos or channel in self.channel_whos:
+            self.skipped += 1
+            return
+        else:
+            self.nick_whos[target] = channel
+            if channel:
+                nicks = self.channel_nicks.setdefault(channel, set())
+                nicks.add(target)
+                if len(nicks) >= self.who_channel_threshold:
+                    self.crowded[channel] = True
+        self.schedule()
+
+    def drop_channel_nicks(self, channel):
+        """ Forget the nick WHOs waiting for channel, returning their nicks. """
+        self.crowded.pop(channel, None)
+        nicks = self.channel_nicks.pop(channel, ())
+        for nick in nicks:
+            del self.nick_whos[nick]
+        return nicks
+
+    def pending(self):
+        return len(self.joins) + len(self.modes) + len(self.channel_whos) + len(self.nick_whos)
+
+    def schedule(self):
+        if self.wakeup:
+            self.wakeup()
+
+    def next_line(self):
+        line = self._next_line()
+        if line:
+            self.sent += 1
+        return line
+
+    def _next_line(self):
+        if self.joins:
+            return self.joins.pop(0)
+        if self.modes:
+            return "MODE %s" % self.modes.popitem(last=False)[0]
+        if self.channel_whos:
+            return "WHO %s" % self.channel_whos.popitem(last=False)[0]
+        if self.nick_whos:
+            return self.next_nick_who()
+        return None
+
+    def next_nick_who(self):
+        # a netsplit rejoin floods a channel with joins; one WHO for the channel beats a WHO per nick
+        if self.crowded:
+            channel = next(iter(self.crowded))
+            count = len(self.drop_channel_nicks(channel))
+            log.debug("coalescing %d WHOs into WHO %s", count, channel)
+            self.skipped += count - 1
+            return "WHO %s" % channel
+        nicks = []
+        while self.nick_whos and len(nicks) < self.who_targets:
+            nick = next(iter(self.nick_whos))
+            if nicks and len("WHO ") + len(",".join(nicks + [nick])) > MAX_LINE_LENGTH:
+                break
+            nicks.append(nick)
+            channel = self.nick_whos.pop(nick)
+            if channel:
+                self.channel_nicks[channel].discard(nick)
+                if not self.channel_nicks[channel]:
+                    del self.channel_nicks[channel]
+        return "WHO %s" % ",".join(nicks)
@@ -0,0 +1,199 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Full-text search over the in-memory backlogs, for THUD search.
+
+With search_index enabled every channel and query buffer keeps a BufferIndex next to its deque: for each word, and
+for each nick, the sequence numbers of the messages containing it. Entries are added as messages come in and
+removed as the deque drops them, so the index only ever covers what is in memory (the on-disk backlog isn't
+searched).
+
+A posting list is a plain list whose first item counts the entries at its head that have already been evicted;
+those are only cut off once they make up half the list. That keeps eviction cheap for common words, and a word
+seen once costs a short list rather than a deque.
+
+Matches are ranked by the summed inverse document frequency of the query words they contain, so messages with
+more, and rarer, words of the query come first; ties go to the newest.
+"""
+import re
+import math
+import heapq
+import string
+from datetime import datetime, timedelta
+
+# words are runs of anything but whitespace, control characters and ASCII punctuation, which this table turns into
+# spaces while lower casing the rest; bytes of UTF-8 encoded characters count as letters
+SEPARATORS = "".join(chr(c) for c in range(0x20)) + string.punctuation + "\x7f"
+WORD_TABLE = string.maketrans(SEPARATORS + string.ascii_uppercase, " " * len(SEPARATORS) + string.ascii_lowercase)
+MAX_WORDS = 64  # distinct words indexed per message
+RELATIVE_TIME = re.compile(r"^([0-9]+)([smhd])$")
+TIME_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+
+
+class QueryError(Exception):
+    pass
+
+
+def tokenize(text):
+    words = text.translate(WORD_TABLE).split()
+    if len(words) > MAX_WORDS:
+        del words[MAX_WORDS:]
+    return set(words)
+
+
+def add_posting(index, key, seq):
+    postings = index.get(key)
+    if postings is None:
+        index[key] = [0, seq]
+    else:
+        postings.append(seq)
+
+
+def remove_posting(index, key, seq):
+    """ Evict seq, and anything older still left, from the head of the posting list of key. """
+    postings = index.get(key)
+    if postings is None:
+        return
+    head = postings[0] + 1
+    if len(postings) > head * 2 + 1 and postings[head] == seq:
+        postings[0] = head  # the usual case: just the oldest entry goes, and no compaction is due
+        return
+    while head < len(postings) and postings[head] <= seq:
+        head += 1
+    if head == len(postings):
+        del index[key]
+    elif head * 2 > len(postings):
+        del postings[1:head]
+        postings[0] = 0
+    else:
+        postings[0] = head - 1
+
+
+def live_postings(index, key, first_seq):
+    postings = index.get(key)
+    if not postings:
+        return []
+    return [seq for seq in postings[postings[0] + 1:] if seq >= first_seq]
+
+
+class BufferIndex(object):
+    def __init__(self):
+        self.words = {}  # key is a word, value is a posting list (see above) of sequence numbers
+        self.nicks = {}  # key is a folded nick, value is a posting list
+
+    def add(self, seq, nick, text):
+        words = self.words
+        for word in tokenize(text):
+            postings = words.get(word)
+            if postings is None:
+                words[word] = [0, seq]
+            else:
+                postings.append(seq)
+        add_posting(self.nicks, nick, seq)
+
+    def remove(self, seq, nick, text):
+        words = self.words
+        for word in tokenize(text):
+            postings = words.get(word)
+            head = postings and postings[0] + 1
+            if postings and len(postings) > head * 2 + 1 and postings[head] == seq:
+                postings[0] = head  # inlined fast path of remove_posting
+            else:
+                remove_posting(words, word, seq)
+        remove_posting(self.nicks, nick, seq)
+
+
+def parse_time(value, now):
+    """ Parse 90m / 2h / 3d (ago), 2024-05-01 or 14:30 (today). """
+    m = RELATIVE_TIME.match(value)
+    if m:
+        return now - timedelta(**{TIME_UNITS[m.group(2)]: int(m.group(1))})
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        pass
+    try:
+        clock = datetime.strptime(value, "%H:%M")
+    except ValueError:
+        raise QueryError("can't make out the time %r, use 90m, 2h, 3d, 14:30 or 2024-05-01" % value)
+    return now.replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0)
+
+
+class Query(object):
+    """ Words to look for, and the from:nick, in:buffer, since:time and until:time filters. """
+    def __init__(self, args, now=None):
+        now = now or datetime.now()
+        self.words = set()
+        self.nick = self.buffer = self.since = self.until = None
+        for arg in args:
+            key, sep, value = arg.partition(":")
+            if sep and value and key.lower() in ("from", "in", "since", "until"):
+                key = key.lower()
+                if key == "from":
+                    self.nick = value
+                elif key == "in":
+                    self.buffer = value
+                else:
+                    setattr(self, key, parse_time(value, now))
+            else:
+                self.words.update(tokenize(arg))
+        if not self.words and not self.nick:
+            raise QueryError("nothing to search for, give some words or from:nick")
+
+
+def seq_bound(buf, stamp, first_seq):
+    """ The sequence number of the first message in buf's deque at or after stamp. """
+    messages = buf.messages
+    low, high = 0, len(messages)
+    while low < high:
+        middle = (low + high) // 2
+        if messages[middle][1] < stamp:
+            low = middle + 1
+        else:
+            high = middle
+    return first_seq + low
+
+
+def search_buffer(buf, query, fold, count):
+    """ Return up to count (score, seq) tuples for the best matches in buf. """
+    index = buf.index
+    if not index or not buf.messages:
+        return []
+    total = len(buf.messages)
+    first_seq = buf.last_seq - total + 1
+    low, high = first_seq, buf.last_seq
+    if query.since:
+        low = seq_bound(buf, query.since, first_seq)
+    if query.until:
+        high = seq_bound(buf, query.until, first_seq) - 1
+    if low > high:
+        return []
+    nick_seqs = None
+    if query.nick:
+        nick_seqs = set(live_postings(index.nicks, fold(query.nick), low))
+        if not nick_seqs:
+            return []
+    if not query.words:
+        return [(0, seq) for seq in heapq.nlargest(count, (seq for seq in nick_seqs if seq <= high))]
+    scores = {}
+    for word in query.words:
+        postings = live_postings(index.words, word, low)
+        if not postings:
+            continue
+        idf = math.log(1 + float(total) / len(postings))
+        for seq in postings:
+            if seq <= high and (nick_seqs is None or seq in nick_seqs):
+                scores[seq] = scores.get(seq, 0) + idf
+    return heapq.nlargest(count, ((score, seq) for seq, score in scores.iteritems()))
+
+
+def search(cache, query, count):
+    """ Return the best count matches over the buffers of cache as (buffer, timestamp, message) tuples, best first. """
+    results = []
+    for buf in cache.channels.values() + cache.queries.values():
+        if query.buffer and cache.fold(buf.name) != cache.fold(query.buffer):
+            continue
+        first_seq = buf.last_seq - len(buf.messages) + 1
+        for score, seq in search_buffer(buf, query, cache.fold, count):
+            seq, stamp, message = buf.messages[seq - first_seq]
+            results.append((score, stamp, buf, message))
+    results = heapq.nlargest(count, results, key=lambda result: result[:2])
+    return [(buf, stamp, message) for score, stamp, buf, message in results]
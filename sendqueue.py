@@ -0,0 +1,110 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Flood-controlled, prioritised sending to a server.
+
+Every line thud sends upstream goes through the SendQueue of its server connection. Lines are written while the
+token bucket (flood_rate lines per second, up to flood_burst at once) has tokens, and otherwise wait in one of
+three queues:
+
+    PRIORITY_URGENT       registration and PONGs; the connection depends on these
+    PRIORITY_INTERACTIVE  whatever a client typed
+    PRIORITY_BACKGROUND   queries thud makes by itself
+
+A QueryScheduler can be attached as an extra, lowest priority source: it is only asked for its next line while
+nothing else is waiting, and only while more than flood_reserve tokens are left, so background queries never eat
+the burst an interactive line would need. Lines stay in the scheduler (where they can still be deduplicated and
+coalesced) until they are actually sent.
+"""
+import time
+from collections import deque
+
+from twisted.internet import reactor
+
+import metrics
+
+PRIORITY_URGENT = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ("urgent", "interactive", "background")
+
+DEFAULT_RATE = 0.5
+DEFAULT_BURST = 5
+DEFAULT_RESERVE = 2
+
+wait_seconds = metrics.histogram("thud_upstream_send_wait_seconds", "Time lines spent in the upstream send queue before being written", ("priority",),
+                                 buckets=(0, .1, .5, 1, 2, 5, 10, 30, 60, 120))
+
+
+class SendQueue(object):
+    def __init__(self, write, rate=DEFAULT_RATE, burst=DEFAULT_BURST, reserve=DEFAULT_RESERVE):
+        self.write = write
+        self.rate = float(rate)
+        self.burst = burst
+        self.reserve = min(reserve, burst - 1)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.queues = [deque() for name in PRIORITY_NAMES]  # (time queued, line) tuples
+        self.scheduler = None
+        self.timer = None
+        self.sent = [0] * len(PRIORITY_NAMES)
+
+    def attach_scheduler(self, scheduler):
+        self.scheduler = scheduler
+        scheduler.wakeup = self.flush
+
+    def send(self, line, priority=PRIORITY_INTERACTIVE):
+        self.queues[priority].append((time.time(), line))
+        self.flush()
+
+    def depth(self, priority):
+        depth = len(self.queues[priority])
+        if priority == PRIORITY_BACKGROUND and self.scheduler:
+            depth += self.scheduler.pending()
+        return depth
+
+    def refill(self, now):
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    def next_line(self):
+        """ Return (priority, time queued, line) for the next line to send, or None. """
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                queued, line = queue.popleft()
+                return priority, queued, line
+        if self.scheduler and self.tokens >= 1 + self.reserve:
+            line = self.scheduler.next_line()
+            if line:
+                return PRIORITY_BACKGROUND, None, line
+        return None
+
+    def flush(self):
+        if self.timer:
+            # rescheduled below; what is waiting now may need a token sooner
+            self.timer.cancel()
+            self.timer = None
+        now = time.time()
+        self.refill(now)
+        while self.tokens >= 1:
+            item = self.next_line()
+            if item is None:
+                break
+            priority, queued, line = item
+            self.tokens -= 1
+            self.sent[priority] += 1
+            wait_seconds.observe((PRIORITY_NAMES[priority],), queued and now - queued or 0)
+            self.write(line)
+        if any(self.queues) or self.scheduler and self.scheduler.pending():
+            # background lines wait for the reserve to fill up again too
+            needed = any(self.queues) and 1 or 1 + self.reserve
+            self.timer = reactor.callLater(max(needed - self.tokens, 0) / self.rate, self._timer_fired)
+
+    def _timer_fired(self):
+        self.timer = None
+        self.flush()
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        for queue in self.queues:
+            queue.clear()
@@ -0,0 +1,248 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Multi-process sharding of users across worker processes.
+
+With 'workers: N' in thud.conf, the process started by the admin becomes a supervisor. It owns the client listeners,
+spawns N worker processes (thud.py --worker <index>) and restarts them when they die. Every user belongs to exactly
+one worker, picked by a stable hash of the username, and each worker only loads its own users.
+
+When a client sends its PASS, the supervisor stops reading from the connection and hands it to the owning worker
+over that worker's UNIX control socket: the socket itself travels as SCM_RIGHTS ancillary data, together with
+whatever the supervisor had already read from it (the PASS line and anything buffered after it). The worker adopts
+the socket into its own reactor and carries on as if the client had connected to it directly.
+
+TLS sessions can't be moved between processes, so for SSL clients the supervisor keeps the TLS connection and hands
+the worker one end of a socketpair instead, relaying bytes between the two.
+"""
+import os
+import sys
+import zlib
+import socket
+import binascii
+
+from twisted.internet import reactor, stdio
+from twisted.internet.protocol import Factory, ClientFactory, Protocol, ProcessProtocol
+from twisted.internet.error import ReactorNotRunning
+from twisted.internet.interfaces import IFileDescriptorReceiver, ISSLTransport
+from twisted.protocols.basic import LineReceiver
+from zope.interface import implementer
+
+import thudlog
+
+log = thudlog.getLogger("shard")
+
+THUD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thud.py")
+
+
+def shard_for(username, workers):
+    """ Return the index of the worker that owns username. Stable across processes and restarts. """
+    return (zlib.crc32(username.lower()) & 0xffffffff) % workers
+
+
+def worker_socket_path(config, index):
+    return os.path.join(config.worker_socket_dir or ".", "thud-worker-%d.sock" % index)
+
+
+class WorkerProcess(ProcessProtocol):
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+
+    def connectionMade(self):
+        log.info("worker %d started with pid %d", self.index, self.transport.pid)
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+
+class Supervisor(object):
+    def __init__(self, config, configpath):
+        self.config = config
+        self.configpath = configpath
+        self.workers = config.workers
+        self.processes = {}  # key is worker index
+        self.stopping = False
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def start(self):
+        for index in range(self.workers):
+            self.spawn(index)
+
+    def spawn(self, index):
+        args = [sys.executable, THUD, "--worker", str(index), self.configpath]
+        # the worker watches its stdin, and exits when the supervisor goes away and the pipe closes
+        process = WorkerProcess(self, index)
+        reactor.spawnProcess(process, sys.executable, args, env=os.environ, childFDs={0: "w", 1: 1, 2: 2})
+        self.processes[index] = process
+
+    def worker_ended(self, process, reason):
+        if self.processes.get(process.index) is process:
+            del self.processes[process.index]
+        if self.stopping:
+            return
+        delay = self.config.worker_restart_delay or 1
+        log.error("worker %d died (%s), restarting in %s seconds", process.index, reason.value, delay)
+        reactor.callLater(delay, self.spawn, process.index)
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            # closing the pipe lets the worker shut down cleanly, see ParentWatcher
+            process.transport.closeStdin()
+
+    def reload(self):
+        for process in self.processes.values():
+            process.transport.signalProcess("HUP")
+
+    def handoff(self, client, username, data):
+        """ Hand client, whose connection is paused, over to the worker owning username. data is everything already read from the connection that the worker still needs to see. """
+        index = shard_for(username, self.workers)
+        log.debug("handing client for %s off to worker %d", username, index)
+        if ISSLTransport.providedBy(client.transport):
+            local, remote = socket.socketpair()
+            reactor.adoptStreamConnection(local.fileno(), socket.AF_UNIX, RelayFactory(client))
+            local.close()  # the reactor has its own duplicate now
+            fd, family = remote.fileno(), socket.AF_UNIX
+        else:
+            remote = None
+            fd, family = client.transport.fileno(), client.transport.getHost().type == "TCP6" and socket.AF_INET6 or socket.AF_INET
+        factory = HandoffClientFactory(client, fd, family, data, remote)
+        reactor.connectUNIX(worker_socket_path(self.config, index), factory)
+
+
+class HandoffClient(LineReceiver):
+    """ Supervisor side of a handoff: sends the descriptor and buffered data, then lets go once the worker confirms. """
+    def connectionMade(self):
+        f = self.factory
+        self.transport.sendFileDescriptor(f.fd)
+        self.sendLine("HANDOFF %d %s %s" % (f.family, binascii.hexlify(f.data), f.client.source))
+
+    def lineReceived(self, line):
+        self.factory.done(line == "OK")
+        self.transport.loseConnection()
+
+
+class HandoffClientFactory(ClientFactory):
+    protocol = HandoffClient
+
+    def __init__(self, client, fd, family, data, remote):
+        self.client = client
+        self.fd = fd
+        self.family = family
+        self.data = data
+        self.remote = remote  # our end of the relay socketpair, if any
+        self.finished = False
+
+    def done(self, ok):
+        if self.finished:
+            return
+        self.finished = True
+        if self.remote:
+            # the worker has its own copy of the relay socket; the relay keeps going through the adopted end
+            self.remote.close()
+            if ok:
+                self.client.resumeProducing()
+            else:
+                self.client.transport.loseConnection()
+        else:
+            # the worker owns the connection now; close our copy of the socket without shutting it down
+            self.client.transport._shouldShutdown = False
+            self.client.transport.loseConnection()
+        if not ok:
+            log.error("handoff of client %s failed", self.client.transport.getPeer())
+
+    def clientConnectionFailed(self, connector, reason):
+        log.error("could not reach worker for handoff: %s", reason.value)
+        self.done(False)
+
+    def clientConnectionLost(self, connector, reason):
+        self.done(False)
+
+
+class Relay(Protocol):
+    """ Supervisor side of a relayed (TLS) client: shovels bytes between the socketpair and the client connection. """
+    def __init__(self, client):
+        self.client = client
+
+    def connectionMade(self):
+        self.client.relay = self
+
+    def dataReceived(self, data):
+        self.client.transport.write(data)
+
+    def connectionLost(self, reason):
+        self.client.transport.loseConnection()
+
+
+class RelayFactory(Factory):
+    def __init__(self, client):
+        self.client = client
+
+    def buildProtocol(self, addr):
+        return Relay(self.client)
+
+
+@implementer(IFileDescriptorReceiver)
+class HandoffServer(LineReceiver):
+    """ Worker side of a handoff: adopts the descriptor and replays the buffered data into a fresh client connection. """
+    def connectionMade(self):
+        self.fds = []
+
+    def fileDescriptorReceived(self, fd):
+        self.fds.append(fd)
+
+    def lineReceived(self, line):
+        command, family, data, source = line.split(" ", 3)
+        if command != "HANDOFF" or not self.fds:
+            self.sendLine("ERROR")
+            return
+        fd = self.fds.pop(0)
+        try:
+            reactor.adoptStreamConnection(fd, int(family), AdoptedFactory(self.factory.client_factory, binascii.unhexlify(data), source))
+        except Exception, e:
+            log.error("failed to adopt handed off client: %s", e)
+            self.sendLine("ERROR")
+            return
+        finally:
+            os.close(fd)  # the reactor has its own duplicate now
+        self.sendLine("OK")
+
+
+class HandoffServerFactory(Factory):
+    protocol = HandoffServer
+
+    def __init__(self, client_factory):
+        self.client_factory = client_factory
+
+
+class AdoptedFactory(Factory):
+    """ Builds the client connection for an adopted socket and feeds it the data the supervisor already read. """
+    def __init__(self, client_factory, data, source):
+        self.client_factory = client_factory
+        self.data = data
+        self.source = source  # the client's real address; a relayed client's socket is only a socketpair
+
+    def buildProtocol(self, addr):
+        client = self.client_factory.buildProtocol(addr)
+        client.source = self.source
+        # connectionMade runs right after this returns; the buffered data has to come after it
+        reactor.callLater(0, client.dataReceived, self.data)
+        return client
+
+
+class ParentWatcher(Protocol):
+    """ Stops a worker's reactor once its stdin - a pipe from the supervisor - closes. """
+    def connectionLost(self, reason):
+        try:
+            reactor.stop()
+            log.warning("supervisor went away, shutting down")
+        except ReactorNotRunning:
+            pass  # already on the way down, the supervisor stopped us with a signal
+
+
+def listen_worker(config, index, client_factory):
+    path = worker_socket_path(config, index)
+    if os.path.exists(path):
+        os.unlink(path)
+    reactor.listenUNIX(path, HandoffServerFactory(client_factory), mode=0600)
+    stdio.StandardIO(ParentWatcher())
+    log.info("worker %d listening for handoffs on %s", index, path)
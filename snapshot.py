@@ -0,0 +1,173 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Snapshots of the cache state of every user, so a restart doesn't lose it.
+
+Every snapshot_interval seconds, and once more on shutdown, each user's caches are turned into plain data (see
+Cache.snapshot) and written to <snapshot_dir>/<user>.snap, which is read back when the user's config is processed on
+startup. Users are gathered one per reactor iteration; encoding and writing happen in a background thread.
+
+A snapshot file is an 8 byte magic string and a 2 byte little-endian format version, followed by the zlib compressed
+marshal of the state. Snapshots of any other version are ignored rather than guessed at.
+
+Messages of buffers with an on-disk backlog (backlog_dir) are not part of the snapshot; the backlog store already
+has them.
+"""
+import os
+import time
+import errno
+import zlib
+import marshal
+import struct
+import urllib
+import threading
+import Queue
+from collections import deque
+
+from twisted.internet import reactor, task
+
+import backlog
+import thudlog
+
+log = thudlog.getLogger("snapshot")
+
+MAGIC = "THUDSNAP"
+VERSION = 1
+HEADER = struct.Struct("<8sH")
+
+DEFAULT_INTERVAL = 300
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def path_for(directory, username):
+    return os.path.join(directory, urllib.quote(username.lower(), safe="") + ".snap")
+
+
+def encode(state):
+    return HEADER.pack(MAGIC, VERSION) + zlib.compress(marshal.dumps(state, 2))
+
+
+def decode(data):
+    if len(data) < HEADER.size:
+        raise SnapshotError("truncated header")
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("not a snapshot")
+    if version != VERSION:
+        raise SnapshotError("unsupported version %d" % version)
+    try:
+        return marshal.loads(zlib.decompress(data[HEADER.size:]))
+    except (zlib.error, ValueError, EOFError, TypeError), e:
+        raise SnapshotError("corrupt: %s" % e)
+
+
+def write(path, state):
+    """ Encode and write state to path, replacing the previous snapshot only once the new one is complete. """
+    directory = os.path.dirname(path)
+    if directory:
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(encode(state))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def load(config, username):
+    """ Return the state last snapshotted for username, or None if there is none (or snapshots are disabled). """
+    if not config.snapshot_dir:
+        return None
+    path = path_for(config.snapshot_dir, username)
+    try:
+        with open(path, "rb") as f:
+            state = decode(f.read())
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            log.error("failed to read snapshot %s: %s", path, e)
+        return None
+    except SnapshotError, e:
+        log.warning("ignoring snapshot %s: %s", path, e)
+        return None
+    log.info("restoring %s from snapshot taken at %s", username, time.ctime(state["saved"]))
+    return state
+
+
+def pack_messages(state):
+    """ Turn the (seq, datetime, Message) tuples MessageBuffer.snapshot leaves in a user's state into (seq, timestamp,
+    raw line) tuples. Done in the writer thread, as it's the bulk of the work for large in-memory backlogs. """
+    for network in state["networks"].values():
+        for buf in network["channels"] + network["queries"]:
+            buf["messages"] = [(seq, backlog.to_timestamp(stamp), message.raw) for seq, stamp, message in buf["messages"]]
+
+
+def user_state(user):
+    return {
+        "name": user.config.name,
+        "saved": time.time(),
+        "networks": dict((ref, cache.snapshot()) for ref, cache in user.server_caches.items()),
+    }
+
+
+class Snapshotter(object):
+    def __init__(self, bouncer, directory, interval=DEFAULT_INTERVAL):
+        self.bouncer = bouncer
+        self.directory = directory
+        self.interval = interval
+        self.pending_users = deque()  # users still to be gathered in the current round
+        self.queue = Queue.Queue()  # (path, state) tuples for the writer thread, None to stop it
+        self.loop = task.LoopingCall(self.snapshot_all)
+        self.thread = threading.Thread(target=self._run, name="thud-snapshot-writer")
+        self.thread.daemon = True
+
+    def start(self):
+        log.info("snapshotting to %s every %ds", self.directory, self.interval)
+        self.thread.start()
+        self.loop.start(self.interval, now=False)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def snapshot_all(self):
+        if self.pending_users:
+            log.warning("previous snapshot round still running, skipping this one")
+            return
+        self.pending_users.extend(self.bouncer.users.values())
+        self.snapshot_next()
+
+    def snapshot_next(self):
+        if not self.pending_users:
+            return
+        self.snapshot_user(self.pending_users.popleft())
+        if self.pending_users:
+            reactor.callLater(0, self.snapshot_next)
+
+    def snapshot_user(self, user):
+        # the snapshot's sequence numbers and cursors mustn't get ahead of what the backlog stores have on disk
+        self.bouncer.backlog_files.flush()
+        self.queue.put((path_for(self.directory, user.config.name), user_state(user)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, state = item
+            try:
+                pack_messages(state)
+                write(path, state)
+            except (IOError, OSError), e:
+                log.error("failed to write snapshot %s: %s", path, e)
+
+    def stop(self):
+        """ Snapshot every user one last time and wait for the snapshots to be written. """
+        if self.loop.running:
+            self.loop.stop()
+        self.pending_users.clear()
+        for user in self.bouncer.users.values():
+            self.snapshot_user(user)
+        self.queue.put(None)
+        self.thread.join()
@@ -1,19 +1,55 @@
 #!/usr/bin/env python2.7
+import sys
+
+import engine
+
+
+def parse_args(args):
+    """ Return (worker index or None, config directory) from a [--worker N] [configpath] command line. """
+    worker = None
+    if args[:1] == ["--worker"]:
+        worker = int(args[1])
+        args = args[2:]
+    return worker, args and args[0] or "."
+
+if __name__ == '__main__':
+    # thud.conf picks the reactor, which has to be installed before anything below imports it
+    try:
+        engine.install(parse_args(sys.argv[1:])[1])
+    except engine.EngineError, e:
+        sys.exit("thud: %s" % e)
+
 from twisted.internet.protocol import Factory
 from twisted.protocols.basic import LineReceiver
-from twisted.internet import reactor, ssl
-from twisted.internet.endpoints import clientFromString
-from passlib.apps import custom_app_context as pwd_context
+from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+import yaml
 
-import re
+import os
 import glob
+import signal
 import uuid
-import time
-from datetime import datetime
+from collections import deque
 
 import irc
+import auth
 import config
-
+import connector
+import thudlog
+import chatlog
+import backlog
+import shard
+import metrics
+import replay
+import scheduler
+import sendqueue
+import snapshot
+
+log = thudlog.getLogger("bouncer")
+TRACE = thudlog.TRACE
+
+DEFAULT_PENDING_MAX_LINES = 100
 
 class ThudException(Exception):
     pass
@@ -35,15 +71,84 @@ class User(object):
         self.server_connections = {}  # key is ref
         self.server_caches = {}  # key is ref
         self.clients = {}  # key is resource
-        self.logger = []  # no need for keys here
-
-    def authenticate_client(self, password):
-        """ Called when a downstream client connects and is attempting to authenticate """
-        return pwd_context.verify(password, self.config.password)
+        self.network_clients = {}  # key is ref, then resource; the same clients as above, indexed by network for fan-out
+        self.removed = False  # set once the user's .user file is gone; nothing gets reconnected after that
+        self.pending_lines = {}  # key is ref, value is a deque of (client, message) sent while the network wasn't connected yet
+
+    def restore(self, state):
+        """ Recreate the caches of a snapshot (see snapshot.py). """
+        for ref, cache_state in state["networks"].items():
+            self.server_caches[ref] = irc.Cache(self)
+            self.server_caches[ref].restore(cache_state)
+
+    def reload(self, config):
+        """ Switch to a new version of the user's config, applying what changed to the running connections. """
+        old, self.config = self.config, config
+        old_networks = dict((networkconfig.ref, networkconfig) for networkconfig in old.networks or [])
+        for networkconfig in config.networks or []:
+            ref = networkconfig.ref
+            if ref not in old_networks:
+                log.info("[%s] network %s added", config.name, ref)
+                if networkconfig.autoconnect:
+                    self.bouncer.connector.request(self, ref, connector.REASON_ADDED)
+                continue
+            server = self.server_connections.get(ref)
+            if server:
+                server.config = networkconfig
+                self.reload_network(server, old_networks[ref])
+        for ref in old_networks:
+            if not config.get_child("ref", ref):
+                log.info("[%s] network %s removed", config.name, ref)
+                self.bouncer.connector.cancel(self, ref)
+                self.drop_pending_lines(ref, "network removed from configuration")
+                server = self.server_connections.get(ref)
+                if server:
+                    server.write_line("QUIT :network removed from configuration")
+                    server.transport.loseConnection()
+
+    def reload_network(self, server, old):
+        """ Bring a connected network in line with its new config; old is the config it was connected with. """
+        new = server.config
+        cache = server.cache
+        old_channels = dict((cache.fold(channel.name), channel) for channel in old.channels or [])
+        new_channels = dict((cache.fold(channel.name), channel) for channel in new.channels or [])
+        added = [channel for key, channel in new_channels.items() if key not in old_channels]
+        if added:
+            log.info("[%s][%s] joining added channels %s", self.config.name, new.ref, ",".join(channel.name for channel in added))
+            server.scheduler.join([(channel.name, channel.key) for channel in added])
+            for channel in added:
+                server.scheduler.mode(channel.name)
+                server.scheduler.who(channel.name)
+        for key, channel in old_channels.items():
+            if key not in new_channels:
+                log.info("[%s][%s] parting removed channel %s", self.config.name, new.ref, channel.name)
+                self.server_send(server, "PART %s" % channel.name)
+        if new.nick != old.nick:
+            self.server_send(server, "NICK %s" % new.nick)
+        # buffers read their settings (backlog and replay limits and the like) from their config as they go
+        for channel in cache.channels.values():
+            channel.config = cache.channel_config(channel.name)
+        for query in cache.queries.values():
+            query.config = new
+
+    def remove(self):
+        """ Drop every connection of a user whose .user file has been removed. """
+        self.removed = True
+        self.bouncer.connector.cancel(self)
+        self.pending_lines.clear()
+        for client in self.clients.values():
+            client.transport.loseConnection()
+        for server in self.server_connections.values():
+            server.write_line("QUIT :user removed from configuration")
+            server.transport.loseConnection()
+
+    def authenticate_client(self, password, source):
+        """ Called when a downstream client connects and is attempting to authenticate. Returns a Deferred firing with whether the password is right. """
+        return self.bouncer.authenticator.verify(self.config.name, password, self.config.password, source)
 
     def server_connected(self, server):
         """ Called when one of the server connections has successfully connected to the server server """
-        print "[%s] SERVER CONNECTED FOR %s" % (self.config.name, server.config.uri)
+        log.info("[%s] server connected for %s", self.config.name, server.config.uri)
         self.server_connections[server.config.ref] = server
         server.register_callback(CALLBACK_MESSAGE, self.server_message)
         server.register_callback(CALLBACK_DISCONNECTED, self.server_disconnected)
@@ -52,58 +157,107 @@ class User(object):
 
         self.server_caches[server.config.ref].set_server(server)
         server.register_callback(CALLBACK_MESSAGE, server.cache.process_server_message)
+        server.sendqueue = sendqueue.SendQueue(server.write_line,
+                                               server.config.flood_rate or sendqueue.DEFAULT_RATE,
+                                               server.config.flood_burst or sendqueue.DEFAULT_BURST,
+                                               server.config.flood_reserve or sendqueue.DEFAULT_RESERVE)
+        server.scheduler = scheduler.QueryScheduler(server.config.who_targets or scheduler.DEFAULT_WHO_TARGETS,
+                                                    server.config.who_channel_threshold or scheduler.DEFAULT_WHO_CHANNEL_THRESHOLD)
+        server.sendqueue.attach_scheduler(server.scheduler)
 
         # we need to do a USER and NICK command to the server here.
         if server.config.get("password"):
-            self.server_send(server, "PASS %s" % server.config.get("password"))
-        self.server_send(server, "NICK %s" % server.config.nick)
-        self.server_send(server, "USER %s 0 * :%s" % (server.config.nick, server.config.realname))
-        # we should join all channels:
+            self.server_send(server, "PASS %s" % server.config.get("password"), sendqueue.PRIORITY_URGENT)
+        self.server_send(server, "NICK %s" % server.config.nick, sendqueue.PRIORITY_URGENT)
+        self.server_send(server, "USER %s 0 * :%s" % (server.config.nick, server.config.realname), sendqueue.PRIORITY_URGENT)
+        # we should join all channels; the scheduler batches and paces the JOINs and the MODE/WHO queries after them
         if server.config.channels:
+            server.scheduler.join([(channel.name, channel.key) for channel in server.config.channels])
             for channel in server.config.channels:
-                self.server_send(server, "JOIN %s %s" % (channel.name, channel.key))
-                self.server_send(server, "MODE %s" % channel.name)
-                self.server_send(server, "WHO %s" % channel.name)
+                server.scheduler.mode(channel.name)
+                server.scheduler.who(channel.name)
 
         return server
 
-    def server_send(self, server, line):
+    def server_send(self, server, line, priority=sendqueue.PRIORITY_INTERACTIVE):
         """ Convenience function used to send messages to an server server """
-        print "[%s][%s] SERVER_SEND: %s" % (self.config.name, server.config.uri, line)
-        server.sendLine(line)
+        log.log(TRACE, "[%s][%s] SERVER_SEND: %s", self.config.name, server.config.uri, line)
+        server.sendLine(line, priority)
+
+    def get_network_clients(self, ref):
+        """ Return the clients attached to network ref. """
+        return self.network_clients.get(ref, {}).values()
 
-    def server_message(self, server, line):
+    def server_message(self, server, message):
         """ Called when a message is received from an server connection. This message will usually be delivered to all clients, and may also be cached."""
-        print "[%s][%s] SERVER_RECV: %s" % (self.config.name, server.config.uri, line)
-        for resource, client in self.clients.items():
-            if client.serverref == server.config.ref:
-                client.sendLine(line)
+        log.log(TRACE, "[%s][%s] SERVER_RECV: %s", self.config.name, server.config.uri, message.raw)
+        for client in self.get_network_clients(server.config.ref):
+            # a client with held lines gets the cached state once they are sent, which covers what it misses here
+            if client.holding:
+                continue
+            if client.replay.active:
+                client.replay.hold(message.raw)
+            else:
+                client.sendLine(message.raw)
 
     def server_disconnected(self, server):
         """ Called when one of the server connections disconnects for whatever reason """
         del self.server_connections[server.config.ref]
-        print "[%s] SERVER DISCONNECTED FOR %s" % (self.config.name, server.config.uri)
-        server.config.reconnect_attempts = 0
-        self.server_reconnect(server.config)
+        server.sendqueue.stop()
+        log.info("[%s] server disconnected for %s", self.config.name, server.config.uri)
+        # a reload may have replaced the network's config since it connected, or removed the network altogether
+        networkconfig = self.config.get_child("ref", server.config.ref)
+        if self.removed or not networkconfig:
+            log.info("[%s] not reconnecting to %s, it is no longer configured", self.config.name, server.config.uri)
+            return server
+        self.bouncer.connector.request(self, networkconfig.ref, connector.REASON_RECONNECT)
         return server
 
-    def server_reconnect(self, networkconfig):
-        if networkconfig.reconnect_attempts == 3:
-            print "[%s] ABORTING RECONNECT TO %s" % (self.config.name, networkconfig.uri)
+    def server_registered(self, server):
+        """ Called when the server has welcomed us, which is when a connection attempt counts as successful. """
+        self.bouncer.connector.registered(self, server.config.ref)
+
+    def server_ready(self, server):
+        """ Called at the end of the MOTD, once registration is complete and the welcome cached for clients. """
+        server.ready = True
+        pending = self.pending_lines.pop(server.config.ref, None)
+        if pending:
+            log.debug("[%s][%s] sending %d lines clients sent while connecting", self.config.name, server.config.ref, len(pending))
+            for client, message in pending:
+                client.holding = False
+            for client, message in pending:
+                if not client.closed:
+                    self.client_message(client, message)
+
+    def server_connect_failed(self, ref, error, delay):
+        """ Called when an attempt to connect to network ref failed; the next one is made in delay seconds. Lines
+        clients sent meanwhile keep waiting for it, their NICK and USER included, but the clients are told. """
+        pending = self.pending_lines.get(ref)
+        if not pending:
             return
-        print "[%s] ATTEMPTING RECONNECT TO %s ..." % (self.config.name, networkconfig.uri)
-        d = self.bouncer.connect_server(networkconfig, self)
-
-        def __connected(server):
-            return server.user.server_connected(server)
-
-        def __error(server):
-            networkconfig.reconnect_attempts += 1
-            reactor.callLater(pow(2, networkconfig.reconnect_attempts), self.server_reconnect, networkconfig)
-        d.addCallbacks(__connected, __error)
+        # nobody is left to send them for
+        pending = self.pending_lines[ref] = deque((client, message) for client, message in pending if not client.closed)
+        counts = {}
+        for client, message in pending:
+            counts[client] = counts.get(client, 0) + 1
+        for client, count in counts.items():
+            client.sendLine(":thud!cache@th.ud NOTICE %s :%s: connecting failed (%s), retrying in %ds, %d lines you sent are still waiting" % (self.config.nick, ref, error, delay, count))
+
+    def drop_pending_lines(self, ref, reason):
+        """ Drop the lines waiting for network ref to connect, and tell the clients that sent them. """
+        pending = self.pending_lines.pop(ref, None)
+        if not pending:
+            return
+        counts = {}
+        for client, message in pending:
+            client.holding = False
+            counts[client] = counts.get(client, 0) + 1
+        for client, count in counts.items():
+            if not client.closed:
+                client.sendLine(":thud!cache@th.ud NOTICE %s :%s: %s, %d lines you sent were not delivered" % (self.config.nick, ref, reason, count))
 
     def client_connected(self, client, token):
-        """ Called when a client connects for this user."""
+        """ Called when a client connects for this user. Returns a Deferred firing once the client is authenticated and attached. """
         # We need to perform authentication, resource resolution, attach to an server,  and possibly replay parts of the cache.
         if token.count(":") == 2:
             password, serverref, resource = token.split(":")
@@ -111,104 +265,257 @@ class User(object):
             password, serverref = token.split(":")
             resource = uuid.uuid4().hex
 
-        if not self.authenticate_client(password):
-            raise AuthenticationFailed()
+        def __verified(ok):
+            if not ok:
+                raise AuthenticationFailed()
+            if client.closed:
+                raise ThudException("client went away while authenticating")
+            return self.attach_client(client, serverref, resource)
+        return self.authenticate_client(password, client.source).addCallback(__verified)
 
+    def attach_client(self, client, serverref, resource):
         serverref = serverref.lower()
         client.resource = resource
         client.serverref = serverref
         client.register_callback(CALLBACK_MESSAGE, self.client_message)
         client.register_callback(CALLBACK_DISCONNECTED, self.client_disconnected)
+        client.register_callback(CALLBACK_GAP, self.client_gap)
+        client.register_callback(CALLBACK_QUEUEING, self.client_queueing)
         self.clients[resource] = client
+        self.network_clients.setdefault(serverref, {})[resource] = client
         if not serverref in self.server_connections:
-            networkconfig = self.config.by_path("networks/ref=%s" % serverref)
+            networkconfig = self.config.get_child("ref", serverref)
             if networkconfig:  # connect on demand
-                print "[%s] ON DEMAND CONNECTING TO SERVER %s" % (self.config.name, networkconfig.uri)
-                d = self.bouncer.connect_server(networkconfig, self)
-
-                def __connected(server):
-                    res = self.server_connected(server)
-                    return res
-                d.addCallback(__connected)
+                self.bouncer.connector.request(self, serverref, connector.REASON_DEMAND)
             else:
                 raise NoSuchNetwork(serverref)
         return client
 
-    def client_message(self, client, line):
+    def client_message(self, client, message):
         """ Called when a message is received from a client. This message will usually be relayed to the relevant server, although it might be diverted to the cache instead. """
-        print "[%s][%s][%s] CLIENT_RECV: %s" % (self.config.name, client.serverref, client.resource, line)
+        log.log(TRACE, "[%s][%s][%s] CLIENT_RECV: %s", self.config.name, client.serverref, client.resource, message.raw)
 
-        if not client.serverref in self.server_connections:
-            print "---> PUTTING OFF FOR 1 SECOND TO GIVE THE SERVER A CHANCE TO COMPLETE CONNECTION!"
-            reactor.callLater(1, self.client_message, client, line)
+        server = self.server_connections.get(client.serverref)
+        if not server or not server.ready:
+            self.hold_client_message(client, message)
             return
-        if self.server_caches[client.serverref].handle_client_message(client, line):
+        if self.server_caches[client.serverref].handle_client_message(client, message):
             return
-        self.server_connections[client.serverref].sendLine(line)
+        self.server_send(self.server_connections[client.serverref], message.raw, sendqueue.PRIORITY_INTERACTIVE)
+
+    def hold_client_message(self, client, message):
+        """ Keep a line for a network that isn't connected yet, to be sent once registration is complete. """
+        ref = client.serverref
+        if not self.bouncer.connector.pending(self, ref) and not ref in self.server_connections:
+            client.sendLine(":thud!cache@th.ud NOTICE %s :%s: not connected, line not delivered" % (self.config.nick, ref))
+            return
+        pending = self.pending_lines.setdefault(ref, deque())
+        if len(pending) >= (self.config.pending_max_lines or DEFAULT_PENDING_MAX_LINES):
+            log.warning("[%s][%s][%s] dropping client line, %d already waiting for the connection", self.config.name, ref, client.resource, len(pending))
+            client.sendLine(":thud!cache@th.ud NOTICE %s :%s: still connecting and too many lines waiting, line not delivered" % (self.config.nick, ref))
+            return
+        log.debug("[%s][%s] holding client line until registration is complete", self.config.name, ref)
+        client.holding = True
+        pending.append((client, message))
+
+    def client_queueing(self, client):
+        """ Called when lines start to wait in the outbound queue of a client. """
+        if client.serverref in self.server_caches:
+            self.server_caches[client.serverref].mark_delivered(client)
+
+    def client_gap(self, client):
+        """ Called once a client that overflowed its outbound queue has caught up again. Whatever it missed in the meantime gets replayed from the backlog."""
+        log.warning("[%s][%s][%s] client caught up after %d lines were dropped", self.config.name, client.serverref, client.resource, client.outbound.gap_lines)
+        if client.serverref in self.server_caches:
+            self.server_caches[client.serverref].replay_gap(client)
 
     def client_disconnected(self, client):
         """ Called when a client disconnectes for this user."""
-        print "[%s][%s] CLIENT_DISCONNECTED" % (self.config.name, client.serverref)
-        if client.resource in self.clients:
+        log.info("[%s][%s][%s] client disconnected", self.config.name, client.serverref, client.resource)
+        # the resource may already have reconnected on a new connection, which must stay attached
+        if self.clients.get(client.resource) is client:
             del self.clients[client.resource]
+        clients = self.network_clients.get(client.serverref, {})
+        if clients.get(client.resource) is client:
+            del clients[client.resource]
 
 
 class IRCBouncer:
-    def __init__(self, port, configpath="."):
+    def __init__(self, port, configpath=".", worker=None):
         self.users = {}
+        self.worker = worker  # index of the worker process we are, if any
+        self.supervisor = None
+        self.connector = None
+        self.configpath = configpath
         self.process_server_config("%s/thud.conf" % configpath)
+        thudlog.setup(self.config)
+        log.info("running on %s", engine.describe())
+        irc.set_handler_timing(self.config.handler_timing)
+        self.chatlog = chatlog.ChatLogWriter(self.config.log_flush_interval or chatlog.DEFAULT_FLUSH_INTERVAL, self.config.log_max_open_files or chatlog.DEFAULT_MAX_OPEN_FILES)
+        reactor.addSystemEventTrigger("before", "shutdown", self.chatlog.stop)
+        self.backlog_files = backlog.BacklogFiles(self.config.backlog_max_open_files or backlog.DEFAULT_MAX_OPEN_FILES,
+                                                  self.config.backlog_flush_interval or backlog.DEFAULT_FLUSH_INTERVAL,
+                                                  self.config.backlog_expire_interval or backlog.DEFAULT_EXPIRE_INTERVAL)
+        self.backlog_files.start()
         factory = IRCClientConnectionFactory(self)
+        metrics.registry.add_collector(self.collect_metrics)
+        metrics.listen(self.config, worker is not None and worker + 1 or 0)
+        # SIGHUP re-reads the configuration; the reactor takes it from there, outside the signal handler
+        signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(self.reload))
+
+        if worker is not None:
+            # clients only ever reach a worker through a handoff from the supervisor
+            shard.listen_worker(self.config, worker, factory)
+        else:
+            self.listen(factory)
 
+        if self.config.workers and worker is None:
+            log.info("supervising %d worker processes", self.config.workers)
+            self.supervisor = shard.Supervisor(self.config, configpath)
+            self.supervisor.start()
+            return
+
+        # the supervisor never sees a password, it hands clients off before that
+        self.authenticator = auth.Authenticator(self.config.get("auth_processes", auth.DEFAULT_PROCESSES),
+                                                self.config.auth_cache_ttl or auth.DEFAULT_CACHE_TTL,
+                                                self.config.auth_max_failures or auth.DEFAULT_MAX_FAILURES,
+                                                self.config.auth_failure_window or auth.DEFAULT_FAILURE_WINDOW)
+        self.connector = connector.ConnectionScheduler(self,
+                                                       self.config.connect_max_per_host or connector.DEFAULT_MAX_PER_HOST,
+                                                       self.config.get("connect_spread", connector.DEFAULT_SPREAD),
+                                                       self.config.connect_backoff_base or connector.DEFAULT_BACKOFF_BASE,
+                                                       self.config.connect_backoff_cap or connector.DEFAULT_BACKOFF_CAP,
+                                                       self.config.connect_timeout or connector.DEFAULT_TIMEOUT,
+                                                       self.config.connect_stable or connector.DEFAULT_STABLE)
+
+        for user_file in glob.glob("%s/*.user" % configpath):
+            self.process_user_config(user_file)
+
+        if self.config.snapshot_dir:
+            snapshot.Snapshotter(self, self.config.snapshot_dir, self.config.snapshot_interval or snapshot.DEFAULT_INTERVAL).start()
+
+    def listen(self, factory):
         if self.config.ssl_enable:
-            print "LISTENING ON PORT %d for SSL" % self.config.ssl_port
+            log.info("listening on port %d for SSL", self.config.ssl_port)
             try:
-                reactor.listenSSL(self.config.ssl_port, factory, ssl.DefaultOpenSSLContextFactory(self.config.ssl_key, self.config.ssl_cert))
+                engine.listen_ssl(self.config.ssl_port, factory, self.config.ssl_key, self.config.ssl_cert)
             except Exception, e:
-                print "FAILED TO LISTEN FOR SSL: %s" % e
+                log.error("failed to listen for SSL: %s", e)
 
         if self.config.tcp_enable:
-            print "LISTENING ON PORT %d for TCP" % self.config.tcp_port
-            reactor.listenTCP(self.config.tcp_port, factory)
-
-        for user_file in glob.glob("%s/*.user" % configpath):
-            self.process_user_config(user_file)
+            log.info("listening on port %d for TCP", self.config.tcp_port)
+            engine.listen_tcp(self.config.tcp_port, factory)
+
+    def collect_metrics(self):
+        """ Read the current line counts, queue depths and cache sizes off the users, connections and caches. """
+        net = ("user", "network")
+        upstream_received = metrics.Family("thud_upstream_lines_received_total", "counter", "Lines received from the network", net)
+        upstream_sent = metrics.Family("thud_upstream_lines_sent_total", "counter", "Lines sent to the network", net)
+        upstream_queued = metrics.Family("thud_upstream_queued_lines", "gauge", "Lines waiting in the upstream send queue", net + ("priority",))
+        client_received = metrics.Family("thud_client_lines_received_total", "counter", "Lines received from a client", net + ("resource",))
+        client_sent = metrics.Family("thud_client_lines_sent_total", "counter", "Lines sent to a client", net + ("resource",))
+        client_dropped = metrics.Family("thud_client_lines_dropped_total", "counter", "Lines dropped because a client's outbound queue overflowed", net + ("resource",))
+        client_queued = metrics.Family("thud_client_queued_bytes", "gauge", "Bytes waiting in a client's outbound queue", net + ("resource",))
+        buffered = metrics.Family("thud_buffer_bytes", "gauge", "Bytes of the lines in a channel or query buffer; a line shared with other users counts in each of their buffers", net + ("buffer",))
+        channels = metrics.Family("thud_cache_channels", "gauge", "Channels in the cache", net)
+        members = metrics.Family("thud_cache_members", "gauge", "Channel members in the cache, summed over channels", net)
+        queries = metrics.Family("thud_cache_queries", "gauge", "Queries in the cache", net)
+        connects = metrics.Family("thud_connect_attempts", "gauge", "Connection attempts waiting, connecting or registering", ("state",))
+        shared = metrics.Family("thud_shared_messages", "gauge", "Distinct messages held by the buffers of all users, each stored once")
+        shared.add((), len(irc.shared_messages))
+        if self.connector:
+            self.connector.collect(connects)
+        for name, user in self.users.items():
+            for ref, server in user.server_connections.items():
+                upstream_received.add((name, ref), server.lines_received)
+                upstream_sent.add((name, ref), server.lines_sent)
+                if server.sendqueue:
+                    for priority, priority_name in enumerate(sendqueue.PRIORITY_NAMES):
+                        upstream_queued.add((name, ref, priority_name), server.sendqueue.depth(priority))
+            for client in user.clients.values():
+                labels = (name, client.serverref, client.resource)
+                client_received.add(labels, client.lines_received)
+                client_sent.add(labels, client.outbound.sent_lines)
+                client_dropped.add(labels, client.outbound.dropped_lines)
+                client_queued.add(labels, client.outbound.queued_bytes)
+            for ref, cache in user.server_caches.items():
+                channels.add((name, ref), len(cache.channels))
+                members.add((name, ref), sum(len(channel.members) for channel in cache.channels.values()))
+                queries.add((name, ref), len(cache.queries))
+                for buf in cache.channels.values() + cache.queries.values():
+                    buffered.add((name, ref, buf.name), buf.buffered_bytes)
+        return [upstream_received, upstream_sent, upstream_queued, client_received, client_sent, client_dropped, client_queued, buffered, channels, members, queries, connects, shared]
 
     def process_server_config(self, filename):
-        print "PROCESSING SERVER CONFIG"
         self.config = config.Config(filename=filename)
 
     def process_user_config(self, filename):
         userconfig = config.Config(filename=filename, parent=self.config)
+        if self.is_ours(userconfig):
+            self.add_user(userconfig)
+
+    def is_ours(self, userconfig):
+        """ Whether the user belongs to this process, rather than to another worker. """
+        return self.worker is None or shard.shard_for(userconfig.name, self.config.workers) == self.worker
+
+    def add_user(self, userconfig):
         user = User(self, userconfig)
-        print "PROCESSING USER CONFIG FOR %s" % user.config.name
+        log.info("processing user config for %s", user.config.name)
         self.users[user.config.name] = user
+        state = snapshot.load(user.config, user.config.name)
+        if state:
+            user.restore(state)
         for networkconfig in user.config.networks:
-            print "\t", networkconfig.ref, networkconfig.uri, networkconfig.autoconnect and "AUTOCONNECT" or "ONDEMAND"
+            log.info("    %s %s %s", networkconfig.ref, networkconfig.uri, networkconfig.autoconnect and "AUTOCONNECT" or "ONDEMAND")
             if networkconfig.autoconnect:
-                d = self.connect_server(networkconfig, user)
+                self.connector.request(user, networkconfig.ref, connector.REASON_STARTUP)
 
-                def __connected(server):
-                    return server.user.server_connected(server)
-                d.addCallback(__connected)
+    def reload(self):
+        """ Re-read thud.conf and the .user files and apply the differences, leaving unchanged connections alone. """
+        if self.supervisor:
+            log.info("passing reload on to the workers")
+            self.supervisor.reload()
+            return
+        log.info("reloading configuration from %s", self.configpath)
+        # read everything first, so a broken file leaves the running configuration untouched
+        try:
+            serverconfig = config.Config(filename="%s/thud.conf" % self.configpath)
+            userconfigs = [config.Config(filename=filename, parent=serverconfig) for filename in glob.glob("%s/*.user" % self.configpath)]
+        except (IOError, yaml.YAMLError, config.ConfigError), e:
+            log.error("reload failed, keeping the current configuration: %s", e)
+            return
+        self.config = serverconfig
+        irc.set_handler_timing(self.config.handler_timing)
+        names = set()
+        for userconfig in userconfigs:
+            if not self.is_ours(userconfig):
+                continue
+            names.add(userconfig.name)
+            if userconfig.name in self.users:
+                self.users[userconfig.name].reload(userconfig)
+            else:
+                log.info("user %s added", userconfig.name)
+                self.add_user(userconfig)
+        for name in set(self.users) - names:
+            log.info("user %s removed", name)
+            self.users.pop(name).remove()
+
+    def request_reload(self):
+        """ Reload the configuration of the whole bouncer, all workers included. """
+        if self.worker is not None:
+            os.kill(os.getppid(), signal.SIGHUP)
+        else:
+            self.reload()
 
-    def connect_server(self, networkconfig, user):
+    def connect_server(self, networkconfig, user, timeout=connector.DEFAULT_TIMEOUT):
+        """ Open a connection to a network; use connector.request rather than calling this directly. """
         uri = networkconfig.uri
-        m = re.match("(?:(?P<proto>[a-zA-i0-9]+)://)?(?P<host>[a-zA-Z0-9.-]+)(?:[:](?P<port>[0-9]+))?/?", uri)
-        parts = m.groupdict()
-        protocol = parts.get("proto", "irc").lower()
-        host = parts.get("host")
-        port = parts.get("port", "6667")
-
-        if protocol == "irc":
-            epproto = "tcp"
-        elif protocol == "ircs":
-            epproto = "ssl"
-        endpointstring = "%s:host=%s:port=%s" % (epproto, host, port)
-        endpoint = clientFromString(reactor, endpointstring)
-        d = endpoint.connect(IRCServerConnectionFactory(uri))
+        protocol, host, port = connector.parse_uri(uri)
+        if protocol not in ("irc", "ircs"):
+            return defer.fail(ThudException("unsupported protocol %s in %s" % (protocol, uri)))
+        d = engine.connect(host, port, protocol == "ircs", IRCServerConnectionFactory(uri), timeout)
 
         def __connected(server):
-            print "SERVER_CONNECTED!"
             server.config = networkconfig
             server.user = user
             return server
@@ -216,109 +523,39 @@ class IRCBouncer:
         return d
 
     def connect_client(self, client, token):
+        """ Authenticate and attach client; returns a Deferred. """
         if not ":" in token:
-            raise ThudException("Invalid Token!")
+            return defer.fail(ThudException("Invalid Token!"))
         username, sep, token = token.partition(":")
         username = username.lower()
         if username in self.users:
-            self.users[username].client_connected(client, token)
-        else:
-            raise AuthenticationFailed("CLIENT CONNECTED WITH UNKNOWN USERNAME: %s" % username)
-
-
-class IRCLogger(object):
-    def __init__(self):
-        self.file_template = None
-        self.file_opened = 0
-        self.file = None
-        self.enable = False
-        self.name = None
-        self.server = None
-        self.timestamp_template = None
-        self.last_activity = time.time()
-
-    def read_config(self, config):
-        pass
-
-    def open_file_required(self, now):
-        if self.file == None:
-            return True
-
-        if (now - self.file_opened) > (60 * 60 * 24):
-            return True
-
-        new = datetime.fromtimestamp(now)
-        old = datetime.fromtimestamp(self.file_opened)
-        if old.day != new.dat:
-            return True
-
-        return False
-
-    def open_file(self, now):
-        if self.open_file_required(now) != True:
-            return
-
-        # XXX: fail, too lazy to figure out a sane way to do this...
-        dt = datetime.fromtimestamp(now)
-        fname = self.file_template
-        fname = fname.replace('%y', dt.year)
-        fname = fname.replace('%m', dt.month)
-        fname = fname.replace('%d', dt.day)
-        fname = fname.replace('%n', self.server)
-        fname = fname.replace('%c', self.name)
-
-        self.file = open(fname, 'a+')
-        self.file_opened = now
-
-    def shutdown(self):
-        self.file.close()
-        self.file_opened = 0
-
-    def format_timestamp(self, timestamp):
-        timestamp = datetime.fromtimestamp(timestamp)
-        return '%02d:%02d:%02d' % (timestamp.hour, timestamp.minute, timestamp.second)
-
-    def log(self, timestamp, message):
-        message = '[%s] %s' % (self.format_timestamp(timestamp), message)
-        print '-------- %s' % message
-        return
-        self.open_file(timestamp)
-        self.file.write(message + '\n')
-        self.last_activity = time.time()
-
-    def clone(self):
-        clone = IRCLogger()
-        clone.file_template = self.file_template
-        clone.enable = self.enable
-        clone.timestamp_template = self.timestamp_template
-        clone.server = self.server
-        return clone
-
-    def log_join(self, now, name):
-        self.log(now, '*** %s has joined' % name)
-
-    def log_topic(self, now, name, topic):
-        self.log(now, '*** topic has been set by %s to: %s' % (name, topic))
-
-    def log_mode(self, user, message):
-        self.log(time.time(), "*** %s sets mode %s" % (user, ' '.join(message)))
-        pass
-
-    def log_privmsg(self, now, source, message):
-        self.log(now, '<%s> %s' % (source, message))
+            return self.users[username].client_connected(client, token)
+        # unknown users count towards the source's failed attempts as well
+        return self.authenticator.verify(username, token, None, client.source).addCallback(lambda ok: defer.fail(AuthenticationFailed("CLIENT CONNECTED WITH UNKNOWN USERNAME: %s" % username)))
 
 
 CALLBACK_MESSAGE = 0
 CALLBACK_DISCONNECTED = 1
+CALLBACK_GAP = 2
+CALLBACK_QUEUEING = 3
+
+OVERFLOW_BACKLOG = "backlog"
+OVERFLOW_DISCONNECT = "disconnect"
 
 
 class CallBackLineReceiver(LineReceiver):
+    parse_line = staticmethod(irc.parse_line)
+
     def __init__(self):
-        self.callbacks = {CALLBACK_MESSAGE: [], CALLBACK_DISCONNECTED: []}
+        self.callbacks = {CALLBACK_MESSAGE: [], CALLBACK_DISCONNECTED: [], CALLBACK_GAP: [], CALLBACK_QUEUEING: []}
+        self.lines_received = 0
 
     def lineReceived(self, line):
+        self.lines_received += 1
+        # parse exactly once; every callback gets the same irc.Message
+        message = self.parse_line(line)
         for cb in self.callbacks[CALLBACK_MESSAGE]:
-            cb(self, line)
+            cb(self, message)
 
     def connectionLost(self, line):
         for cb in self.callbacks[CALLBACK_DISCONNECTED]:
@@ -333,37 +570,175 @@ class CallBackLineReceiver(LineReceiver):
             self.callbacks[kind].remove(callback)
 
 
+@implementer(IPushProducer)
+class OutboundQueue(object):
+    """ Bounded queue of lines waiting to be written to a client.
+
+    It is registered as a streaming producer on the client's transport, so lines are only handed to the transport
+    while it isn't paused; anything sent in the meantime waits here. Once more than max_bytes are waiting, the
+    overflow policy kicks in: either the client is disconnected, or the queue is dropped and the client is put into
+    backlog-only mode (a 'gap') until the transport drains, at which point the CALLBACK_GAP callbacks fire so the
+    missed messages can be replayed from the backlog. The CALLBACK_QUEUEING callbacks fire whenever lines start to
+    wait, which is the last point everything sent so far is known to have reached the transport.
+    """
+    def __init__(self, client, max_bytes, policy):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.lines = deque()
+        self.paused = False
+        self.gap = False
+        self.queued_bytes = 0
+        self.peak_queued_bytes = 0
+        self.sent_lines = 0
+        self.sent_bytes = 0
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        self.gap_lines = 0  # lines dropped during the current gap
+        self.drain_callbacks = []
+
+    def write(self, data):
+        if self.gap:
+            self.gap_lines += 1
+            self.dropped_lines += 1
+            self.dropped_bytes += len(data)
+            return
+        if not self.lines:
+            if not self.paused:
+                self._write(data)
+                return
+            for cb in self.client.callbacks[CALLBACK_QUEUEING]:
+                cb(self.client)
+        self.lines.append(data)
+        self.queued_bytes += len(data)
+        self.peak_queued_bytes = max(self.peak_queued_bytes, self.queued_bytes)
+        if self.queued_bytes > self.max_bytes:
+            self.overflow()
+
+    def _write(self, data):
+        self.sent_lines += 1
+        self.sent_bytes += len(data)
+        self.client.transport.write(data)
+
+    def when_drained(self, callback):
+        """ Call callback once the queue is empty and the transport isn't paused. """
+        self.drain_callbacks.append(callback)
+
+    def overflow(self):
+        log.warning("client %s outbound queue overflow (%d bytes queued), policy %s", self.client.resource, self.queued_bytes, self.policy)
+        # whatever was left of a replay, and the live lines held back behind it, are part of the backlog replay that
+        # follows the gap
+        self.gap_lines = len(self.lines) + len(self.client.replay.held)
+        self.client.replay.stop()
+        self.dropped_lines += len(self.lines)
+        self.dropped_bytes += self.queued_bytes
+        self.lines.clear()
+        self.queued_bytes = 0
+        if self.policy == OVERFLOW_DISCONNECT:
+            self.client.transport.abortConnection()
+        else:
+            self.gap = True
+            if not self.paused:
+                # the replay's held lines overflowed, not the transport; nothing is waiting for it to drain, so end
+                # the gap once the message at hand has been cached
+                reactor.callLater(0, self.end_gap)
+
+    def end_gap(self):
+        if self.gap and not self.paused:
+            self.resumeProducing()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        # the transport may pause us again from inside write()
+        while self.lines and not self.paused:
+            data = self.lines.popleft()
+            self.queued_bytes -= len(data)
+            self._write(data)
+        if self.gap and not self.paused:
+            self.gap = False
+            for cb in self.client.callbacks[CALLBACK_GAP]:
+                cb(self.client)
+        if self.drain_callbacks and not self.lines and not self.paused:
+            callbacks, self.drain_callbacks = self.drain_callbacks, []
+            for cb in callbacks:
+                cb()
+
+    def stopProducing(self):
+        self.lines.clear()
+        self.queued_bytes = 0
+        self.drain_callbacks = []
+        self.client.replay.stop()
+
+
 class IRCClientConnection(CallBackLineReceiver):
     def __init__(self, bouncer):
         CallBackLineReceiver.__init__(self)
         self.bouncer = bouncer
+        self.resource = None
+        self.outbound = None
+        self.replay = None
+        self.relay = None  # set in the supervisor while relaying a handed off SSL client
+        self.source = None  # the client's address, for rate limiting; set by the worker for handed off clients
+        self.closed = False
+        self.holding = False  # whether lines of the client wait for its network to connect; see User.hold_client_message
+        self.delivered = None  # key is buffer name, value is the last sequence number known to have reached the client; see Cache.mark_delivered
 
     def connectionMade(self):
-        print "CLIENT CONNECTED"
+        log.debug("client connected from %s", self.transport.getPeer())
+        self.source = self.source or getattr(self.transport.getPeer(), "host", None)
+        config = self.bouncer.config
+        self.outbound = OutboundQueue(self, config.client_queue_max_bytes or 1024 * 1024, config.client_overflow_policy or OVERFLOW_BACKLOG)
+        self.transport.registerProducer(self.outbound, True)
+        self.replay = replay.ReplayStream(self)
         self.register_callback(CALLBACK_MESSAGE, self.lineReceived_filter_callback)
 
+    def dataReceived(self, data):
+        if self.relay:
+            self.relay.transport.write(data)
+        else:
+            CallBackLineReceiver.dataReceived(self, data)
+
+    def connectionLost(self, reason):
+        self.closed = True
+        if self.relay:
+            self.relay.transport.loseConnection()
+        CallBackLineReceiver.connectionLost(self, reason)
+
     def sendLine(self, line):
-        #print "CLIENT SENDLINE: %s" % line
         if len(line.strip()):
-            CallBackLineReceiver.sendLine(self, line)
-
-    def lineReceived_filter_callback(self, dummy, line):
-        if line.startswith("PASS"):
-            token = line[5:]
-            print "CLIENT CONNECTED WITH TOKEN: %s" % token
-            try:
-                self.bouncer.connect_client(self, token)
-            except AuthenticationFailed:
-                print "BAD PASSWORD FOR CLIENT"
-                self.sendLine(":THUD 464 :Password is invalid!")
-                self.transport.loseConnection()
-                return
-            except ThudException, e:
-                print "SOMETHING WENT AWRY!"
-                print e
-                self.transport.loseConnection()
+            self.outbound.write(line + self.delimiter)
+
+    def lineReceived_filter_callback(self, dummy, message):
+        if message.command == "PASS" and message.params:
+            token = message.params[0]
+            log.debug("client authenticating as %s", token.partition(":")[0])
+            if self.bouncer.supervisor:
+                # stop reading; the owning worker gets the socket plus everything we already read from it
+                self.pauseProducing()
+                self.unregister_callback(CALLBACK_MESSAGE, self.lineReceived_filter_callback)
+                self.bouncer.supervisor.handoff(self, token.partition(":")[0], message.raw + self.delimiter + self.clearLineBuffer())
                 return
+            # stop reading until the password has been checked; the lines after PASS are for the attached client
+            self.pauseProducing()
             self.unregister_callback(CALLBACK_MESSAGE, self.lineReceived_filter_callback)
+            d = self.bouncer.connect_client(self, token)
+            d.addCallbacks(self.authenticated, self.authentication_failed, errbackArgs=(token.partition(":")[0],))
+
+    def authenticated(self, result):
+        self.resumeProducing()
+
+    def authentication_failed(self, failure, username):
+        if failure.check(AuthenticationFailed):
+            log.warning("bad password for client %s", username)
+            self.sendLine(":THUD 464 :Password is invalid!")
+        elif failure.check(ThudException):
+            log.warning("client connection failed: %s", failure.value)
+        else:
+            log.error("client connection failed", exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+        self.transport.loseConnection()
 
 
 class IRCClientConnectionFactory(Factory):
@@ -375,9 +750,27 @@ class IRCClientConnectionFactory(Factory):
 
 
 class IRCServerConnection(CallBackLineReceiver):
+    # users in the same channel all get its lines; whichever connection is first parses them for everyone
+    parse_line = staticmethod(irc.parse_shared_line)
+
     def __init__(self, uri):
         CallBackLineReceiver.__init__(self)
         self.uri = uri
+        self.lines_sent = 0
+        self.sendqueue = None  # set up along with the scheduler once the connection is handed to its user
+        self.scheduler = None
+        self.ready = False  # whether registration is complete; client lines wait for it
+
+    def sendLine(self, line, priority=sendqueue.PRIORITY_INTERACTIVE):
+        if self.sendqueue:
+            self.sendqueue.send(line, priority)
+        else:
+            self.write_line(line)
+
+    def write_line(self, line):
+        """ Write a line to the server right away, bypassing the send queue. """
+        self.lines_sent += 1
+        CallBackLineReceiver.sendLine(self, line)
 
 
 class IRCServerConnectionFactory(Factory):
@@ -388,6 +781,7 @@ class IRCServerConnectionFactory(Factory):
         return IRCServerConnection(self.uri)
 
 if __name__ == '__main__':
-    bouncer = IRCBouncer(1234)
+    worker, configpath = parse_args(sys.argv[1:])
+    bouncer = IRCBouncer(1234, configpath, worker=worker)
     reactor.run()
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,113 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+""" Diagnostic logging for thud.
+
+Every subsystem gets its own logger (thud.bouncer, thud.cache, thud.shell, ...) from getLogger(). Records are
+handed to a bounded queue and written out by a background thread, so a slow stdout/stderr or disk never blocks the
+reactor. Message formatting only happens in that thread, and only for records that passed the level check, so
+callers should always pass arguments separately: log.debug("joined %s", name), never log.debug("joined %s" % name).
+
+Per-line traces (every line sent and received) are logged with log.log(TRACE, ...), a level that is below DEBUG and can be
+sampled with debug_trace_sample so a busy bouncer can keep tracing on without logging every single line.
+"""
+import sys
+import atexit
+import logging
+import threading
+import Queue
+
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+ROOT = "thud"
+FORMAT = "%(asctime)s %(levelname)-5s [%(name)s] %(message)s"
+
+
+def getLogger(subsystem):
+    return logging.getLogger("%s.%s" % (ROOT, subsystem))
+
+
+class TraceSampler(logging.Filter):
+    """ Let through only one in every rate TRACE records; everything above TRACE always passes. """
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = max(int(rate), 1)
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno > TRACE or self.rate == 1:
+            return True
+        self.count += 1
+        return self.count % self.rate == 0
+
+
+class QueueHandler(logging.Handler):
+    """ Hands records to a background writer thread through a bounded queue. Records are dropped (and counted) rather than blocking when the queue is full. """
+    def __init__(self, target, maxsize):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="thud-log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.makeLogRecord({"name": ROOT, "levelno": logging.WARNING, "levelname": "WARNING", "msg": "log queue full, %d records dropped", "args": (dropped,)}))
+            self.target.handle(record)
+        self.target.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+_handler = None
+
+
+def setup(config):
+    """ (Re)configure diagnostic logging from the server config. """
+    global _handler
+    root = logging.getLogger(ROOT)
+    level = config.debug_level or "INFO"
+    root.setLevel(logging.getLevelName(level.upper()) if isinstance(level, basestring) else level)
+    root.propagate = False
+
+    output = config.debug_output
+    if not output or output == "-":
+        target = logging.StreamHandler(sys.stdout)
+    else:
+        target = logging.FileHandler(output)
+    target.setFormatter(logging.Formatter(FORMAT))
+
+    handler = QueueHandler(target, config.debug_queue_size or 10000)
+    handler.addFilter(TraceSampler(config.debug_trace_sample or 1))
+    if _handler:
+        root.removeHandler(_handler)
+        _handler.close()
+    root.addHandler(handler)
+    _handler = handler
+
+
+def shutdown():
+    global _handler
+    if _handler:
+        logging.getLogger(ROOT).removeHandler(_handler)
+        _handler.close()
+        _handler = None
+
+atexit.register(shutdown)
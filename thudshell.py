@@ -1,3 +1,13 @@
+import os
+import time
+import cProfile
+import pstats
+from twisted.internet import reactor
+import search
+import thudlog
+
+log = thudlog.getLogger("shell")
+
 class ThudCommand(object):
     def __init__(self,shell,name,description=""):
         self.shell = shell
@@ -29,7 +39,7 @@ class HelpCommand(ThudCommand):
 
 class ListCommand(ThudCommand):
     def __init__(self,shell):
-        super(ListCommand,self).__init__(shell,"list","list things (servers, client-resources, etc)")
+        super(ListCommand,self).__init__(shell,"list","list things (servers, client-resources, connections, handlers, etc)")
     def _run(self,args):
         if len(args) != 1:
             return self.help(args)
@@ -41,10 +51,169 @@ class ListCommand(ThudCommand):
                 self.shell.respond("    %s - %s" % (name, server.config.uri))
         elif "clients".startswith(kind) or "resources".startswith(kind):
             self.shell.respond("connected downstream client resources:")
-            clients = self.shell.cache.server.config.user.clients
+            clients = self.shell.cache.user.clients
             for resource, client in clients.items():
                 self.shell.respond("    %s connected to %s last seen at %s" % (resource,client.serverref,self.shell.cache.last_seen[resource]))
+                outbound = client.outbound
+                self.shell.respond("        %d bytes queued (peak %d), %d lines sent, %d lines dropped%s" % (outbound.queued_bytes,outbound.peak_queued_bytes,outbound.sent_lines,outbound.dropped_lines,outbound.gap and ", in backlog-only mode" or ""))
+        elif "connections".startswith(kind):
+            user = self.shell.cache.user
+            # admins see the whole queue, which is shared by all users
+            lines = user.bouncer.connector.describe(not user.config.get("admin") and user or None)
+            self.shell.respond("pending connection attempts:")
+            for line in lines or ["none"]:
+                self.shell.respond("    %s" % line)
+        elif "handlers".startswith(kind):
+            import irc  # not at the top, irc imports this module
+            if not irc.handler_timing:
+                return self.shell.respond("handler timing is off, set handler_timing: true in thud.conf")
+            self.shell.respond("server message handlers by total time (all users):")
+            seconds = irc.handler_seconds.values
+            for key in sorted(seconds, key=seconds.get, reverse=True):
+                calls = irc.handler_calls.values[key]
+                self.shell.respond("    %-20s %9d calls %9.3fs total %8.1fus/call" % (key[0],calls,seconds[key],seconds[key] / calls * 1000000))
+
+
+class BacklogCommand(ThudCommand):
+    DEFAULT_COUNT = 100
+    def __init__(self,shell):
+        super(BacklogCommand,self).__init__(shell,"backlog","replay older messages: backlog <channel|nick> [count] [skip]")
+    def _help(self,args):
+        self.shell.respond("backlog <channel|nick> [count] [skip] - replay count messages (default %d), leaving out the newest skip of them" % BacklogCommand.DEFAULT_COUNT)
+    def _run(self,args):
+        if not 1 <= len(args) <= 3 or not all(arg.isdigit() for arg in args[1:]):
+            return self.help(args)
+        cache = self.shell.cache
+        buf = cache.channels.get(args[0]) or cache.queries.get(args[0])
+        if not buf:
+            return self.shell.respond("backlog: no such channel or query: %s" % args[0])
+        count = len(args) > 1 and int(args[1]) or BacklogCommand.DEFAULT_COUNT
+        skip = len(args) > 2 and int(args[2]) or 0
+        buf.replay_older(self.shell.client,count,skip)
+
+
+class SearchCommand(ThudCommand):
+    DEFAULT_RESULTS = 20
+    def __init__(self,shell):
+        super(SearchCommand,self).__init__(shell,"search","search the backlogs: search <words> [from:nick] [in:channel] [since:time] [until:time]")
+    def _help(self,args):
+        self.shell.respond("search <words> [from:nick] [in:channel|nick] [since:time] [until:time] - the %d best matches in the in-memory backlogs, messages with more and rarer of the words first" % SearchCommand.DEFAULT_RESULTS)
+        self.shell.respond("    times are relative (90m, 2h, 3d ago), a time today (14:30) or a date (2024-05-01)")
+    def _run(self,args):
+        if not len(args):
+            return self.help(args)
+        cache = self.shell.cache
+        if not cache.user.config.search_index:
+            return self.shell.respond("search: not enabled, set search_index: true in thud.conf or your .user file")
+        try:
+            query = search.Query(args)
+        except search.QueryError, e:
+            return self.shell.respond("search: %s" % e)
+        results = search.search(cache,query,SearchCommand.DEFAULT_RESULTS)
+        self.shell.respond("search: %d matches for %s" % (len(results)," ".join(args)))
+        for buf, stamp, message in results:
+            nick = message.prefix and message.nick or cache.nick
+            self.shell.respond("    [%s %s] <%s> %s" % (buf.name,stamp.strftime("%Y-%m-%d %H:%M:%S"),nick,message.params[-1]))
+
 
+class AdminCommand(ThudCommand):
+    """ A command only users with 'admin: true' in their own .user file may run. """
+    def run(self, args):
+        if not self.shell.cache.user.config.get("admin"):
+            log.warning("[%s] denied admin command %s", self.shell.cache.user.config.name, self.name)
+            self.shell.respond("%s: permission denied" % self.name)
+            return
+        self._run(args)
+
+class ProfileSession(object):
+    """ The one cProfile run the process can have at a time, shared by every shell. It only profiles the reactor thread. """
+    DEFAULT_SECONDS = 30
+    MAX_SECONDS = 600
+    def __init__(self):
+        self.profile = None
+        self.stats = None # pstats.Stats of the last finished run
+        self.started = None
+        self.timeout = None
+        self.shell = None # the shell that started the run, told when the window runs out
+    def start(self,shell,seconds):
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+        self.shell = shell
+        self.timeout = reactor.callLater(seconds,self.expire)
+        self.profile.enable()
+    def stop(self):
+        self.profile.disable()
+        if self.timeout.active():
+            self.timeout.cancel()
+        self.stats = pstats.Stats(self.profile)
+        self.stats.sort_stats("cumulative")
+        elapsed = time.time() - self.started
+        self.profile = self.timeout = None
+        return elapsed
+    def expire(self):
+        elapsed = self.stop()
+        log.info("profile window of %.1fs ran out", elapsed)
+        self.shell.respond("profile: stopped after %.1fs" % elapsed)
+        self.report(self.shell,10)
+    def report(self,shell,count):
+        shell.respond("profile: top %d functions by cumulative time:" % count)
+        shell.respond("      cumtime   tottime     calls  function")
+        for func in self.stats.fcn_list[:count]:
+            cc, nc, tt, ct, callers = self.stats.stats[func]
+            shell.respond("    %9.3fs %9.3fs %9d  %s:%d(%s)" % (ct,tt,nc,os.path.basename(func[0]),func[1],func[2]))
+
+profile_session = ProfileSession()
+
+class ProfileCommand(AdminCommand):
+    def __init__(self,shell):
+        super(ProfileCommand,self).__init__(shell,"profile","profile the reactor: start [seconds] | stop [filename] | top [count]")
+    def _help(self,args):
+        self.shell.respond("profile start [seconds] - profile the reactor thread for up to seconds (default %d, at most %d)" % (ProfileSession.DEFAULT_SECONDS,ProfileSession.MAX_SECONDS))
+        self.shell.respond("profile stop [filename] - stop profiling, show the top functions and optionally dump pstats data to filename in profile_dir")
+        self.shell.respond("profile top [count] - show the top count functions of the last profile by cumulative time")
+    def _run(self,args):
+        if not len(args):
+            return self.help(args)
+        action = args[0].lower()
+        session = profile_session
+        if action == "start":
+            if session.profile:
+                return self.shell.respond("profile: already running")
+            seconds = len(args) > 1 and args[1].isdigit() and int(args[1]) or ProfileSession.DEFAULT_SECONDS
+            seconds = min(seconds,ProfileSession.MAX_SECONDS)
+            session.start(self.shell,seconds)
+            log.info("[%s] profiling started for %ds", self.shell.cache.user.config.name, seconds)
+            self.shell.respond("profile: started, stopping automatically after %ds" % seconds)
+        elif action == "stop":
+            if not session.profile:
+                return self.shell.respond("profile: not running")
+            elapsed = session.stop()
+            log.info("[%s] profiling stopped after %.1fs", self.shell.cache.user.config.name, elapsed)
+            self.shell.respond("profile: stopped after %.1fs" % elapsed)
+            if len(args) > 1:
+                # never let a shell command write outside profile_dir
+                path = os.path.join(self.shell.cache.user.config.profile_dir or ".",os.path.basename(args[1]))
+                try:
+                    session.stats.dump_stats(path)
+                    self.shell.respond("profile: pstats data written to %s" % path)
+                except (IOError, OSError), e:
+                    self.shell.respond("profile: failed to write %s: %s" % (path,e))
+            session.report(self.shell,10)
+        elif action == "top":
+            if not session.stats:
+                return self.shell.respond("profile: nothing profiled yet")
+            count = len(args) > 1 and args[1].isdigit() and int(args[1]) or 10
+            session.report(self.shell,count)
+        else:
+            self.help(args)
+
+class ReloadCommand(AdminCommand):
+    def __init__(self,shell):
+        super(ReloadCommand,self).__init__(shell,"reload","re-read thud.conf and the .user files, applying what changed")
+    def _run(self,args):
+        log.info("[%s] configuration reload requested", self.shell.cache.user.config.name)
+        self.shell.cache.user.bouncer.request_reload()
+        self.shell.respond("reload: requested, see the log for what changed")
 
 class ThudShell(object):
     def __init__(self, cache, client):
@@ -52,12 +221,17 @@ class ThudShell(object):
         self.commands = {
             "help": HelpCommand(self),
             "list": ListCommand(self),
+            "backlog": BacklogCommand(self),
+            "search": SearchCommand(self),
+            "profile": ProfileCommand(self),
+            "reload": ReloadCommand(self),
         }
     def respond(self, message):
         messages = message.split("\n")
         for m in messages:
             self.client.sendLine(":thud!cache@th.ud NOTICE %s :%s" % (self.cache.server.config.nick,m))
     def handle(self, args):
+        log.info("[%s][%s] THUD %s", self.cache.user.config.name, self.client.resource, " ".join(args))
         cmd = args[0].lower()
         if cmd in self.commands:
             self.commands[cmd].run(args[1:])